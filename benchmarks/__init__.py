@@ -0,0 +1 @@
+"""pyspec benchmarks (see asv.conf.json)"""
@@ -0,0 +1,56 @@
+"""Benchmarks for pyspec.calibration"""
+import os
+import tempfile
+
+from pyspec.cache import set_cache
+from pyspec.calibration import Calibration
+
+from .common import SPECTRUM_SIZES, make_calibration_points
+
+NUM_POINTS = [10, 100, 1000]
+
+
+class CalibrationSuite:
+    """Compute, apply and load wavelength solutions"""
+    params = NUM_POINTS
+    param_names = ["num_points"]
+
+    def setup(self, num_points):
+        """Create the calibration and save it to a temporary file"""
+        set_cache(None)
+        self.calibration_points = make_calibration_points(num_points, 10**4)
+        self.calibration = Calibration(self.calibration_points)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "calibration.dat")
+        self.calibration.save(self.filename)
+
+    def teardown(self, num_points):
+        """Remove the temporary files"""
+        self.tmp_dir.cleanup()
+
+    def time_init(self, num_points):
+        """Calibration.__init__"""
+        Calibration(self.calibration_points)
+
+    def time_from_file(self, num_points):
+        """Calibration.from_file"""
+        Calibration.from_file(self.filename)
+
+
+class CalibrateSuite:
+    """Apply a wavelength solution to spectra of different sizes"""
+    params = SPECTRUM_SIZES
+    param_names = ["size"]
+
+    def setup(self, size):
+        """Create the calibration"""
+        set_cache(None)
+        self.calibration = Calibration(make_calibration_points(20, size))
+
+    def time_calibrate(self, size):
+        """Calibration.calibrate"""
+        self.calibration.calibrate(size)
+
+    def peakmem_calibrate(self, size):
+        """Calibration.calibrate"""
+        self.calibration.calibrate(size)
@@ -0,0 +1,40 @@
+"""Benchmarks for pyspec.image"""
+from pyspec.cache import set_cache
+from pyspec.image import Image
+
+from .common import IMAGE_SIZES, image_filename, write_images
+
+
+class ImageSuite:
+    """Load and rotate synthetic frames"""
+    params = IMAGE_SIZES
+    param_names = ["size"]
+    timeout = 1200
+    # setup runs before each sample, so each rotation starts from a fresh Image
+    number = 1
+
+    def setup_cache(self):
+        """Write the synthetic frames once for all the benchmarks"""
+        return write_images()
+
+    def setup(self, directory, size):
+        """Open the frame, without rotations"""
+        set_cache(None)
+        self.filename = image_filename(directory, size)
+        self.image = Image(self.filename)
+
+    def time_init(self, directory, size):
+        """Image.__init__"""
+        Image(self.filename)
+
+    def peakmem_init(self, directory, size):
+        """Image.__init__"""
+        Image(self.filename)
+
+    def time_rotate(self, directory, size):
+        """Image.rotate"""
+        self.image.rotate("1.5")
+
+    def peakmem_rotate(self, directory, size):
+        """Image.rotate"""
+        self.image.rotate("1.5")
@@ -0,0 +1,78 @@
+"""Benchmarks for pyspec.spectrum"""
+import os
+import tempfile
+
+from pyspec.cache import set_cache
+from pyspec.image import Image
+from pyspec.spectrum import Spectrum
+
+from .common import (IMAGE_SIZES, SPECTRUM_SIZES, image_filename,
+                     make_peak, make_spectrum, write_images)
+
+
+class ExtractionSuite:
+    """Extract spectra from synthetic frames"""
+    params = IMAGE_SIZES
+    param_names = ["size"]
+    timeout = 1200
+
+    def setup_cache(self):
+        """Write the synthetic frames once for all the benchmarks"""
+        return write_images()
+
+    def setup(self, directory, size):
+        """Open the frame"""
+        set_cache(None)
+        self.image = Image(image_filename(directory, size))
+        self.lower_limit = size // 2 - size // 100
+        self.upper_limit = size // 2 + size // 100
+
+    def time_from_image(self, directory, size):
+        """Spectrum.from_image"""
+        Spectrum.from_image(self.image, self.lower_limit, self.upper_limit)
+
+    def peakmem_from_image(self, directory, size):
+        """Spectrum.from_image"""
+        Spectrum.from_image(self.image, self.lower_limit, self.upper_limit)
+
+
+class SpectrumSuite:
+    """Operations on synthetic spectra"""
+    params = SPECTRUM_SIZES
+    param_names = ["size"]
+    timeout = 1200
+
+    def setup(self, size):
+        """Create the spectrum and save it to a temporary file"""
+        set_cache(None)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "spectrum.dat")
+        self.spectrum = Spectrum(make_spectrum(size), None, self.filename)
+        self.spectrum.save()
+        # find_local_max walks pixel by pixel, so start far from the peak
+        self.peak = Spectrum(make_peak(size), None, self.filename)
+        self.start = size // 4
+
+    def teardown(self, size):
+        """Remove the temporary files"""
+        self.tmp_dir.cleanup()
+
+    def time_find_local_max(self, size):
+        """Spectrum.find_local_max"""
+        self.peak.find_local_max(self.start)
+
+    def time_save(self, size):
+        """Spectrum.save"""
+        self.spectrum.save()
+
+    def peakmem_save(self, size):
+        """Spectrum.save"""
+        self.spectrum.save()
+
+    def time_from_file(self, size):
+        """Spectrum.from_file"""
+        Spectrum.from_file(self.filename)
+
+    def peakmem_from_file(self, size):
+        """Spectrum.from_file"""
+        Spectrum.from_file(self.filename)
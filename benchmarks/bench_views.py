@@ -0,0 +1,92 @@
+"""Benchmarks for the plotting widgets, using an offscreen Qt platform"""
+import os
+
+from pyspec.cache import set_cache
+from pyspec.image import Image
+from pyspec.spectrum import Spectrum
+
+from .common import (IMAGE_SIZES, SPECTRUM_SIZES, image_filename,
+                     make_spectrum, write_images)
+
+_APP = None
+
+
+def get_application():
+    """Create the QApplication once per process
+
+    Return
+    ------
+    app: QApplication
+    The application
+    """
+    global _APP  # pylint: disable=global-statement
+    if _APP is None:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        # pylint: disable-next=import-outside-toplevel
+        from PyQt6.QtWidgets import QApplication
+        _APP = QApplication.instance() or QApplication([])
+    return _APP
+
+
+class ImageViewSuite:
+    """Redraw ImageView"""
+    params = IMAGE_SIZES
+    param_names = ["size"]
+    timeout = 1200
+
+    def setup_cache(self):
+        """Write the synthetic frames once for all the benchmarks"""
+        return write_images()
+
+    def setup(self, directory, size):
+        """Open the frame and create the widget"""
+        set_cache(None)
+        self.app = get_application()
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.image_view import ImageView
+        self.image = Image(image_filename(directory, size))
+        self.image_view = ImageView(self.image)
+        self.app.processEvents()
+
+    def teardown(self, directory, size):
+        """Close the widget"""
+        self.image_view.close()
+        self.image_view.deleteLater()
+        self.app.processEvents()
+
+    def time_update_plot(self, directory, size):
+        """ImageView.updatePlot"""
+        self.image_view.updatePlot()
+        self.image_view.grab()
+
+    def peakmem_update_plot(self, directory, size):
+        """ImageView.updatePlot"""
+        self.image_view.updatePlot()
+        self.image_view.grab()
+
+
+class SpectrumViewSuite:
+    """Redraw SpectrumView"""
+    params = SPECTRUM_SIZES[:-1]
+    param_names = ["size"]
+
+    def setup(self, size):
+        """Create the spectrum and the widget"""
+        set_cache(None)
+        self.app = get_application()
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.spectrum_view import SpectrumView
+        self.spectrum_view = SpectrumView(
+            Spectrum(make_spectrum(size), None, "spectrum.dat"))
+        self.app.processEvents()
+
+    def teardown(self, size):
+        """Close the widget"""
+        self.spectrum_view.close()
+        self.spectrum_view.deleteLater()
+        self.app.processEvents()
+
+    def time_update_plot(self, size):
+        """SpectrumView.updatePlot"""
+        self.spectrum_view.updatePlot()
+        self.spectrum_view.grab()
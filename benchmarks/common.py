@@ -0,0 +1,148 @@
+"""Synthetic data shared by the benchmarks"""
+import os
+
+import numpy as np
+
+# image sizes (number of pixels per side) and spectrum sizes (number of pixels)
+IMAGE_SIZES = [1024, 2048, 4096, 8192]
+SPECTRUM_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+SEED = 458932
+
+
+def make_image(size, seed=SEED):
+    """Make a synthetic frame with a tilted spectral trace and arc-like lines
+
+    Arguments
+    ---------
+    size: int
+    Number of pixels per side
+
+    seed: int - Default: SEED
+    Seed of the random generator
+
+    Return
+    ------
+    data: array of uint16
+    The frame
+    """
+    rng = np.random.default_rng(seed)
+    y_pos = np.arange(size, dtype=np.float32)[:, None]
+    x_pos = np.arange(size, dtype=np.float32)[None, :]
+    trace = size / 2 + 0.02 * (x_pos - size / 2)
+    profile = np.exp(-0.5 * ((y_pos - trace) / (size / 200))**2)
+    lines = 1 + 5 * np.sin(x_pos * (40 * np.pi / size))**40
+    data = 1000 + 20000 * profile * lines
+    data += rng.normal(0, 10, size=data.shape).astype(np.float32)
+    return data.clip(0, 65535).astype(np.uint16)
+
+
+def make_spectrum(size, seed=SEED):
+    """Make a synthetic arc spectrum
+
+    Arguments
+    ---------
+    size: int
+    Number of pixels
+
+    seed: int - Default: SEED
+    Seed of the random generator
+
+    Return
+    ------
+    flux: array of float
+    The spectrum flux
+    """
+    rng = np.random.default_rng(seed)
+    x_pos = np.arange(size)
+    flux = 100 + 1000 * np.sin(x_pos * (200 * np.pi / size))**40
+    return flux + rng.normal(0, 1, size=size)
+
+
+def make_peak(size):
+    """Make a spectrum with a single broad peak in the middle
+
+    Arguments
+    ---------
+    size: int
+    Number of pixels
+
+    Return
+    ------
+    flux: array of float
+    The spectrum flux
+    """
+    x_pos = np.arange(size)
+    return np.exp(-0.5 * ((x_pos - size / 2) / (size / 20))**2)
+
+
+def make_calibration_points(num_points, size):
+    """Make sorted calibration points following a smooth wavelength solution
+
+    Arguments
+    ---------
+    num_points: int
+    Number of calibration points
+
+    size: int
+    Number of pixels of the spectrum
+
+    Return
+    ------
+    calibration_points: np.ndarray
+    Named array with fields "x" and "wave"
+    """
+    x_pos = np.linspace(0, size - 1, num_points)
+    wave = 4000 + 3000 * x_pos / size + 50 * (x_pos / size)**2
+    calibration_points = np.zeros(num_points, dtype=[("x", float),
+                                                     ("wave", float)])
+    calibration_points["x"] = x_pos
+    calibration_points["wave"] = wave
+    return calibration_points
+
+
+def image_filename(directory, size):
+    """Name of the synthetic frame of a given size
+
+    Arguments
+    ---------
+    directory: str
+    Directory where the frames are stored
+
+    size: int
+    Number of pixels per side
+
+    Return
+    ------
+    filename: str
+    The frame name
+    """
+    return os.path.join(directory, f"frame_{size}.fits")
+
+
+def write_images(directory="synthetic_frames", sizes=IMAGE_SIZES):
+    """Write the synthetic frames. Used by the setup_cache of the suites
+
+    Arguments
+    ---------
+    directory: str - Default: "synthetic_frames"
+    Directory where the frames are stored
+
+    sizes: list of int - Default: IMAGE_SIZES
+    Number of pixels per side of each frame
+
+    Return
+    ------
+    directory: str
+    Absolute path of the directory
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from astropy.io import fits
+
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    for size in sizes:
+        fits.writeto(image_filename(directory, size),
+                     make_image(size),
+                     overwrite=True)
+    return directory
@@ -1,4 +1,6 @@
 """pyspec app"""
+import logging
+import os
 import sys
 
 from PyQt6.QtWidgets import QApplication
@@ -6,6 +8,7 @@ from PyQt6.QtWidgets import QApplication
 from pyspec.app.main_window import MainWindow
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("PYSPEC_LOG_LEVEL", "WARNING"))
     app = QApplication([])
     mainWindow = MainWindow()
     mainWindow.show()
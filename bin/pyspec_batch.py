@@ -0,0 +1,5 @@
+"""pyspec batch reduction"""
+from pyspec.batch import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""pyspec night scanner"""
+from pyspec.catalog import main
+
+if __name__ == "__main__":
+    main()
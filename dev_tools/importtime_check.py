@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Check that the pyspec GUI starts within the allowed time budget
+
+The check runs `python -X importtime` on the main window module and fails if
+1. the cumulative import time exceeds the import budget, or
+2. any of the heavy scientific packages (which must only be imported on first
+   use) is imported before the window is shown, or
+3. the time to show the first (offscreen) window exceeds the window budget.
+
+Usage (from the repo folder):
+    python dev_tools/importtime_check.py [--import-budget MS] [--window-budget MS]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+MAIN_MODULE = "pyspec.app.main_window"
+DEFERRED_MODULES = ["astropy", "scipy", "pyqtgraph"]
+
+FIRST_WINDOW_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+from PyQt6.QtWidgets import QApplication
+from pyspec.app.main_window import MainWindow
+app = QApplication([])
+mainWindow = MainWindow()
+mainWindow.show()
+app.processEvents()
+print((time.perf_counter() - start) * 1000)
+print(",".join(sorted(sys.modules)))
+"""
+
+
+def parse_importtime(stderr):
+    """Parse the output of python -X importtime
+
+    Arguments
+    ---------
+    stderr: str
+    The standard error of the python process
+
+    Return
+    ------
+    cumulative: dict
+    Cumulative import time (in microseconds) for each imported module
+    """
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_time, module = line.split(":", 1)[1].split("|")
+        cumulative[module.strip()] = int(cumulative_time)
+    return cumulative
+
+
+def run(command, env):
+    """Run a command and return the completed process
+
+    Arguments
+    ---------
+    command: list of str
+    The command to run
+
+    env: dict
+    Environment variables
+
+    Return
+    ------
+    process: subprocess.CompletedProcess
+    The finished process
+    """
+    return subprocess.run(command,
+                          capture_output=True,
+                          text=True,
+                          env=env,
+                          check=True)
+
+
+def main():
+    """Run the checks"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--import-budget",
+                        type=float,
+                        default=400.0,
+                        help="Maximum import time of the main window (ms)")
+    parser.add_argument("--window-budget",
+                        type=float,
+                        default=1000.0,
+                        help="Maximum time to show the first window (ms)")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    failures = []
+
+    # import time of the main window module
+    process = run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MAIN_MODULE}"],
+        env)
+    cumulative = parse_importtime(process.stderr)
+    import_time = cumulative[MAIN_MODULE] / 1000
+    print(f"import {MAIN_MODULE}: {import_time:.1f} ms "
+          f"(budget {args.import_budget:.1f} ms)")
+    if import_time > args.import_budget:
+        failures.append("import time budget exceeded")
+    for module in DEFERRED_MODULES:
+        if module in cumulative:
+            failures.append(f"{module} is imported at start-up")
+
+    # time to first window
+    process = run([sys.executable, "-c", FIRST_WINDOW_SCRIPT], env)
+    window_time, modules = process.stdout.strip().splitlines()[-2:]
+    window_time = float(window_time)
+    print(f"time to first window: {window_time:.1f} ms "
+          f"(budget {args.window_budget:.1f} ms)")
+    if window_time > args.window_budget:
+        failures.append("time to first window budget exceeded")
+    modules = modules.split(",")
+    for module in DEFERRED_MODULES:
+        if module in modules:
+            failures.append(f"{module} is imported before the first window")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Check the directory watcher on synthetic frames
+
+The check writes synthetic FITS frames into a temporary directory while a
+DirectoryWatcher polls it, and fails if
+1. a frame already in the directory when the watcher starts is reduced,
+2. a frame is reduced while it is still being written,
+3. a new frame is not reduced once its writing finished,
+4. a flat frame is reduced (the frames are routed), or
+5. terminate does not return promptly with the queued frames pending.
+
+Usage (from the repo folder):
+    python dev_tools/watcher_check.py [--num-frames N] [--timeout S]
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from pyspec.watcher import DirectoryWatcher
+
+FRAME_SHAPE = (200, 400)
+LOWER_LIMIT = 90
+UPPER_LIMIT = 110
+POLL_INTERVAL = 0.05  # in seconds
+
+
+def frame_bytes(frame_type, seed):
+    """Create a synthetic frame
+
+    Arguments
+    ---------
+    frame_type: str
+    Value of the IMAGETYP keyword
+
+    seed: int
+    Seed of the noise
+
+    Return
+    ------
+    content: bytes
+    The FITS file content
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100, 5, FRAME_SHAPE).astype(np.float32)
+    columns = np.arange(FRAME_SHAPE[1])
+    for line in (50, 140, 230, 320):
+        data[LOWER_LIMIT:UPPER_LIMIT] += 1000 * np.exp(
+            -0.5 * ((columns - line) / 1.5)**2)
+    header = fits.Header()
+    header["IMAGETYP"] = frame_type
+    header["EXPTIME"] = 60.0
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data, header).writeto(buffer)
+    return buffer.getvalue()
+
+
+def write_frame(directory, name, content):
+    """Write a frame
+
+    Arguments
+    ---------
+    directory: str
+    The watched directory
+
+    name: str
+    Name of the frame
+
+    content: bytes
+    The FITS file content
+
+    Return
+    ------
+    filename: str
+    Name of the written file
+    """
+    filename = os.path.join(directory, name)
+    with open(filename, "wb") as file:
+        file.write(content)
+    return filename
+
+
+def poll_until(watcher, condition, timeout):
+    """Poll the watcher until a condition is met
+
+    Arguments
+    ---------
+    watcher: DirectoryWatcher
+    The watcher
+
+    condition: function
+    Function without arguments returning True when the wait is over
+
+    timeout: float
+    Maximum waiting time in seconds
+
+    Return
+    ------
+    met: bool
+    True if the condition was met before the timeout
+    """
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        watcher.poll()
+        if condition():
+            return True
+        time.sleep(POLL_INTERVAL)
+    return False
+
+
+def main():
+    """Run the checks"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--num-frames",
+                        type=int,
+                        default=6,
+                        help="Number of new science frames")
+    parser.add_argument("--timeout",
+                        type=float,
+                        default=60.0,
+                        help="Maximum time to reduce the frames (s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        existing = write_frame(directory, "existing.fits",
+                               frame_bytes("science", 0))
+        watcher = DirectoryWatcher(directory, 0.0, LOWER_LIMIT, UPPER_LIMIT,
+                                   num_processors=2, route=True)
+        try:
+            # a frame being written is not read
+            content = frame_bytes("science", 1)
+            partial = write_frame(directory, "partial.fits",
+                                  content[:len(content) // 2])
+            for _ in range(3):
+                watcher.poll()
+                time.sleep(POLL_INTERVAL)
+            if partial in watcher.queued:
+                failures.append("a frame was queued while being written")
+            write_frame(directory, "partial.fits", content)
+
+            # new frames and a flat
+            for index in range(args.num_frames):
+                write_frame(directory, f"science{index}.fits",
+                            frame_bytes("science", index + 2))
+            flat = write_frame(directory, "flat.fits", frame_bytes("flat", 99))
+
+            start = time.perf_counter()
+            if not poll_until(
+                    watcher,
+                    lambda: len(watcher.names) + len(watcher.failed) >=
+                    args.num_frames + 1, args.timeout):
+                failures.append(
+                    f"only {len(watcher.names)} of {args.num_frames + 1} "
+                    "frames were reduced")
+            print(f"{len(watcher.names)} frames reduced in "
+                  f"{time.perf_counter() - start:.2f} s")
+            if watcher.failed:
+                failures.append(f"reductions failed: {watcher.failed}")
+            if partial not in watcher.queued:
+                failures.append("the frame written in two steps was not "
+                                "reduced")
+            if existing in watcher.queued:
+                failures.append("a frame present at start was reduced")
+            if flat in watcher.queued or flat not in watcher.skipped:
+                failures.append("the flat frame was not skipped")
+            for name in watcher.names:
+                if not os.path.isfile(name):
+                    failures.append(f"{name} was not saved")
+
+            # terminate does not wait for the queued frames
+            for index in range(args.num_frames):
+                write_frame(directory, f"late{index}.fits",
+                            frame_bytes("science", index + 100))
+            poll_until(watcher, lambda: len(watcher.queued) > args.num_frames
+                       + 1, args.timeout)
+        finally:
+            start = time.perf_counter()
+            num_dropped = watcher.terminate()
+            terminate_time = time.perf_counter() - start
+        print(f"terminate: {terminate_time:.2f} s, {num_dropped} queued "
+              "frames not reduced")
+        if num_dropped < 0:
+            failures.append("terminate reported a negative number of frames")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
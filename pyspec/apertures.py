@@ -0,0 +1,129 @@
+""" Detection and batched extraction of several apertures (traces) in a frame
+
+Apertures are bands of rows given as (lower_limit, upper_limit) pairs, with
+the same meaning as the limits of Spectrum.from_image. Detected apertures are
+sorted and do not overlap, which allows extracting all of them from a single
+band of rows with np.add.reduceat.
+"""
+import numpy as np
+
+from pyspec.errors import SpectrumError
+from pyspec.precision import get_working_dtype
+
+DEFAULT_DETECTION_SIGMA = 5.0
+DEFAULT_MIN_WIDTH = 3  # in rows
+DEFAULT_PADDING = 1  # in rows
+PROFILE_COLUMNS = 256  # number of columns sampled to build the profile
+
+def check_apertures(apertures):
+    """Check that the apertures are sorted, not empty and do not overlap
+
+    Arguments
+    ---------
+    apertures: list of (int, int)
+    The apertures
+
+    Raise
+    -----
+    SpectrumError if the apertures are not valid
+    """
+    previous_upper = None
+    for lower_limit, upper_limit in apertures:
+        if lower_limit >= upper_limit:
+            raise SpectrumError(
+                f"Spectrum: Empty aperture ({lower_limit}, {upper_limit})")
+        if previous_upper is not None and lower_limit < previous_upper:
+            raise SpectrumError(
+                "Spectrum: Apertures must be sorted and must not overlap")
+        previous_upper = upper_limit
+
+def extract_apertures(band, apertures, first_row=0):
+    """Extract the mean flux of several apertures at once
+
+    Arguments
+    ---------
+    band: array of float
+    Rows of the image containing all the apertures
+
+    apertures: list of (int, int)
+    The apertures. Must be sorted and must not overlap (see check_apertures)
+
+    first_row: int - Default: 0
+    Image row of the first row of the band
+
+    Return
+    ------
+    fluxes: array of float
+    The flux of each aperture (one row per aperture), in the working dtype
+    (see pyspec.precision)
+
+    Raise
+    -----
+    SpectrumError if the apertures are not valid
+    """
+    check_apertures(apertures)
+    limits = np.asarray(apertures, dtype=int) - first_row
+    if limits.min() < 0 or limits.max() > band.shape[0]:
+        raise SpectrumError("Spectrum: Apertures outside the band")
+
+    # sums over [lower_0, upper_0), [upper_0, lower_1), [lower_1, upper_1)...
+    # The sums over the gaps between apertures are discarded
+    indices = limits.ravel()
+    if indices[-1] == band.shape[0]:
+        # the last aperture goes to the end of the band
+        indices = indices[:-1]
+    sums = np.add.reduceat(band, indices, axis=0, dtype=np.float64)[::2]
+    sums /= limits[:, 1:] - limits[:, :1]
+    return sums.astype(get_working_dtype(), copy=False)
+
+def find_apertures(data, sigma=DEFAULT_DETECTION_SIGMA,
+                   min_width=DEFAULT_MIN_WIDTH, padding=DEFAULT_PADDING):
+    """Detect the apertures in an image from its spatial profile
+
+    The spatial profile is the median over a sample of columns. Rows more than
+    sigma times the (robust) noise above the background are part of an
+    aperture
+
+    Arguments
+    ---------
+    data: array of float
+    The image data. Traces must be roughly horizontal (rotate the image first)
+
+    sigma: float - Default: DEFAULT_DETECTION_SIGMA
+    Detection threshold in units of the profile noise
+
+    min_width: int - Default: DEFAULT_MIN_WIDTH
+    Minimum number of rows of an aperture. Narrower detections are ignored
+
+    padding: int - Default: DEFAULT_PADDING
+    Rows added on each side of the detections, as long as apertures do not
+    overlap
+
+    Return
+    ------
+    apertures: list of (int, int)
+    The detected apertures, sorted
+    """
+    step = max(data.shape[1] // PROFILE_COLUMNS, 1)
+    profile = np.median(data[:, ::step], axis=1)
+    background = np.median(profile)
+    noise = 1.4826 * np.median(np.abs(profile - background))
+    if noise == 0.0:
+        noise = np.std(profile)
+    mask = profile > background + sigma * noise
+
+    # start and end of the runs of detected rows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8),
+                                                   [0]))))
+    lowers, uppers = edges[::2], edges[1::2]
+    keep = uppers - lowers >= min_width
+    lowers, uppers = lowers[keep] - padding, uppers[keep] + padding
+
+    # padding must not create overlaps
+    lowers[0:1] = np.maximum(lowers[0:1], 0)
+    uppers[-1:] = np.minimum(uppers[-1:], data.shape[0])
+    middles = (uppers[:-1] + lowers[1:]) // 2
+    uppers[:-1] = np.minimum(uppers[:-1], middles)
+    lowers[1:] = np.maximum(lowers[1:], middles)
+
+    return [(int(lower), int(upper)) for lower, upper in zip(lowers, uppers)]
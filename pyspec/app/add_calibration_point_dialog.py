@@ -1,6 +1,6 @@
 """ Dialog to add calibration points"""
 from PyQt6.QtWidgets import (
-    QDialog, QDialogButtonBox, QGridLayout, QLabel, QLineEdit
+    QComboBox, QDialog, QDialogButtonBox, QGridLayout, QLabel, QLineEdit
 )
 
 class AddCalibrationPointDialog(QDialog):
@@ -18,19 +18,30 @@ class AddCalibrationPointDialog(QDialog):
     buttonBox: QDialogButtonBox
     Accept/cancel button
 
+    candidatesBox: QComboBox or None
+    Candidate lines. Choosing one sets its wavelength. None if there are no
+    candidates
+
     xPosQuestion: QLineEdit
     Field to modify the peak position
 
     wavelengthQuestion: QLineEdit
     Field to modify the wavelength of the peak
     """
-    def __init__(self, xPos, wavelength=None):
+    def __init__(self, xPos, wavelength=None, candidates=None):
         """Initialize instance
 
         Arguments
         ---------
         xPos: int
         Initial guess for x position
+
+        wavelength: float or None - Default: None
+        Expected wavelength of the peak
+
+        candidates: list of (str, float) or None - Default: None
+        Label and wavelength of the candidate lines, the most likely first.
+        The wavelength of the first one is filled in
         """
         super().__init__()
 
@@ -58,5 +69,18 @@ class AddCalibrationPointDialog(QDialog):
         layout.addWidget(self.wavelengthQuestion, 0, 1)
         layout.addWidget(QLabel("X position"), 1, 0)
         layout.addWidget(self.xPosQuestion, 1, 1)
+
+        self.candidatesBox = None
+        if candidates:
+            self.candidatesBox = QComboBox()
+            for label, candidateWavelength in candidates:
+                self.candidatesBox.addItem(label, candidateWavelength)
+            self.candidatesBox.currentIndexChanged.connect(
+                lambda index: self.wavelengthQuestion.setText(
+                    str(self.candidatesBox.itemData(index))))
+            self.wavelengthQuestion.setText(str(candidates[0][1]))
+            layout.addWidget(QLabel("Atlas lines"), 2, 0)
+            layout.addWidget(self.candidatesBox, 2, 1)
+
         layout.addWidget(self.buttonBox)
         self.setLayout(layout)
@@ -7,6 +7,7 @@ from PyQt6.QtWidgets import (
 from pyspec.app.add_calibration_point_dialog import AddCalibrationPointDialog
 from pyspec.app.error_dialog import ErrorDialog
 from pyspec.app.q_push_button_index import QPushButtonIndex
+from pyspec.calibration import IncrementalFit
 
 class CalibrationPointListDialog(QDialog):
     """ Class to define the dialog to list and modify current calibration point
@@ -23,19 +24,27 @@ class CalibrationPointListDialog(QDialog):
     buttonBox: QDialogButtonBox
     Accept/cancel button
 
+    calibrationFit: IncrementalFit or None
+    Fit of the points not deleted, updated after every edit to show their
+    residuals. None if the residuals are not shown
+
     calibrationPoints: list of [int, float, boolean]
     List with lists containting:
     1. An integer with the x position of the peak
     2. A float with the wavelength of the peak
     3. A boolean determining whether this peak has been deleted (True) or not (False)
     """
-    def __init__(self, calibrationPoints):
+    def __init__(self, calibrationPoints, size=None):
         """Initialize instance
 
         Arguments
         ---------
         calibrationPoints: dict
         Dictionary with pairs of x and wavelengths
+
+        size: int or None - Default: None
+        Size of the spectrum. If given, the residuals of the points with
+        respect to their fit are shown and the outliers highlighted
         """
         super().__init__()
 
@@ -43,6 +52,7 @@ class CalibrationPointListDialog(QDialog):
             [key, calibrationPoints.get(key), False]
             for key in sorted(calibrationPoints)
         ]
+        self.calibrationFit = None if size is None else IncrementalFit(size)
 
         self.setWindowTitle("Calibration points list")
 
@@ -126,6 +136,22 @@ class CalibrationPointListDialog(QDialog):
             layout.addWidget(QLabel("wavelength"), 0, 1)
             layout.addWidget(QLabel("(in Angs)"), 1, 1)
 
+            # refit the points not deleted
+            pixelResiduals = {}
+            if self.calibrationFit is not None:
+                self.calibrationFit.update({
+                    xPos: wavelength
+                    for xPos, wavelength, deleted in self.calibrationPoints
+                    if not deleted
+                })
+                _, residuals = self.calibrationFit.solve()
+                pixelResiduals = {
+                    int(item["x"]): (item["pixel_residual"], item["outlier"])
+                    for item in residuals
+                }
+                layout.addWidget(QLabel("residual"), 0, 2)
+                layout.addWidget(QLabel("(in pixels)"), 1, 2)
+
             next_index = 2
             for index, (xPos, wavelength, deleted) in enumerate(self.calibrationPoints):
                 if deleted:
@@ -147,22 +173,32 @@ class CalibrationPointListDialog(QDialog):
 
                     restoreButton = QPushButtonIndex("Restore", index)
                     restoreButton.clicked.connect(self.restorePoint)
-                    layout.addWidget(restoreButton, index + next_index, 2)
+                    layout.addWidget(restoreButton, index + next_index, 3)
 
                 else:
                     layout.addWidget(QLabel(str(xPos)), index + next_index, 0)
                     layout.addWidget(QLabel(str(wavelength)), index + next_index, 1)
 
+                    if xPos in pixelResiduals:
+                        pixelResidual, outlier = pixelResiduals[xPos]
+                        labelResidual = QLabel(f"{pixelResidual:+.2f}")
+                        if outlier:
+                            labelResidual.setText(
+                                f"{pixelResidual:+.2f} (outlier)")
+                            labelResidual.setStyleSheet("color: orange")
+                        layout.addWidget(
+                            labelResidual, index + next_index, 2)
+
                     deleteButton = QPushButtonIndex("Delete", index)
                     deleteButton.clicked.connect(self.deletePoint)
-                    layout.addWidget(deleteButton, index + next_index, 2)
+                    layout.addWidget(deleteButton, index + next_index, 3)
 
                     modifyButton = QPushButtonIndex("Modify", index)
                     modifyButton.clicked.connect(self.modifyPoint)
-                    layout.addWidget(modifyButton, index + next_index, 3)
+                    layout.addWidget(modifyButton, index + next_index, 4)
 
 
             next_index += index + 1
-            layout.addWidget(self.buttonBox, next_index, 4)
+            layout.addWidget(self.buttonBox, next_index, 5)
 
         self.setLayout(layout)
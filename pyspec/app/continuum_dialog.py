@@ -0,0 +1,137 @@
+""" Dialog to fit the continuum of a Spectrum"""
+from PyQt6.QtCore import pyqtSignal
+from PyQt6.QtWidgets import (
+    QComboBox, QDialog, QDialogButtonBox, QDoubleSpinBox, QGridLayout, QLabel,
+    QLineEdit, QSpinBox
+)
+
+from pyspec.continuum import (
+    CONTINUUM_MODELS, DEFAULT_CONTINUUM_MODEL, DEFAULT_NUM_COEFFICIENTS,
+    DEFAULT_SIGMA_LOWER, DEFAULT_SIGMA_UPPER
+)
+
+class ContinuumDialog(QDialog):
+    """ Class to define the dialog to fit the continuum of a Spectrum
+
+    The signal parametersChanged is emitted every time a field changes, so
+    the continuum can be previewed while the dialog is open
+
+    Methods
+    -------
+    (see QDialog)
+    __init__
+    parameters
+
+    Arguments
+    ---------
+    (see QDialog)
+
+    buttonBox: QDialogButtonBox
+    Accept/cancel button
+
+    maskedRangesQuestion: QLineEdit
+    Field to input the ranges excluded from the fit
+
+    modelQuestion: QComboBox
+    Field to choose the continuum model
+
+    numCoefficientsQuestion: QSpinBox
+    Field to input the number of coefficients
+
+    sigmaLowerQuestion: QDoubleSpinBox
+    Field to input the lower rejection threshold
+
+    sigmaUpperQuestion: QDoubleSpinBox
+    Field to input the upper rejection threshold
+    """
+    parametersChanged = pyqtSignal()
+
+    def __init__(self, calibrated):
+        """Initialize instance
+
+        Arguments
+        ---------
+        calibrated: bool
+        True if the spectrum is calibrated (ranges are in wavelength)
+        """
+        super().__init__()
+
+        self.setWindowTitle("Normalize by continuum")
+
+        QButtons = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
+
+        self.buttonBox = QDialogButtonBox(QButtons)
+        self.buttonBox.accepted.connect(self.accept)
+        self.buttonBox.rejected.connect(self.reject)
+
+        self.modelQuestion = QComboBox()
+        self.modelQuestion.addItems(CONTINUUM_MODELS)
+        self.modelQuestion.setCurrentText(DEFAULT_CONTINUUM_MODEL)
+        self.modelQuestion.currentTextChanged.connect(
+            lambda text: self.parametersChanged.emit())
+
+        self.numCoefficientsQuestion = QSpinBox()
+        self.numCoefficientsQuestion.setRange(1, 100)
+        self.numCoefficientsQuestion.setValue(DEFAULT_NUM_COEFFICIENTS)
+        self.numCoefficientsQuestion.valueChanged.connect(
+            lambda value: self.parametersChanged.emit())
+
+        self.sigmaLowerQuestion = QDoubleSpinBox()
+        self.sigmaLowerQuestion.setRange(0.5, 100.0)
+        self.sigmaLowerQuestion.setSingleStep(0.5)
+        self.sigmaLowerQuestion.setValue(DEFAULT_SIGMA_LOWER)
+        self.sigmaLowerQuestion.valueChanged.connect(
+            lambda value: self.parametersChanged.emit())
+
+        self.sigmaUpperQuestion = QDoubleSpinBox()
+        self.sigmaUpperQuestion.setRange(0.5, 100.0)
+        self.sigmaUpperQuestion.setSingleStep(0.5)
+        self.sigmaUpperQuestion.setValue(DEFAULT_SIGMA_UPPER)
+        self.sigmaUpperQuestion.valueChanged.connect(
+            lambda value: self.parametersChanged.emit())
+
+        self.maskedRangesQuestion = QLineEdit()
+        self.maskedRangesQuestion.setPlaceholderText("e.g. 6550-6575, 4855-4870")
+        self.maskedRangesQuestion.editingFinished.connect(
+            self.parametersChanged.emit)
+
+        units = "Angs" if calibrated else "pixels"
+        layout = QGridLayout()
+        layout.addWidget(QLabel("Model"), 0, 0)
+        layout.addWidget(self.modelQuestion, 0, 1)
+        layout.addWidget(QLabel("Number of coefficients"), 1, 0)
+        layout.addWidget(self.numCoefficientsQuestion, 1, 1)
+        layout.addWidget(QLabel("Rejection below (sigma)"), 2, 0)
+        layout.addWidget(self.sigmaLowerQuestion, 2, 1)
+        layout.addWidget(QLabel("Rejection above (sigma)"), 3, 0)
+        layout.addWidget(self.sigmaUpperQuestion, 3, 1)
+        layout.addWidget(QLabel(f"Masked ranges (in {units})"), 4, 0)
+        layout.addWidget(self.maskedRangesQuestion, 4, 1)
+        layout.addWidget(self.buttonBox)
+        self.setLayout(layout)
+
+    def parameters(self):
+        """Get the fit parameters
+
+        Return
+        ------
+        parameters: dict
+        Arguments of continuum.fit_continuum
+
+        Raise
+        -----
+        ValueError if the masked ranges are malformed
+        """
+        maskedRanges = []
+        for item in self.maskedRangesQuestion.text().split(","):
+            if item.strip() == "":
+                continue
+            start, end = item.split("-")
+            maskedRanges.append((float(start), float(end)))
+        return {
+            "masked_ranges": maskedRanges,
+            "model": self.modelQuestion.currentText(),
+            "num_coefficients": self.numCoefficientsQuestion.value(),
+            "sigma_lower": self.sigmaLowerQuestion.value(),
+            "sigma_upper": self.sigmaUpperQuestion.value(),
+        }
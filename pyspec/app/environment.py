@@ -9,3 +9,12 @@ BUTTONS_PATH = f"{THIS_DIR}/button_plots/"
 WIDTH = 800
 HEIGHT = 800
 ICON_SIZE = 30
+
+# workspace properties
+WORKSPACE_MEMORY_BUDGET = 2 * 1024**3  # in bytes
+
+# instrumentation properties
+TIMINGS_REFRESH_INTERVAL = 1000  # in milliseconds
+
+# folder watcher properties
+WATCHER_POLL_INTERVAL = 2000  # in milliseconds
@@ -16,7 +16,11 @@ class ImageView(pg.PlotWidget):
     activateChooseLimitOnClick
     deactivateChooseLimitOnClick
     mousePressEvent
-    setImge
+    releaseImage
+    restoreSessionState
+    sessionState
+    setApertures
+    setImage
     setPlot
     updatePlot
 
@@ -24,11 +28,22 @@ class ImageView(pg.PlotWidget):
     ----------
     (see pg.PlotWidget)
 
+    apertures: list of (int, int)
+    Lower and upper limits of the apertures extracted at once (see
+    Spectrum.from_apertures)
+
     chooseLimit: str or None
     String that specifies which limit is being set ("upper" or "lower"). None for
     no limit. If any limit is set, then mouse clicks on the image will store
     the y position of the click
 
+    imageData: array of float or None
+    The image data. None if the image was released
+
+    levels: (float, float) or None
+    The display levels of the image (see Image.display_levels). None if the
+    image was released
+
     lowerLimit: int or None
     Lower limit of the area to be considered in the extraction of a spectrum
 
@@ -48,19 +63,22 @@ class ImageView(pg.PlotWidget):
         self.show()
 
         # keep image
-        self.imageData = image.data
-        self.imageShape = image.data.shape
+        self.imageData = None
+        self.imageShape = None
+        self.levels = None
 
         # limits to extract the spectrum
         self.chooseLimit = None
         self.lowerLimit = None
         self.upperLimit = None
+        self.apertures = []
 
         # plot image
         self.imageItem = None
         self.lowerLimitItem = None
         self.upperLimitItem = None
-        self.updatePlot()
+        if image.is_loaded:
+            self.setImage(image)
 
     def activateChooseLimitOnClick(self, menuAction):
         """Activate on click actions
@@ -117,6 +135,55 @@ class ImageView(pg.PlotWidget):
         else:
             super().mousePressEvent(event)
 
+    def releaseImage(self):
+        """Drop the references to the image data so that its memory can be
+        freed. Limits are kept. Call setImage to plot the image again"""
+        self.imageData = None
+        self.imageItem = None
+        self.levels = None
+        self.clear()
+
+    def restoreSessionState(self, state):
+        """Restore the state saved by sessionState
+
+        Arguments
+        ---------
+        state: dict
+        The saved state
+        """
+        self.lowerLimit = state.get("lower_limit")
+        self.upperLimit = state.get("upper_limit")
+        self.apertures = [
+            tuple(aperture) for aperture in state.get("apertures", [])]
+        if self.imageData is not None:
+            self.updatePlot()
+
+    def sessionState(self):
+        """Get the state to be stored in a session
+
+        Return
+        ------
+        state: dict
+        The extraction limits and apertures
+        """
+        return {
+            "lower_limit": self.lowerLimit,
+            "upper_limit": self.upperLimit,
+            "apertures": [list(aperture) for aperture in self.apertures],
+        }
+
+    def setApertures(self, apertures):
+        """Set the apertures and update plot accordingly
+
+        Arguments
+        ---------
+        apertures: list of (int, int)
+        Lower and upper limits of the apertures
+        """
+        self.apertures = list(apertures)
+        if self.imageData is not None:
+            self.updatePlot()
+
     def setImage(self, image):
         """Set image and update plot accordingly
 
@@ -127,6 +194,7 @@ class ImageView(pg.PlotWidget):
         """
         self.imageData = image.data
         self.imageShape = image.data.shape
+        self.levels = image.display_levels()
         self.updatePlot()
 
     def setPlot(self):
@@ -144,10 +212,22 @@ class ImageView(pg.PlotWidget):
         # load plot settings
         self.setPlot()
 
-        # plot image
-        self.imageItem = pg.ImageItem(self.imageData.transpose())
+        # plot image. Row-major order avoids transposing the data, and giving
+        # the levels avoids scanning the whole image for them
+        self.imageItem = pg.ImageItem(
+            self.imageData, axisOrder="row-major", levels=self.levels)
         self.addItem(self.imageItem)
 
+        # plot apertures
+        for lowerLimit, upperLimit in self.apertures:
+            apertureItem = pg.LinearRegionItem(
+                values=(lowerLimit, upperLimit),
+                orientation="horizontal",
+                brush=pg.mkBrush(255, 255, 0, 40),
+                pen=pg.mkPen("y"),
+                movable=False)
+            self.addItem(apertureItem)
+
         # plot lower limit if active
         if self.lowerLimit is not None:
             pen = pg.mkPen("r")
@@ -1,8 +1,37 @@
 """ Functions to load Actions"""
-from PyQt6.QtGui import QAction, QIcon
+from PyQt6.QtGui import QAction, QIcon, QKeySequence
 
 from pyspec.app.environment import BUTTONS_PATH
 
+def loadEditMenuActions(window):
+    """Load edit menu actions
+
+    Arguments
+    ---------
+    window: MainWindow
+    Window where the actions will act
+
+    Return
+    ------
+    menuAction: list of QAction
+    List of actions in the edit menu
+    """
+    menuActions = []
+
+    undo_option = QAction("&Undo", window)
+    undo_option.setStatusTip("Undo the last edit in the current tab")
+    undo_option.setShortcut(QKeySequence.StandardKey.Undo)
+    undo_option.triggered.connect(window.undo)
+    menuActions.append(undo_option)
+
+    redo_option = QAction("&Redo", window)
+    redo_option.setStatusTip("Redo the last undone edit in the current tab")
+    redo_option.setShortcut(QKeySequence.StandardKey.Redo)
+    redo_option.triggered.connect(window.redo)
+    menuActions.append(redo_option)
+
+    return menuActions
+
 def loadFileMenuActions(window):
     """Load file menu actions
 
@@ -26,6 +55,31 @@ def loadFileMenuActions(window):
     load_spectrum_option.triggered.connect(window.openFile)
     menuActions.append(load_spectrum_option)
 
+    open_session_option = QAction(
+        QIcon(f"{BUTTONS_PATH}/load_image.png"),
+        "&Open Session",
+        window)
+    open_session_option.setStatusTip("Open Session")
+    open_session_option.triggered.connect(window.openSession)
+    menuActions.append(open_session_option)
+
+    save_session_option = QAction(
+        QIcon(f"{BUTTONS_PATH}/save.png"),
+        "Save Sess&ion",
+        window)
+    save_session_option.setStatusTip("Save Session")
+    save_session_option.triggered.connect(window.saveSession)
+    menuActions.append(save_session_option)
+
+    save_all_spectra_option = QAction(
+        QIcon(f"{BUTTONS_PATH}/save.png"),
+        "Save &All Spectra",
+        window)
+    save_all_spectra_option.setStatusTip(
+        "Save all the opened spectra into a folder")
+    save_all_spectra_option.triggered.connect(window.saveAllSpectra)
+    menuActions.append(save_all_spectra_option)
+
     return menuActions
 
 def loadSpectralExtractionActions(window):
@@ -86,6 +140,66 @@ def loadSpectralExtractionActions(window):
     set_lower_limit_option.setEnabled(False)
     menuActions.append(set_lower_limit_option)
 
+    detect_apertures_option = QAction("&Detect Apertures", window)
+    detect_apertures_option.setStatusTip(
+        "Detect the apertures (traces) from the spatial profile")
+    detect_apertures_option.triggered.connect(window.detectApertures)
+    detect_apertures_option.setEnabled(False)
+    menuActions.append(detect_apertures_option)
+
+    extract_apertures_option = QAction("Extract &All Apertures", window)
+    extract_apertures_option.setStatusTip(
+        "Extract the spectra of all the apertures at once")
+    extract_apertures_option.triggered.connect(window.extractApertures)
+    extract_apertures_option.setEnabled(False)
+    menuActions.append(extract_apertures_option)
+
+    return menuActions
+
+def loadToolsMenuActions(window):
+    """Load tools menu actions
+
+    Arguments
+    ---------
+    window: MainWindow
+    Window where the actions will act
+
+    Return
+    ------
+    menuAction: list of QAction
+    List of actions in the tools menu
+    """
+    menuActions = []
+
+    show_timings_option = QAction("Show &Timings", window)
+    show_timings_option.setStatusTip(
+        "Measure the time spent in each stage and show it in the status bar")
+    show_timings_option.setCheckable(True)
+    show_timings_option.triggered.connect(window.showTimings)
+    menuActions.append(show_timings_option)
+
+    export_timings_option = QAction("&Export Timings", window)
+    export_timings_option.setStatusTip(
+        "Save the measured timings in the Chrome trace format")
+    export_timings_option.triggered.connect(window.exportTimings)
+    menuActions.append(export_timings_option)
+
+    watch_folder_option = QAction("&Watch Folder", window)
+    watch_folder_option.setStatusTip(
+        "Extract the spectra of the new frames in a folder with the settings "
+        "of the current image")
+    watch_folder_option.setCheckable(True)
+    watch_folder_option.triggered.connect(
+        lambda checked: window.watchFolder(checked, watch_folder_option))
+    menuActions.append(watch_folder_option)
+
+    show_residuals_option = window.residualDock.toggleViewAction()
+    show_residuals_option.setText("Show &Residuals")
+    show_residuals_option.setStatusTip(
+        "Show the residuals of the calibration points of the current "
+        "spectrum with respect to their fit")
+    menuActions.append(show_residuals_option)
+
     return menuActions
 
 def loadSpectrumActions(window):
@@ -133,6 +247,14 @@ def loadSpectrumActions(window):
     show_calibration_points.setEnabled(False)
     menuActions.append(show_calibration_points)
 
+    line_atlas = QAction("Line &Atlas", window)
+    line_atlas.setStatusTip(
+        "Show the lines of the atlas over the spectrum and suggest them when "
+        "adding calibration points")
+    line_atlas.triggered.connect(window.showLineAtlas)
+    line_atlas.setEnabled(False)
+    menuActions.append(line_atlas)
+
     compute_calibration = QAction(
         QIcon(f"{BUTTONS_PATH}/set_calib.png"),
         "&Set Calibration",
@@ -160,6 +282,14 @@ def loadSpectrumActions(window):
     load_calibration_option.setEnabled(False)
     menuActions.append(load_calibration_option)
 
+    track_arc_drift = QAction("Track Arc &Drift", window)
+    track_arc_drift.setStatusTip(
+        "Correct the current calibration for the drift of this arc with "
+        "respect to the arc of the calibration")
+    track_arc_drift.triggered.connect(window.trackArcDrift)
+    track_arc_drift.setEnabled(False)
+    menuActions.append(track_arc_drift)
+
     calibrate = QAction(
         QIcon(f"{BUTTONS_PATH}/calibrate.png"),
         "&Calibrate",
@@ -169,4 +299,18 @@ def loadSpectrumActions(window):
     calibrate.setEnabled(False)
     menuActions.append(calibrate)
 
+    calibrate_all = QAction("Calibrate &All Spectra", window)
+    calibrate_all.setStatusTip(
+        "Calibrate all the opened spectra with the current calibration")
+    calibrate_all.triggered.connect(window.calibrateAll)
+    calibrate_all.setEnabled(False)
+    menuActions.append(calibrate_all)
+
+    normalize_continuum = QAction("&Normalize by Continuum", window)
+    normalize_continuum.setStatusTip(
+        "Fit the continuum of the spectrum and divide the flux by it")
+    normalize_continuum.triggered.connect(window.normalizeContinuum)
+    normalize_continuum.setEnabled(False)
+    menuActions.append(normalize_continuum)
+
     return menuActions
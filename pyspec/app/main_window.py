@@ -1,60 +1,143 @@
 """pyspec main window"""
 import os
 
-from PyQt6.QtCore import QSize, Qt, pyqtSlot
+from PyQt6.QtCore import QSize, Qt, QTimer, pyqtSlot
 from PyQt6.QtWidgets import (
     QCheckBox,
+    QDockWidget,
     QFileDialog,
+    QInputDialog,
     QLabel,
     QMainWindow,
     QPushButton,
     QStatusBar,
+    QTabWidget,
     QToolBar,
     QMessageBox,
 )
 
-from pyspec.app.environment import WIDTH, HEIGHT, ICON_SIZE
+from pyspec.app.environment import (
+    WIDTH, HEIGHT, ICON_SIZE, TIMINGS_REFRESH_INTERVAL, WATCHER_POLL_INTERVAL,
+    WORKSPACE_MEMORY_BUDGET
+)
+from pyspec.app.continuum_dialog import ContinuumDialog
 from pyspec.app.error_dialog import ErrorDialog
-from pyspec.app.image_view import ImageView
 from pyspec.app.load_actions import (
+    loadEditMenuActions,
     loadFileMenuActions,
     loadSpectralExtractionActions,
-    loadSpectrumActions
+    loadSpectrumActions,
+    loadToolsMenuActions,
 )
 from pyspec.app.rotate_image_dialog import RotateImageDialog
-from pyspec.app.spectrum_view import SpectrumView
 from pyspec.app.success_dialog import SuccessDialog
 from pyspec.app.utils import getFileType
-from pyspec.errors import CalibrationError, ImageError, SpectrumError
+from pyspec import instrumentation
+from pyspec.errors import (
+    CalibrationError, ImageError, SessionError, SpectrumError
+)
 from pyspec.calibration import Calibration
+from pyspec.continuum import fit_continuum
+from pyspec.drift import measure_drift
+from pyspec.fits_utils import list_image_hdus
+from pyspec.frame_types import classify_data, classify_frame
 from pyspec.image import Image
-from pyspec.spectrum import Spectrum
+from pyspec.line_atlas import get_line_atlas
+from pyspec.session import load_session, save_session, SESSION_EXTENSION
+from pyspec.spectrum import Spectrum, save_spectra
+from pyspec.workspace import Workspace
 
 
 class MainWindow(QMainWindow):
     """Main Window
 
+    The plotting widgets (and with them pyqtgraph) are imported the first
+    time they are needed so that the window appears as fast as possible
+
+    Every opened Image or Spectrum is shown in its own tab. The opened items
+    are kept in a Workspace that releases the data of the least recently used
+    Images when the memory budget is exceeded.
+
     Methods
     -------
     (see QMainWindow)
     __init__
+    _activate
+    _addTab
+    _classifyImage
     _createToolBar
     _createMenuBar
     _createStatusBar
     _loadActions
+    _releaseViews
+    _pollWatcher
+    _selectImage
+    _setActionsEnabled
+    _stopWatcher
+    _updateResiduals
+    _updateTimings
+    closeEvent
 
     Attributes
     ----------
     (see QMainWindow)
 
+    calibrationArc: Spectrum or None
+    Arc of the current calibration: the arc it was set from or, after tracking
+    the drift, the tracked arc. The drift of other arcs is measured with
+    respect to it. None if the calibration was loaded
+
     centralWidget: QtWidget
     Central widget
 
-    image: Image
-    Opened image
+    frameTypes: dict
+    Frame type of the opened Images (see pyspec.frame_types). Keys are the
+    Images. Extracting the spectrum of an arc starts the wavelength
+    calibration, and that of a science frame applies the current calibration
+
+    image: Image or None
+    Image in the current tab
+
+    imageView: ImageView or None
+    Widget in the current tab if it shows an Image
 
     menuActions: list of QAction
     List of menu items. They are plotted in the menu and also in the toolbar
+
+    residualDock: QDockWidget
+    Panel with the residuals of the calibration points of the current
+    Spectrum. It is shown while setting calibration points
+
+    residualView: ResidualView or None
+    Widget of residualDock. Created the first time the panel is shown
+
+    spectrum: Spectrum or None
+    Spectrum in the current tab
+
+    spectrumView: SpectrumView or None
+    Widget in the current tab if it shows a Spectrum
+
+    tabWidget: QTabWidget
+    Widget containing one tab per opened item
+
+    timingsLabel: QLabel
+    Status bar label with the timing summary
+
+    timingsTimer: QTimer
+    Timer to refresh timingsLabel while the instrumentation is enabled
+
+    viewItems: dict
+    Opened items. Keys are the tab widgets and values the Image or Spectrum
+    they show
+
+    watcher: DirectoryWatcher or None
+    Reduces the frames written into the watched folder
+
+    watcherTimer: QTimer
+    Timer to collect the frames reduced by the watcher
+
+    workspace: Workspace
+    The opened Images and Spectra
     """
     def __init__(self):
         """Initialize class instance """
@@ -67,9 +150,18 @@ class MainWindow(QMainWindow):
         self.centralWidget.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.setCentralWidget(self.centralWidget)
 
+        self.residualDock = QDockWidget("Calibration Residuals", self)
+        self.residualDock.visibilityChanged.connect(self._updateResiduals)
+        self.addDockWidget(Qt.DockWidgetArea.BottomDockWidgetArea,
+                           self.residualDock)
+        self.residualDock.hide()
+        self.residualView = None
+
         self.extractSpectrumActions = loadSpectralExtractionActions(self)
+        self.editActions = loadEditMenuActions(self)
         self.fileActions = loadFileMenuActions(self)
         self.spectrumActions = loadSpectrumActions(self)
+        self.toolsActions = loadToolsMenuActions(self)
 
         self._createToolBar()
         self._createStatusBar()
@@ -80,6 +172,229 @@ class MainWindow(QMainWindow):
         self.spectrum = None
         self.spectrumView = None
         self.calibration = None
+        self.calibrationArc = None
+
+        self.workspace = Workspace(WORKSPACE_MEMORY_BUDGET)
+        self.viewItems = {}
+        self.frameTypes = {}
+        self.tabWidget = QTabWidget()
+        self.tabWidget.setTabsClosable(True)
+        self.tabWidget.setDocumentMode(True)
+        self.tabWidget.currentChanged.connect(self.changeTab)
+        self.tabWidget.tabCloseRequested.connect(self.closeTab)
+
+        self.watcher = None
+        self.watcherTimer = QTimer(self)
+        self.watcherTimer.setInterval(WATCHER_POLL_INTERVAL)
+        self.watcherTimer.timeout.connect(self._pollWatcher)
+
+    def _activate(self, item):
+        """Activate an item in the workspace
+
+        The plots of the Images released by the workspace are cleared
+
+        Arguments
+        ---------
+        item: Image or Spectrum
+        The item to activate
+
+        Return
+        ------
+        success: bool
+        True if the item was activated, False otherwise
+        """
+        try:
+            released = self.workspace.activate(item)
+        except ImageError as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when reading the image:\n" + str(error))
+            errorDialog.exec()
+            return False
+
+        self._releaseViews(released)
+
+        return True
+
+    def _addTab(self, item, view, title, setCurrent=True):
+        """Add an item to the workspace and show it in a new tab
+
+        Arguments
+        ---------
+        item: Image or Spectrum
+        The item to add
+
+        view: ImageView or SpectrumView
+        Widget showing the item
+
+        title: str
+        Tab title
+
+        setCurrent: bool - Default: True
+        If True, make the new tab the current one. Otherwise the item data is
+        not loaded until the tab is selected
+        """
+        if self.centralWidget is not self.tabWidget:
+            self.centralWidget = self.tabWidget
+            self.setCentralWidget(self.tabWidget)
+
+        self._releaseViews(self.workspace.add(item, activate=setCurrent))
+        self.viewItems[view] = item
+        if isinstance(item, Spectrum):
+            view.calibrationPointsChanged.connect(self._updateResiduals)
+        index = self.tabWidget.addTab(view, title)
+        self.tabWidget.setTabToolTip(index, title)
+        if setCurrent:
+            # this triggers changeTab
+            self.tabWidget.setCurrentIndex(index)
+
+    def _classifyImage(self, image):
+        """Get the frame type of an Image
+
+        The type is computed the first time and then kept in frameTypes
+
+        Arguments
+        ---------
+        image: Image
+        The image
+
+        Return
+        ------
+        frameType: str or None
+        One of pyspec.frame_types.FRAME_TYPES. None if the image cannot be
+        classified
+        """
+        if image not in self.frameTypes:
+            try:
+                if image.is_loaded:
+                    frameType, _ = classify_data(image.header, image.data)
+                else:
+                    frameType, _ = classify_frame(image.filename)
+            except ImageError:
+                frameType = None
+            self.frameTypes[image] = frameType
+        return self.frameTypes[image]
+
+    def _releaseViews(self, released):
+        """Clear the plots of the released Images
+
+        Arguments
+        ---------
+        released: list of Image
+        Images whose data was released by the workspace
+        """
+        for view, viewItem in self.viewItems.items():
+            if any(viewItem is releasedItem for releasedItem in released):
+                view.releaseImage()
+
+    def _pollWatcher(self):
+        """Queue the new frames of the watched folder and report the reduced
+        ones in the status bar"""
+        names = self.watcher.poll()
+        if len(names) > 0:
+            self.statusBar().showMessage(
+                f"Watch Folder: {len(self.watcher.names)} frames reduced, last "
+                f"saved to {names[-1]}")
+
+    def _stopWatcher(self):
+        """Stop the folder watcher without waiting for the queued frames
+
+        Return
+        ------
+        numDropped: int
+        Number of queued frames that were not reduced
+        """
+        self.watcherTimer.stop()
+        numDropped = self.watcher.terminate()
+        self.statusBar().showMessage(
+            f"Watch Folder: stopped after {len(self.watcher.names)} frames, "
+            f"{numDropped} queued frames not reduced")
+        self.watcher = None
+        return numDropped
+
+    def _selectImage(self, filename):
+        """Ask which image to open if a file has several of them
+
+        Files with several image extensions (that are not the amplifiers of a
+        mosaic) ask for the extension. Data cubes ask for the plane
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Return
+        ------
+        selection: dict or None
+        The "hdu" and "plane" arguments of Image. None if cancelled
+
+        Raise
+        -----
+        ImageError if the file cannot be read
+        """
+        hdus = list_image_hdus(filename)
+        selection = {"hdu": None, "plane": None}
+        if len(hdus) == 0 or hdus[0]["mosaic"]:
+            return selection
+
+        selected = hdus[0]
+        if len(hdus) > 1:
+            items = [
+                f"{hdu['index']}: {hdu['name']} {hdu['shape']}" for hdu in hdus]
+            item, accepted = QInputDialog.getItem(
+                self, "Select Extension", "Image extension:", items, 0, False)
+            if not accepted:
+                return None
+            selected = hdus[items.index(item)]
+            selection["hdu"] = selected["index"]
+
+        if len(selected["shape"]) == 3 and selected["shape"][0] > 1:
+            plane, accepted = QInputDialog.getInt(
+                self, "Select Plane", "Cube plane:", 0, 0,
+                selected["shape"][0] - 1)
+            if not accepted:
+                return None
+            selection["plane"] = plane
+
+        return selection
+
+    def _updateResiduals(self):
+        """Plot the residuals of the calibration points of the current
+        Spectrum, if the residual panel is visible"""
+        if not self.residualDock.isVisible():
+            return
+        if self.residualView is None:
+            # pylint: disable-next=import-outside-toplevel
+            from pyspec.app.residual_view import ResidualView
+            self.residualView = ResidualView()
+            self.residualDock.setWidget(self.residualView)
+        if self.spectrumView is None:
+            self.residualView.setResiduals(None)
+        else:
+            self.residualView.setResiduals(
+                self.spectrumView.calibrationResiduals)
+
+    def _updateTimings(self):
+        """Show the per-stage timing summary in the status bar"""
+        self.timingsLabel.setText(instrumentation.format_summary(" | "))
+
+    @staticmethod
+    def _setActionsEnabled(menuActions, enabled):
+        """Enable or disable a list of actions
+
+        Checkable actions are also unchecked
+
+        Arguments
+        ---------
+        menuActions: list of QAction
+        The actions
+
+        enabled: bool
+        True to enable the actions, False to disable them
+        """
+        for menuAction in menuActions:
+            menuAction.setEnabled(enabled)
+            if menuAction.isCheckable():
+                menuAction.setChecked(False)
 
     def _createToolBar(self):
         """Create tool bars"""
@@ -113,6 +428,10 @@ class MainWindow(QMainWindow):
             fileMenu.addAction(menuAction)
             fileMenu.addSeparator()
 
+        editMenu = menu.addMenu("&Edit")
+        for menuAction in self.editActions:
+            editMenu.addAction(menuAction)
+
         extractSpectrumMenu = menu.addMenu("&Extract Spectrum")
         for menuAction in self.extractSpectrumActions:
             extractSpectrumMenu.addAction(menuAction)
@@ -123,10 +442,24 @@ class MainWindow(QMainWindow):
             spectrumMenu.addAction(menuAction)
             spectrumMenu.addSeparator()
 
+        toolsMenu = menu.addMenu("&Tools")
+        for menuAction in self.toolsActions:
+            toolsMenu.addAction(menuAction)
+
     def _createStatusBar(self):
-        """Create status bar"""
+        """Create status bar
+
+        The status bar has a permanent label to show the timing summary (see
+        showTimings)
+        """
         self.setStatusBar(QStatusBar(self))
 
+        self.timingsLabel = QLabel("")
+        self.statusBar().addPermanentWidget(self.timingsLabel)
+        self.timingsTimer = QTimer(self)
+        self.timingsTimer.setInterval(TIMINGS_REFRESH_INTERVAL)
+        self.timingsTimer.timeout.connect(self._updateTimings)
+
     def activateChooseLimitOnClick(self, checked, sender):
         """Activate/deactivate choose limits on click.
 
@@ -183,6 +516,7 @@ class MainWindow(QMainWindow):
 
             # activate set limit on clicking
             message = self.spectrumView.activateSetCalibrationPoints()
+            self.residualDock.show()
 
         else:
             # de activate set limit on clicking
@@ -201,6 +535,104 @@ class MainWindow(QMainWindow):
         successDialog = SuccessDialog("Calibration success")
         successDialog.exec()
 
+    def calibrateAll(self):
+        """Calibrate all the opened spectra with the current calibration
+
+        The wavelength array is computed once per spectrum size and shared by
+        the spectra
+        """
+        if self.calibration is None:
+            errorDialog = ErrorDialog("Set calibration before calibrating")
+            errorDialog.exec()
+            return
+
+        spectra = [
+            item for item in self.workspace if isinstance(item, Spectrum)]
+        wavelengths = {}
+        for spectrum in spectra:
+            size = spectrum.flux.size
+            if size not in wavelengths:
+                wavelengths[size] = self.calibration.calibrate(size)
+            spectrum.wavelength = wavelengths[size]
+        for view, item in self.viewItems.items():
+            if isinstance(item, Spectrum):
+                view.calibrated = True
+                view.setSpectrum(item)
+
+        self.statusBar().showMessage(f"{len(spectra)} spectra calibrated")
+
+    @pyqtSlot(int)
+    def changeTab(self, index):
+        """Make the item in the selected tab the current one
+
+        Arguments
+        ---------
+        index: int
+        Index of the selected tab. -1 if there are no tabs
+        """
+        # stop the on click actions of the previous views
+        if self.imageView is not None:
+            self.imageView.deactivateChooseLimitOnClick()
+        if self.spectrumView is not None:
+            self.spectrumView.deactivateSetCalibrationPoints()
+
+        self.image = None
+        self.imageView = None
+        self.spectrum = None
+        self.spectrumView = None
+        self._setActionsEnabled(self.extractSpectrumActions, False)
+        self._setActionsEnabled(self.spectrumActions, False)
+        self._updateResiduals()
+
+        if index == -1:
+            return
+
+        view = self.tabWidget.widget(index)
+        item = self.viewItems[view]
+        if not self._activate(item):
+            return
+
+        if isinstance(item, Image):
+            self.image = item
+            self.imageView = view
+            if view.imageData is None:
+                view.setImage(item)
+            self._setActionsEnabled(self.extractSpectrumActions, True)
+        else:
+            self.spectrum = item
+            self.spectrumView = view
+            view.setReferenceCalibration(self.calibration)
+            self._setActionsEnabled(self.spectrumActions, True)
+            self._updateResiduals()
+
+    def closeEvent(self, event):
+        """Stop the folder watcher before closing the window
+
+        Arguments
+        ---------
+        event: QCloseEvent
+        The close event
+        """
+        if self.watcher is not None:
+            self._stopWatcher()
+        super().closeEvent(event)
+
+    @pyqtSlot(int)
+    def closeTab(self, index):
+        """Close a tab and remove its item from the workspace
+
+        Arguments
+        ---------
+        index: int
+        Index of the tab to close
+        """
+        view = self.tabWidget.widget(index)
+        item = self.viewItems.pop(view)
+        self.frameTypes.pop(item, None)
+        self.workspace.remove(item)
+        self.tabWidget.removeTab(index)
+        view.deleteLater()
+
     @pyqtSlot()
     def extractSpectrum(self):
         """Extract the spectrum"""
@@ -227,24 +659,85 @@ class MainWindow(QMainWindow):
             return
 
         # load spectrum
-        self.spectrum = Spectrum.from_image(self.image, lowerLimit, upperLimit)
+        spectrum = Spectrum.from_image(self.image, lowerLimit, upperLimit)
+        frameType = self._classifyImage(self.image)
+
+        # plot spectrum in a new tab, the image stays open in its own tab
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.spectrum_view import SpectrumView
+        self._addTab(
+            spectrum, SpectrumView(spectrum), os.path.basename(spectrum.name))
+
+        # route the spectrum to the next stage
+        if frameType == "arc":
+            # the only checkable action is Set Calibration Points
+            setCalibrationAction = next(
+                menuAction for menuAction in self.spectrumActions
+                if menuAction.isCheckable())
+            setCalibrationAction.trigger()
+        elif frameType == "science" and self.calibration is not None:
+            spectrum.wavelength = self.calibration.calibrate(
+                spectrum.flux.size)
+            self.spectrumView.calibrated = True
+            self.spectrumView.setSpectrum(spectrum)
+            self.statusBar().showMessage(
+                "Science frame: spectrum calibrated with the current "
+                "calibration")
+        elif frameType in ("bias", "dark", "flat"):
+            self.statusBar().showMessage(
+                f"Warning: the spectrum was extracted from a {frameType} frame")
 
-        # disable extract spectrum options
-        for menuAction in self.extractSpectrumActions:
-            menuAction.setEnabled(False)
-            if menuAction.isCheckable():
-                menuAction.setChecked(False)
+    @pyqtSlot()
+    def detectApertures(self):
+        """Detect the apertures of the current image"""
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.apertures import find_apertures
+        apertures = find_apertures(self.image.data)
+        self.imageView.setApertures(apertures)
+        self.statusBar().showMessage(f"{len(apertures)} apertures detected")
 
-        # enable spectrum options
-        for menuAction in self.spectrumActions:
-            menuAction.setEnabled(True)
+    @pyqtSlot()
+    def extractApertures(self):
+        """Extract the spectra of all the apertures of the current image
 
-        # plot spectrum
-        self.spectrumView = SpectrumView(self.spectrum)
-        self.setCentralWidget(self.spectrumView)
+        Each spectrum is shown in a new tab
+        """
+        if len(self.imageView.apertures) == 0:
+            errorDialog = ErrorDialog(
+                "Extraction error: No apertures. Detect them first")
+            errorDialog.exec()
+            return
 
-        # close image
-        self.imageView.close()
+        try:
+            spectra = Spectrum.from_apertures(
+                self.image, self.imageView.apertures)
+        except SpectrumError as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when extracting the apertures:\n" +
+                str(error))
+            errorDialog.exec()
+            return
+
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.spectrum_view import SpectrumView
+        for spectrum in spectra:
+            self._addTab(
+                spectrum, SpectrumView(spectrum), os.path.basename(spectrum.name),
+                setCurrent=False)
+        self.statusBar().showMessage(f"{len(spectra)} spectra extracted")
+
+    @pyqtSlot()
+    def exportTimings(self):
+        """Save the measured timings in the Chrome trace format"""
+        filename, _ = QFileDialog.getSaveFileName(
+            self,
+            "Export Timings",
+            "pyspec_trace.json",
+            "JSON (*json);; All (*)")
+
+        if filename == "":
+            return
+        instrumentation.export_chrome_trace(filename)
 
     @pyqtSlot()
     def loadCalibration(self):
@@ -258,10 +751,53 @@ class MainWindow(QMainWindow):
 
         try:
             self.calibration = Calibration.from_file(filename)
+            self.calibrationArc = None
         except CalibrationError as error:
             errorDialog = ErrorDialog(
                 "An error occurred when loading the calibration:\n" + str(error))
             errorDialog.exec()
+        self.spectrumView.setReferenceCalibration(self.calibration)
+
+    @pyqtSlot()
+    def normalizeContinuum(self):
+        """Fit the continuum of the spectrum and divide the flux by it
+
+        The continuum is shown over the spectrum and updated while the fit
+        parameters are edited
+        """
+        if self.spectrumView is None:
+            return
+
+        def previewContinuum():
+            try:
+                continuum, _ = fit_continuum(
+                    self.spectrum.flux, self.spectrum.wavelength,
+                    **continuumDialog.parameters())
+            except (SpectrumError, ValueError) as error:
+                self.statusBar().showMessage(
+                    f"Cannot fit the continuum: {str(error)}")
+                self.spectrumView.setContinuum(None)
+                return
+            self.statusBar().clearMessage()
+            self.spectrumView.setContinuum(continuum)
+
+        continuumDialog = ContinuumDialog(self.spectrum.wavelength is not None)
+        continuumDialog.parametersChanged.connect(previewContinuum)
+        previewContinuum()
+        accepted = continuumDialog.exec()
+        self.spectrumView.setContinuum(None)
+        if not accepted:
+            return
+
+        try:
+            self.spectrum.normalize(**continuumDialog.parameters())
+        except (SpectrumError, ValueError) as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when fitting the continuum:\n" + str(error))
+            errorDialog.exec()
+            return
+        self.spectrumView.setSpectrum(self.spectrum)
+        self.statusBar().showMessage("Spectrum normalized")
 
     @pyqtSlot()
     def openFile(self):
@@ -285,15 +821,19 @@ class MainWindow(QMainWindow):
         elif file_type == "Image":
             try:
                 # load image
-                self.image = Image(filename)
+                selection = self._selectImage(filename)
+                if selection is None:
+                    return
+                image = Image(filename, **selection)
+                frameType = self._classifyImage(image)
 
                 # plot image
-                self.imageView = ImageView(self.image)
-                self.setCentralWidget(self.imageView)
-
-                # enable extract spectrum options
-                for action in self.extractSpectrumActions:
-                    action.setEnabled(True)
+                # pylint: disable-next=import-outside-toplevel
+                from pyspec.app.image_view import ImageView
+                title = os.path.basename(filename)
+                if frameType is not None:
+                    title += f" [{frameType}]"
+                self._addTab(image, ImageView(image), title)
 
             except ImageError as error:
                 errorDialog = ErrorDialog(
@@ -304,21 +844,74 @@ class MainWindow(QMainWindow):
         elif file_type == "Spectrum":
             try:
                 # load spectrum
-                self.spectrum = Spectrum.from_file(filename)
+                spectrum = Spectrum.from_file(filename)
 
                 # plot spectrum
-                self.spectrumView = SpectrumView(self.spectrum)
-                self.setCentralWidget(self.spectrumView)
-
-                # enable spectrum options
-                for menuAction in self.spectrumActions:
-                    menuAction.setEnabled(True)
+                # pylint: disable-next=import-outside-toplevel
+                from pyspec.app.spectrum_view import SpectrumView
+                self._addTab(
+                    spectrum, SpectrumView(spectrum), os.path.basename(filename))
 
             except SpectrumError as error:
                 errorDialog = ErrorDialog(
                     "An error occurred when opening a spectrum:\n" + str(error))
                 errorDialog.exec()
 
+    def redo(self):
+        """Redo the last undone edit in the current tab"""
+        if self.image is not None and self.image.history.can_redo:
+            self.image.redo()
+            self._activate(self.image)
+            self.imageView.setImage(self.image)
+        elif (self.spectrumView is not None
+              and self.spectrumView.calibrationHistory.can_redo):
+            self.spectrumView.redo()
+        else:
+            self.statusBar().showMessage("Nothing to redo")
+
+    @pyqtSlot()
+    def openSession(self):
+        """Open dialog to select and restore a session"""
+        filename, _ = QFileDialog.getOpenFileName(
+            self,
+            "Open Session",
+            "${HOME}",
+            f"Sessions (*{SESSION_EXTENSION});; All files (*)",
+        )
+        if filename == "":
+            return
+
+        try:
+            items, calibration = load_session(filename)
+        except (SessionError, SpectrumError) as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when opening the session:\n" + str(error))
+            errorDialog.exec()
+            return
+
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.image_view import ImageView
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.app.spectrum_view import SpectrumView
+
+        firstIndex = self.tabWidget.count()
+        for item, state in items:
+            if isinstance(item, Image):
+                view = ImageView(item)
+                title = os.path.basename(item.filename)
+            else:
+                view = SpectrumView(item)
+                title = os.path.basename(item.name)
+            view.restoreSessionState(state)
+            self._addTab(item, view, title, setCurrent=False)
+
+        if calibration is not None:
+            self.calibration = calibration
+            self.calibrationArc = None
+        if len(items) > 0:
+            self.tabWidget.setCurrentIndex(firstIndex)
+            self.changeTab(firstIndex)
+
     def rotateImage(self):
         """ Rotate image.
 
@@ -333,6 +926,8 @@ class MainWindow(QMainWindow):
                 errorDialog = ErrorDialog(
                     "An error occurred when rotating the image:\n" + str(error))
                 errorDialog.exec()
+            # the rotated data might push the workspace over its memory budget
+            self._activate(self.image)
             self.imageView.setImage(self.image)
 
     def saveCalibration(self):
@@ -358,6 +953,47 @@ class MainWindow(QMainWindow):
                 "An error occurred when saving the calibration:\n" + str(error))
             errorDialog.exec()
 
+    def saveSession(self):
+        """Save the opened items and their state in a session file"""
+        filename, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save Session",
+            f"session{SESSION_EXTENSION}",
+            f"Sessions (*{SESSION_EXTENSION})")
+
+        if filename == "":
+            return
+        items = []
+        for index in range(self.tabWidget.count()):
+            view = self.tabWidget.widget(index)
+            items.append((self.viewItems[view], view.sessionState()))
+        try:
+            save_session(filename, items, self.calibration)
+        except SessionError as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when saving the session:\n" + str(error))
+            errorDialog.exec()
+
+    def saveAllSpectra(self):
+        """Save all the opened spectra into a folder"""
+        spectra = [
+            item for item in self.workspace if isinstance(item, Spectrum)]
+        if len(spectra) == 0:
+            self.statusBar().showMessage("No spectra to save")
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, "Save All Spectra")
+        if directory == "":
+            return
+        try:
+            names = save_spectra(spectra, directory)
+        except SpectrumError as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when saving the spectra:\n" + str(error))
+            errorDialog.exec()
+            return
+        self.statusBar().showMessage(f"{len(names)} spectra saved")
+
     def saveSpectrum(self):
         """ Save spectrum"""
         filename, _ = QFileDialog.getSaveFileName(
@@ -386,6 +1022,8 @@ class MainWindow(QMainWindow):
         try:
             self.calibration = Calibration.from_points(
                 self.spectrumView.calibrationPoints)
+            self.calibrationArc = self.spectrum
+            self.spectrumView.setReferenceCalibration(self.calibration)
             successDialog = SuccessDialog("Calibration is set")
             successDialog.exec()
         except CalibrationError as error:
@@ -393,6 +1031,156 @@ class MainWindow(QMainWindow):
                 "An error occurred whe setting the calibration:\n" + str(error))
             errorDialog.exec()
 
+    def showLineAtlas(self):
+        """Choose the atlas lines shown over the spectrum"""
+        atlas = get_line_atlas()
+        items = ["None", "All"] + atlas.elements
+        item, accepted = QInputDialog.getItem(
+            self, "Line Atlas", "Elements (separated by commas):", items, 0,
+            True)
+        if not accepted:
+            return
+
+        if item == "None":
+            self.spectrumView.setAtlas(None)
+        elif item == "All":
+            self.spectrumView.setAtlas(atlas)
+        else:
+            elements = [element.strip() for element in item.split(",")]
+            unknown = [
+                element for element in elements
+                if element not in atlas.elements
+            ]
+            if len(unknown) > 0:
+                errorDialog = ErrorDialog(
+                    "The atlas has no lines of " + ", ".join(unknown) +
+                    ". Available elements are " + ", ".join(atlas.elements))
+                errorDialog.exec()
+                return
+            self.spectrumView.setAtlas(atlas.select(elements))
+        self.statusBar().showMessage(f"Line atlas: {item}")
+
+    @pyqtSlot(bool)
+    def showTimings(self, checked):
+        """Enable/disable the timing instrumentation
+
+        When enabled, the per-stage timing summary is shown in the status bar
+
+        Arguments
+        ---------
+        checked: bool
+        True to enable the instrumentation, False to disable it
+        """
+        if checked:
+            instrumentation.reset()
+            instrumentation.enable()
+            self.timingsTimer.start()
+        else:
+            instrumentation.disable()
+            self.timingsTimer.stop()
+            self.timingsLabel.setText("")
+
+    def watchFolder(self, checked, sender):
+        """Start/stop reducing the frames written into a folder
+
+        The frames are reduced with the rotation and the extraction limits of
+        the current image and the current calibration. Bias, dark and flat
+        frames are skipped (see pyspec.frame_types). The spectra are saved
+        next to the frames
+
+        Arguments
+        ---------
+        checked: bool
+        True to start watching a folder, False to stop
+
+        sender: QAction
+        The action that triggered the call
+        """
+        if not checked:
+            self._stopWatcher()
+            return
+
+        if (self.image is None or self.imageView.lowerLimit is None
+                or self.imageView.upperLimit is None
+                or self.imageView.lowerLimit >= self.imageView.upperLimit):
+            errorDialog = ErrorDialog(
+                "Watch Folder error: Open an image and set its extraction "
+                "limits first")
+            errorDialog.exec()
+            sender.setChecked(False)
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, "Watch Folder")
+        if directory == "":
+            sender.setChecked(False)
+            return
+
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.watcher import DirectoryWatcher
+        self.watcher = DirectoryWatcher(
+            directory,
+            self.image.rotation_angle,
+            self.imageView.lowerLimit,
+            self.imageView.upperLimit,
+            calibration=self.calibration,
+            num_processors=max(os.cpu_count() // 2, 1),
+            route=True)
+        self.watcherTimer.start()
+        self.statusBar().showMessage(f"Watch Folder: watching {directory}")
+
+    def trackArcDrift(self):
+        """Correct the current calibration for the drift of the current arc
+
+        The drift is measured by cross-correlation with the arc of the
+        calibration (see pyspec.drift). The corrected calibration becomes the
+        calibration of the current arc, so that tracking again, or tracking
+        another arc, starts from a calibration and an arc that match. The
+        corrected calibration points are moved to the peaks of the current arc,
+        so that they can be refined before setting the calibration of the arc
+        """
+        if self.calibration is None or self.calibrationArc is None:
+            errorDialog = ErrorDialog(
+                "Set the calibration from the points of an arc before "
+                "tracking the drift")
+            errorDialog.exec()
+            return
+
+        try:
+            offset, stretch = measure_drift(
+                self.calibrationArc.flux, self.spectrum.flux, stretch=True)
+            calibration = self.calibration.corrected(offset, stretch)
+        except CalibrationError as error:
+            errorDialog = ErrorDialog(
+                "An error occurred when tracking the drift:\n" + str(error))
+            errorDialog.exec()
+            return
+        self.calibration = calibration
+        self.calibrationArc = self.spectrum
+
+        calibrationPoints = {}
+        for xPos, wavelength in self.calibration.calibration_points[
+                ["x", "wave"]].tolist():
+            if 0 <= xPos < self.spectrum.flux.size:
+                calibrationPoints[self.spectrum.find_local_max(
+                    int(round(xPos)))] = wavelength
+        self.spectrumView.setReferenceCalibration(self.calibration)
+        self.spectrumView.replaceCalibrationPoints(calibrationPoints)
+        self.statusBar().showMessage(
+            f"Arc drift: offset {offset:+.2f} pixels, stretch {stretch:.5f}. "
+            "Check the calibration points and set the calibration")
+
+    def undo(self):
+        """Undo the last edit in the current tab"""
+        if self.image is not None and self.image.history.can_undo:
+            self.image.undo()
+            self._activate(self.image)
+            self.imageView.setImage(self.image)
+        elif (self.spectrumView is not None
+              and self.spectrumView.calibrationHistory.can_undo):
+            self.spectrumView.undo()
+        else:
+            self.statusBar().showMessage("Nothing to undo")
+
     def showCalibrationPoints(self):
         """ Show current calibration points
 
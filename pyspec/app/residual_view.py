@@ -0,0 +1,61 @@
+"""Define ResidualView widget as an extension of pg.PlotWidget"""
+import numpy as np
+
+import pyqtgraph as pg
+
+from pyspec.calibration import OUTLIER_THRESHOLD
+
+class ResidualView(pg.PlotWidget):
+    """ Plot the residuals of the calibration points with respect to their fit
+
+    Methods
+    -------
+    (see pg.PlotWidget)
+    __init__
+    setResiduals
+
+    Attributes
+    ----------
+    (see pg.PlotWidget)
+
+    residuals: np.ndarray or None
+    The plotted residuals (see IncrementalFit.solve). None if there is no
+    spectrum
+    """
+    def __init__(self):
+        """Initialize instance"""
+        super().__init__()
+        self.setLabel(axis="left", text="Residual [Angs]")
+        self.setLabel(axis="bottom", text="X-pixel")
+        self.residuals = None
+        self.setResiduals(None)
+
+    def setResiduals(self, residuals):
+        """Plot new residuals
+
+        Arguments
+        ---------
+        residuals: np.ndarray or None
+        The residuals (see IncrementalFit.solve). None to clear the plot
+        """
+        self.residuals = residuals
+        self.clear()
+        if residuals is None or residuals.size < 2:
+            self.setTitle("Add calibration points to see their residuals")
+            return
+
+        self.addItem(pg.InfiniteLine(pos=0, angle=0, pen=pg.mkPen("w")))
+        outlier = residuals["outlier"]
+        self.addItem(pg.ScatterPlotItem(
+            residuals["x"][~outlier], residuals["residual"][~outlier],
+            size=10, brush=pg.mkBrush(255, 255, 255, 120)))
+        if np.any(outlier):
+            self.addItem(pg.ScatterPlotItem(
+                residuals["x"][outlier], residuals["residual"][outlier],
+                size=12, brush=pg.mkBrush(255, 0, 0, 200)))
+
+        rms = np.sqrt(np.mean(residuals["residual"][~outlier]**2))
+        self.setTitle(
+            f"{residuals.size} points, rms {rms:.3f} Angs, "
+            f"{np.sum(outlier)} outliers (more than {OUTLIER_THRESHOLD:g} "
+            "pixels away)")
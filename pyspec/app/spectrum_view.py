@@ -1,13 +1,23 @@
 """Define SpectrumView widget as an extension of pg.PlotWidget"""
+import logging
+
 import numpy as np
 
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, pyqtSignal
 from PyQt6.QtGui import QPen
 import pyqtgraph as pg
 
 from pyspec.app.add_calibration_point_dialog import AddCalibrationPointDialog
 from pyspec.app.calibration_point_list_dialog import CalibrationPointListDialog
 from pyspec.app.error_dialog import ErrorDialog
+from pyspec.calibration import IncrementalFit, MIN_CALIBRATION_POINTS
+from pyspec.history import History
+from pyspec.line_atlas import get_line_atlas
+
+logger = logging.getLogger(__name__)
+
+# atlas lines are labelled only when there are few of them in view
+MAX_LABELLED_LINES = 40
 
 class SpectrumView(pg.PlotWidget):
     """ Manage spectrum plotting
@@ -18,10 +28,27 @@ class SpectrumView(pg.PlotWidget):
     __init__
     activateSetCalibrationPoints
     addCalibrationPoint
+    candidateLines
     deactivateSetCalibrationPoints
     mousePressEvent
+    redo
+    replaceCalibrationPoints
+    restoreSessionState
+    sessionState
+    setAtlas
+    setContinuum
     setPlot
+    setReferenceCalibration
+    undo
     updatePlot
+    _updateAtlasLines
+    _updateCalibrationPoints
+    _waveSolution
+
+    Signals
+    -------
+    calibrationPointsChanged
+    Emitted after the calibration points and their fit are updated
 
     Attributes
     ----------
@@ -33,13 +60,55 @@ class SpectrumView(pg.PlotWidget):
     spectrumItem: pg.PlotCurveItem
     Plot item for the spectrum
 
+    continuum: array of float or None
+    Continuum shown over the spectrum. None to hide it
+
+    continuumItem: pg.PlotCurveItem or None
+    Plot item for the continuum
+
+    calibrationHistory: History
+    The edits of the calibration points. calibrationPoints is recomputed from
+    them
+
     calibrationPoints: dict
     Dictionary with the calibration points. Keys are the position in pixels and
     values are the wavelengths
 
     calibrationPointsItem: pg.ScatterPlotItem
-    Plot item for calibrationPoints
+    Plot item for calibrationPoints. Outliers are shown in red
+
+    calibrationFit: IncrementalFit
+    Fit of the wavelength solution to calibrationPoints, updated after every
+    edit
+
+    calibrationResiduals: np.ndarray
+    Residuals of calibrationPoints with respect to their fit (see
+    IncrementalFit.solve)
+
+    calibrationSolution: np.Polynomial or None
+    The solution fitted to calibrationPoints, without the outliers. None if
+    there are less than two points
+
+    atlas: LineAtlas or None
+    Atlas of the lines shown over the spectrum. None to hide them
+
+    atlasItem: pg.PlotCurveItem or None
+    Plot item for the atlas lines in the visible range
+
+    atlasLabels: list of pg.TextItem
+    Labels of the atlas lines in the visible range
+
+    referenceCalibration: Calibration or None
+    Current calibration. Used to place the atlas lines and suggest the
+    wavelength of new calibration points until there are enough points to fit
+    a solution
+
+    waveSolution: array of float or None
+    Wavelength of each pixel under the current or provisional wavelength
+    solution. None if there is no solution
     """
+    calibrationPointsChanged = pyqtSignal()
+
     def __init__(self, spectrum):
         """Initialize instance
 
@@ -56,9 +125,26 @@ class SpectrumView(pg.PlotWidget):
         self.spectrum = spectrum
 
         # calibration points
+        self.calibrationHistory = History()
         self.calibrationPoints = {}
         self.calibrationPointsItem = None
+        self.calibrationFit = IncrementalFit(spectrum.flux.size)
+        self.calibrationSolution, self.calibrationResiduals = (
+            self.calibrationFit.solve())
         self.calibrated = False
+        self.referenceCalibration = None
+        self.waveSolution = None
+
+        # line atlas overlay, updated when the visible range changes
+        self.atlas = None
+        self.atlasItem = None
+        self.atlasLabels = []
+        self.fluxRange = (0, 1)
+        self.getViewBox().sigXRangeChanged.connect(self._updateAtlasLines)
+
+        # continuum overlay
+        self.continuum = None
+        self.continuumItem = None
 
         # mouse control
         self.setCalibrationPoints = False
@@ -90,7 +176,19 @@ class SpectrumView(pg.PlotWidget):
         """Add calibration point"""
         xPos = self.spectrum.find_local_max(int(viewPos.x()))
 
-        addCalibrationPointDialog = AddCalibrationPointDialog(xPos)
+        if self.waveSolution is None:
+            addCalibrationPointDialog = AddCalibrationPointDialog(xPos)
+        else:
+            wavelength = self.waveSolution[xPos]
+            atlas = get_line_atlas() if self.atlas is None else self.atlas
+            addCalibrationPointDialog = AddCalibrationPointDialog(
+                xPos,
+                wavelength=round(float(wavelength), 2),
+                candidates=[
+                    (f"{atlas.label(line)} ({line['wave'] - wavelength:+.2f})",
+                     float(line["wave"]))
+                    for line in self.candidateLines(xPos)
+                ])
 
         if addCalibrationPointDialog.exec():
             try:
@@ -108,11 +206,33 @@ class SpectrumView(pg.PlotWidget):
                 errorDialog.exec()
                 return
 
-            self.calibrationPoints[xPos] = wavelength
-            print(xPos, wavelength)
+            self.calibrationHistory.push(("add", xPos, wavelength))
+            self._updateCalibrationPoints()
+            logger.debug("Added calibration point x=%d, wavelength=%g", xPos,
+                         wavelength)
 
             self.updatePlot()
 
+    def candidateLines(self, xPos):
+        """Find the atlas lines nearest to a peak
+
+        Arguments
+        ---------
+        xPos: int
+        Position of the peak in pixels
+
+        Return
+        ------
+        lines: np.ndarray
+        The nearest lines of atlas (or of the bundled atlas if atlas is None)
+        to the wavelength of the peak under the current or provisional
+        wavelength solution, sorted by distance. Empty if there is no solution
+        """
+        atlas = get_line_atlas() if self.atlas is None else self.atlas
+        if self.waveSolution is None:
+            return atlas.lines[:0]
+        return atlas.nearest(self.waveSolution[xPos])
+
     def deactivateSetCalibrationPoints(self):
         """Deactivate on click actions to set calibration points
 
@@ -153,6 +273,28 @@ class SpectrumView(pg.PlotWidget):
         else:
             self.setLabel(axis='bottom', text='Wavelength [Angs]')
 
+    def setAtlas(self, atlas):
+        """Show the lines of an atlas over the spectrum
+
+        Arguments
+        ---------
+        atlas: LineAtlas or None
+        The atlas. None to hide the lines
+        """
+        self.atlas = atlas
+        self.updatePlot()
+
+    def setContinuum(self, continuum):
+        """Show a continuum over the spectrum
+
+        Arguments
+        ---------
+        continuum: array of float or None
+        The continuum, with the same size as the spectrum. None to hide it
+        """
+        self.continuum = continuum
+        self.updatePlot()
+
     def setSpectrum(self, spectrum):
         """Set spectrum and update plot accordingly
 
@@ -162,19 +304,191 @@ class SpectrumView(pg.PlotWidget):
         The new image
         """
         self.spectrum = spectrum
+        if spectrum.flux.size != self.calibrationFit.size:
+            self.calibrationFit = IncrementalFit(spectrum.flux.size)
+            self._updateCalibrationPoints()
+        self.updatePlot()
+
+    def setReferenceCalibration(self, calibration):
+        """Set the current calibration
+
+        Arguments
+        ---------
+        calibration: Calibration or None
+        The calibration
+        """
+        if calibration is self.referenceCalibration:
+            return
+        self.referenceCalibration = calibration
         self.updatePlot()
 
     def showCalibrationPoints(self):
         """Show current calibration points. Optionally modify them"""
         calibrationPointListDialog = CalibrationPointListDialog(
-            self.calibrationPoints)
+            self.calibrationPoints, size=self.spectrum.flux.size)
         if calibrationPointListDialog.exec():
-            self.calibrationPoints = {
+            calibrationPoints = {
                 item[0]: item[1]
                 for item in calibrationPointListDialog.calibrationPoints
                 if not item[2]
             }
-            self.updatePlot()
+            if calibrationPoints != self.calibrationPoints:
+                self.replaceCalibrationPoints(calibrationPoints)
+            else:
+                self.updatePlot()
+
+    def redo(self):
+        """Redo the last undone edit of the calibration points
+
+        Raise
+        -----
+        HistoryError if there is nothing to redo
+        """
+        self.calibrationHistory.redo()
+        self._updateCalibrationPoints()
+        self.updatePlot()
+
+    def replaceCalibrationPoints(self, calibrationPoints):
+        """Replace all the calibration points. The replacement can be undone
+
+        Arguments
+        ---------
+        calibrationPoints: dict
+        The new calibration points. Keys are the position in pixels and values
+        are the wavelengths
+        """
+        self.calibrationHistory.push(
+            ("set", tuple(sorted(calibrationPoints.items()))))
+        self._updateCalibrationPoints()
+        self.updatePlot()
+
+    def restoreSessionState(self, state):
+        """Restore the state saved by sessionState
+
+        Arguments
+        ---------
+        state: dict
+        The saved state
+        """
+        self.calibrationHistory.clear()
+        if len(state.get("calibration_points", [])) > 0:
+            self.calibrationHistory.push(
+                ("set", tuple(
+                    (int(xPos), float(wavelength))
+                    for xPos, wavelength in state["calibration_points"])))
+        self._updateCalibrationPoints()
+        self.calibrated = state.get("calibrated", False)
+        self.updatePlot()
+
+    def sessionState(self):
+        """Get the state to be stored in a session
+
+        Return
+        ------
+        state: dict
+        The calibration points and whether the spectrum is calibrated
+        """
+        return {
+            "calibration_points": sorted(self.calibrationPoints.items()),
+            "calibrated": self.calibrated,
+        }
+
+    def undo(self):
+        """Undo the last edit of the calibration points
+
+        Raise
+        -----
+        HistoryError if there is nothing to undo
+        """
+        self.calibrationHistory.undo()
+        self._updateCalibrationPoints()
+        self.updatePlot()
+
+    def _updateAtlasLines(self):
+        """Plot the atlas lines in the visible range"""
+        if self.atlasItem is None:
+            return
+        for label in self.atlasLabels:
+            self.removeItem(label)
+        self.atlasLabels = []
+
+        xMin, xMax = self.getViewBox().viewRange()[0]
+        if self.spectrum.wavelength is not None:
+            lines = self.atlas.in_range(xMin, xMax)
+            xLines = lines["wave"]
+        elif self.waveSolution is not None:
+            pixels = np.arange(self.waveSolution.size)
+            lines = self.atlas.in_range(
+                *np.interp([xMin, xMax], pixels, self.waveSolution))
+            xLines = np.interp(lines["wave"], self.waveSolution, pixels)
+        else:
+            self.atlasItem.setData([], [])
+            return
+
+        # lines falling in the same screen pixel look like one
+        pixelWidth = self.getViewBox().viewPixelSize()[0]
+        if pixelWidth > 0 and xLines.size > 1:
+            columns = np.floor((xLines - xMin) / pixelWidth)
+            keep = np.concatenate(([True], np.diff(columns) > 0))
+            lines = lines[keep]
+            xLines = xLines[keep]
+
+        # a single item with one segment per line
+        self.atlasItem.setData(
+            np.repeat(xLines, 2),
+            np.tile(self.fluxRange, xLines.size),
+            connect="pairs")
+        if xLines.size <= MAX_LABELLED_LINES:
+            for line, xLine in zip(lines, xLines):
+                label = pg.TextItem(
+                    self.atlas.label(line), color="y", angle=90,
+                    anchor=(1, 1))
+                label.setPos(xLine, self.fluxRange[1])
+                self.addItem(label, ignoreBounds=True)
+                self.atlasLabels.append(label)
+
+    def _updateCalibrationPoints(self):
+        """Recompute the calibration points from the applied edits"""
+        calibrationPoints = {}
+        for operation in self.calibrationHistory.applied_operations:
+            if operation[0] == "add":
+                calibrationPoints[operation[1]] = operation[2]
+            elif operation[0] == "set":
+                calibrationPoints = dict(operation[1])
+        self.calibrationPoints = calibrationPoints
+
+        # refit with the changed points only
+        self.calibrationFit.update(calibrationPoints)
+        self.calibrationSolution, self.calibrationResiduals = (
+            self.calibrationFit.solve())
+        self.calibrationPointsChanged.emit()
+
+    def _waveSolution(self):
+        """Compute the wavelength of each pixel
+
+        The calibrated wavelength is used if the spectrum is calibrated.
+        Otherwise, the solution fitted to the calibration points is used if
+        there are enough of them or no current calibration, and the current
+        calibration is used if not
+
+        Return
+        ------
+        waveSolution: array of float or None
+        The wavelengths. None if there is no solution or it is not increasing
+        """
+        if self.spectrum.wavelength is not None:
+            return self.spectrum.wavelength
+        if (len(self.calibrationPoints) >= MIN_CALIBRATION_POINTS or
+                self.referenceCalibration is None):
+            solution = self.calibrationSolution
+        else:
+            solution = self.referenceCalibration.wave_solution
+        if solution is None:
+            return None
+        waveSolution = solution(np.arange(self.spectrum.flux.size))
+        if np.any(np.diff(waveSolution) <= 0):
+            return None
+        return waveSolution
 
     def updatePlot(self):
         """Update plot"""
@@ -196,12 +510,41 @@ class SpectrumView(pg.PlotWidget):
             pen=pen)
         self.addItem(self.spectrumItem)
 
+        # plot continuum
+        if self.continuum is not None:
+            self.continuumItem = pg.PlotCurveItem(
+                xArray,
+                self.continuum,
+                pen=pg.mkPen("c", width=2, style=Qt.PenStyle.DashLine))
+            self.addItem(self.continuumItem)
+
         # plot calibration points
         if len(self.calibrationPoints) > 0 and not self.calibrated:
             self.calibrationPointsItem = pg.ScatterPlotItem(
                 size=10, brush=pg.mkBrush(255, 255, 255, 120))
             self.calibrationPointsItem.addPoints([
                 {"pos": (index, self.spectrum.flux[index]), 'data': 1}
-                for index in self.calibrationPoints
+                for index in self.calibrationResiduals["x"][
+                    ~self.calibrationResiduals["outlier"]].astype(int)
+            ])
+            self.calibrationPointsItem.addPoints([
+                {"pos": (index, self.spectrum.flux[index]), 'data': 1,
+                 "brush": pg.mkBrush(255, 0, 0, 200)}
+                for index in self.calibrationResiduals["x"][
+                    self.calibrationResiduals["outlier"]].astype(int)
             ])
             self.addItem(self.calibrationPointsItem)
+
+        # plot atlas lines
+        self.waveSolution = self._waveSolution()
+        self.atlasLabels = []
+        if self.atlas is None:
+            self.atlasItem = None
+        else:
+            if np.isfinite(self.spectrum.flux).any():
+                self.fluxRange = (np.nanmin(self.spectrum.flux),
+                                  np.nanmax(self.spectrum.flux))
+            self.atlasItem = pg.PlotCurveItem(
+                pen=pg.mkPen("y", style=Qt.PenStyle.DotLine))
+            self.addItem(self.atlasItem, ignoreBounds=True)
+            self._updateAtlasLines()
@@ -0,0 +1,523 @@
+""" HDF5 archive of spectra and calibrations
+
+The archive stores all the spectra in a single file:
+- "spectra/flux" and "spectra/wavelength": chunked and compressed 1D arrays
+  with the fluxes (and wavelengths) of all the spectra one after the other.
+  They are created on the first write with the dtype of the written spectra
+  (float32 fluxes with the default working precision, see pyspec.precision)
+- "spectra/metadata": a table with one row per spectrum with its name, source
+  frame, position in the arrays and the header fields in METADATA_FIELDS
+- "calibrations/<name>": the calibration points of each stored calibration
+
+The metadata table is read when the archive is opened and sorted indices of
+its fields are built on first use, so queries do not read the arrays. Query
+results read the arrays of each spectrum only when it is accessed.
+
+Spectra are appended to an in-memory buffer and written in blocks (see
+SpectralArchive.flush). A spectrum with the same name and source frame as a
+stored one replaces it (e.g. when a night is reduced again): its row points to
+the new arrays and the old arrays are left unused in the file. HDF5 files do not support several writers, so batch
+workers send their spectra to the process holding the archive (see
+batch.reduce_night).
+
+This module requires the optional dependency h5py.
+"""
+import logging
+import os
+
+import numpy as np
+
+from pyspec.calibration import Calibration
+from pyspec.errors import ArchiveError
+from pyspec.instrumentation import add_bytes_read, instrument
+from pyspec.spectrum import Spectrum
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSION = ".h5"
+DEFAULT_BUFFER_SIZE = 256  # in spectra
+ARRAY_CHUNK_SIZE = 64 * 1024  # in values
+TABLE_CHUNK_SIZE = 1024  # in rows
+# metadata field: (header keyword, dtype)
+METADATA_FIELDS = {
+    "object": ("OBJECT", "S68"),
+    "date_obs": ("DATE-OBS", "S32"),
+    "exptime": ("EXPTIME", "f8"),
+}
+METADATA_DTYPE = np.dtype([
+    ("name", "S512"),
+    ("filename", "S512"),
+    ("offset", "i8"),
+    ("size", "i8"),
+    ("calibrated", "?"),
+] + [(field, dtype) for field, (_, dtype) in METADATA_FIELDS.items()])
+
+class SpectralArchive:
+    """ HDF5 archive of spectra and calibrations
+
+    Usage:
+        with SpectralArchive("night.h5") as archive:
+            archive.append(spectrum)
+            selection = archive.query(object="M31", exptime=(60, None))
+            spectrum = selection[0]
+
+    Methods
+    -------
+    __init__
+    __enter__
+    __exit__
+    __len__
+    _sorted_index
+    add_calibration
+    append
+    close
+    flush
+    get_calibration
+    query
+    read
+
+    Properties
+    ----------
+    calibrations
+
+    Attributes
+    ----------
+    buffer_size: int
+    Number of appended spectra kept in memory before writing them
+
+    filename: str
+    Name of the archive file
+
+    metadata: array
+    The metadata table (see METADATA_DTYPE) of the written spectra
+
+    _file: h5py.File
+    The opened file
+
+    _indices: dict
+    Sorted indices of the metadata fields. Keys are the field names and values
+    the row numbers sorted by the field
+
+    _pending: list of (array, array or None)
+    Fluxes and wavelengths of the buffered spectra
+
+    _pending_rows: list of array
+    Metadata rows of the buffered spectra
+
+    _next_offset: int
+    Position in the arrays of the next appended spectrum
+
+    _replaced: dict
+    New metadata of written rows replaced by buffered spectra. Keys are the
+    row numbers
+
+    _rows: dict
+    Row number of each spectrum. Keys are the names and the source filenames
+    """
+    def __init__(self, filename, mode="a", buffer_size=DEFAULT_BUFFER_SIZE):
+        """Initialize instance
+
+        Arguments
+        ---------
+        filename: str
+        Name of the archive file. Must end with ARCHIVE_EXTENSION
+
+        mode: str - Default: "a"
+        "r" to read, "a" to read and append (the file is created if needed)
+
+        buffer_size: int - Default: DEFAULT_BUFFER_SIZE
+        Number of appended spectra kept in memory before writing them
+
+        Raise
+        -----
+        ArchiveError if h5py is not installed
+        ArchiveError if the filename does not have the correct format
+        ArchiveError if the file cannot be opened
+        """
+        try:
+            # h5py is an optional dependency
+            import h5py  # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise ArchiveError(
+                "Archive: h5py is required to use archives. Install it with "
+                "'pip install h5py'") from error
+
+        if not filename.endswith(ARCHIVE_EXTENSION):
+            raise ArchiveError(
+                "Archive: 'filename' has incorrect extension. Valid extension "
+                f"is {ARCHIVE_EXTENSION}")
+
+        self.filename = filename
+        self.buffer_size = buffer_size
+        try:
+            self._file = h5py.File(filename, mode)
+        except (IOError, ValueError) as error:
+            raise ArchiveError(
+                f"Archive: Cannot open {filename}: {str(error)}") from error
+
+        if "spectra" not in self._file:
+            if mode == "r":
+                self._file.close()
+                raise ArchiveError(f"Archive: {filename} is not an archive")
+            spectra = self._file.create_group("spectra")
+            spectra.create_dataset(
+                "metadata", shape=(0,), maxshape=(None,), dtype=METADATA_DTYPE,
+                chunks=(TABLE_CHUNK_SIZE,), compression="gzip")
+            self._file.create_group("calibrations")
+
+        self.metadata = self._file["spectra/metadata"][...]
+        self._pending = []
+        self._pending_rows = []
+        self._next_offset = (self._file["spectra/flux"].size
+                             if "flux" in self._file["spectra"] else 0)
+        self._replaced = {}
+        self._rows = {
+            key: row for row, key in enumerate(
+                zip(self.metadata["name"], self.metadata["filename"]))
+        }
+        self._indices = {}
+
+    def __enter__(self):
+        """Enter the context
+
+        Return
+        ------
+        archive: SpectralArchive
+        This instance
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Write the buffered spectra and close the file"""
+        self.close()
+
+    def __len__(self):
+        """Number of spectra, including the buffered ones"""
+        return self.metadata.size + len(self._pending_rows)
+
+    @property
+    def calibrations(self):
+        """Names of the stored calibrations"""
+        return list(self._file["calibrations"])
+
+    def _sorted_index(self, field):
+        """Get the row numbers sorted by a metadata field
+
+        Indices are built on first use and kept until new spectra are written.
+        Only the written spectra are indexed
+
+        Arguments
+        ---------
+        field: str
+        The metadata field
+
+        Return
+        ------
+        rows: array of int
+        The row numbers sorted by the field
+        """
+        if field not in self._indices:
+            self._indices[field] = np.argsort(self.metadata[field],
+                                              kind="stable")
+        return self._indices[field]
+
+    def add_calibration(self, name, calibration):
+        """Store a calibration
+
+        Arguments
+        ---------
+        name: str
+        Name of the calibration. An existing calibration with the same name is
+        replaced
+
+        calibration: Calibration
+        The calibration
+        """
+        group = self._file["calibrations"]
+        if name in group:
+            del group[name]
+        group.create_dataset(name, data=calibration.calibration_points)
+
+    @instrument("SpectralArchive.append")
+    def append(self, spectrum, header=None):
+        """Append a spectrum
+
+        The spectrum is buffered and written with the next buffer_size spectra
+        (see flush). If a spectrum with the same name and source frame is
+        stored, it is replaced and a warning is logged
+
+        Arguments
+        ---------
+        spectrum: Spectrum
+        The spectrum
+
+        header: astropy.io.fits.header.Header, dict or None - Default: None
+        Header with the fields in METADATA_FIELDS. If None, the header of the
+        source frame, if the spectrum was extracted from an Image
+        """
+        if header is None:
+            header = spectrum.read_source_header() or {}
+
+        row = np.zeros(1, dtype=METADATA_DTYPE)
+        row["name"] = spectrum.name.encode("UTF-8")
+        if spectrum.source is not None:
+            row["filename"] = os.path.abspath(
+                spectrum.source["filename"]).encode("UTF-8")
+        row["offset"] = self._next_offset
+        row["size"] = spectrum.flux.size
+        row["calibrated"] = spectrum.wavelength is not None
+        for field, (keyword, dtype) in METADATA_FIELDS.items():
+            value = header.get(keyword)
+            if value is None:
+                row[field] = np.nan if dtype == "f8" else b""
+            elif dtype == "f8":
+                row[field] = float(value)
+            else:
+                row[field] = str(value).strip().encode("UTF-8")
+
+        key = (row["name"][0], row["filename"][0])
+        if key in self._rows:
+            logger.warning("Archive: %s is already stored. Replaced",
+                           spectrum.name)
+            index = self._rows[key]
+            if index < self.metadata.size:
+                self._replaced[index] = row
+            else:
+                self._pending_rows[index - self.metadata.size] = row
+        else:
+            self._rows[key] = len(self)
+            self._pending_rows.append(row)
+        self._pending.append((spectrum.flux, spectrum.wavelength))
+        self._next_offset += spectrum.flux.size
+        if len(self._pending) >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        """Write the buffered spectra and close the file"""
+        if self._file.mode != "r":
+            self.flush()
+        self._file.close()
+
+    @instrument("SpectralArchive.flush")
+    def flush(self):
+        """Write the buffered spectra
+
+        All the buffered spectra are written at once, resizing each dataset
+        and the metadata table only once. The arrays are created on the first
+        write, with the dtype of the written spectra. Later spectra are
+        converted to it
+        """
+        if len(self._pending) == 0:
+            return
+        flux = np.concatenate([flux for flux, _ in self._pending])
+        # wavelengths are computed in double precision (see Calibration)
+        wavelengths = [wavelength for _, wavelength in self._pending
+                       if wavelength is not None]
+        wavelength_dtype = (np.result_type(*wavelengths) if wavelengths
+                            else np.float64)
+        wavelength = np.concatenate([
+            np.full(flux.size, np.nan, dtype=wavelength_dtype)
+            if wavelength is None else wavelength
+            for flux, wavelength in self._pending
+        ])
+
+        spectra = self._file["spectra"]
+        for array_name, array in (("flux", flux), ("wavelength", wavelength)):
+            if array_name not in spectra:
+                spectra.create_dataset(
+                    array_name, shape=(0,), maxshape=(None,),
+                    dtype=array.dtype, chunks=(ARRAY_CHUNK_SIZE,),
+                    compression="gzip", shuffle=True)
+            dataset = spectra[array_name]
+            start = dataset.size
+            dataset.resize((start + array.size,))
+            dataset[start:] = array
+
+        dataset = self._file["spectra/metadata"]
+        for index, row in self._replaced.items():
+            dataset[index] = row[0]
+            self.metadata[index] = row[0]
+        if len(self._pending_rows) > 0:
+            rows = np.concatenate(self._pending_rows)
+            num_written = dataset.size
+            dataset.resize((num_written + rows.size,))
+            dataset[num_written:] = rows
+            self.metadata = np.concatenate([self.metadata, rows])
+
+        self._pending = []
+        self._pending_rows = []
+        self._replaced = {}
+        self._indices = {}
+        self._file.flush()
+
+    def get_calibration(self, name):
+        """Get a stored calibration
+
+        Arguments
+        ---------
+        name: str
+        Name of the calibration
+
+        Return
+        ------
+        calibration: Calibration
+        The calibration
+
+        Raise
+        -----
+        ArchiveError if there is no calibration with this name
+        """
+        if name not in self._file["calibrations"]:
+            raise ArchiveError(f"Archive: Unknown calibration {name}")
+        return Calibration(self._file["calibrations"][name][...])
+
+    def query(self, **criteria):
+        """Select spectra by their metadata
+
+        Arguments
+        ---------
+        **criteria: dict
+        Keys are metadata fields (see METADATA_DTYPE). Values are either the
+        wanted value or a (minimum, maximum) tuple with the inclusive limits.
+        Use None for an open limit. E.g.
+        query(object="M31", date_obs=("2024-01-01", "2024-01-02T12:00:00"))
+
+        Return
+        ------
+        selection: ArchiveSelection
+        The selected spectra, in the order they were appended
+
+        Raise
+        -----
+        ArchiveError if a field is not valid
+        """
+        self.flush()
+        rows = np.arange(len(self))
+        for field, value in criteria.items():
+            if field not in METADATA_DTYPE.names:
+                raise ArchiveError(
+                    f"Archive: Unknown field {field}. Valid fields are " +
+                    ", ".join(METADATA_DTYPE.names))
+            if isinstance(value, tuple):
+                minimum, maximum = value
+            else:
+                minimum, maximum = value, value
+            index = self._sorted_index(field)
+            values = self.metadata[field][index]
+            if isinstance(minimum, str):
+                minimum = minimum.encode("UTF-8")
+            if isinstance(maximum, str):
+                maximum = maximum.encode("UTF-8")
+            first = 0 if minimum is None else np.searchsorted(
+                values, minimum, side="left")
+            last = values.size if maximum is None else np.searchsorted(
+                values, maximum, side="right")
+            rows = np.intersect1d(rows, index[first:last])
+        return ArchiveSelection(self, rows)
+
+    @instrument("SpectralArchive.read")
+    def read(self, row):
+        """Read a spectrum
+
+        Arguments
+        ---------
+        row: int
+        Row of the spectrum in the metadata table
+
+        Return
+        ------
+        spectrum: Spectrum
+        The spectrum
+        """
+        self.flush()
+        metadata = self.metadata[row]
+        limits = slice(metadata["offset"], metadata["offset"] + metadata["size"])
+        flux = self._file["spectra/flux"][limits]
+        wavelength = None
+        if metadata["calibrated"]:
+            wavelength = self._file["spectra/wavelength"][limits]
+        add_bytes_read(flux.nbytes * (2 if metadata["calibrated"] else 1))
+        return Spectrum(flux, wavelength, metadata["name"].decode("UTF-8"))
+
+class ArchiveSelection:
+    """ Spectra selected from an archive
+
+    Spectra are read from the archive only when accessed
+
+    Methods
+    -------
+    __init__
+    __getitem__
+    __iter__
+    __len__
+    to_collection
+
+    Properties
+    ----------
+    metadata
+
+    Attributes
+    ----------
+    archive: SpectralArchive
+    The archive
+
+    rows: array of int
+    Rows of the selected spectra in the metadata table
+    """
+    def __init__(self, archive, rows):
+        """Initialize instance
+
+        Arguments
+        ---------
+        archive: SpectralArchive
+        The archive
+
+        rows: array of int
+        Rows of the selected spectra in the metadata table
+        """
+        self.archive = archive
+        self.rows = rows
+
+    def __getitem__(self, index):
+        """Read a selected spectrum
+
+        Arguments
+        ---------
+        index: int
+        Index of the spectrum in the selection
+
+        Return
+        ------
+        spectrum: Spectrum
+        The spectrum
+        """
+        return self.archive.read(self.rows[index])
+
+    def __iter__(self):
+        """Iterate over the selected spectra, reading them one by one"""
+        return (self[index] for index in range(len(self)))
+
+    def __len__(self):
+        """Number of selected spectra"""
+        return self.rows.size
+
+    @property
+    def metadata(self):
+        """The metadata of the selected spectra"""
+        return self.archive.metadata[self.rows]
+
+    def to_collection(self):
+        """Read the selected spectra into a SpectrumCollection
+
+        Return
+        ------
+        collection: SpectrumCollection
+        The selected spectra
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra cannot be gathered
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.collection import SpectrumCollection
+        return SpectrumCollection.from_spectra(list(self))
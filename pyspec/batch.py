@@ -0,0 +1,652 @@
+""" Batch reduction of many frames with the same settings """
+import logging
+import multiprocessing
+import os
+import sys
+
+from pyspec import instrumentation
+from pyspec.cache import ResultCache, get_cache, set_cache
+from pyspec.calibration import Calibration
+from pyspec.drift import track_drift
+from pyspec.errors import CalibrationError, ImageError, SpectrumError
+from pyspec.frame_types import (
+    EXTRACTED_FRAME_TYPES, FRAME_TYPES, classify_frame
+)
+from pyspec.image import ACCEPTED_FORMATS, Image
+from pyspec.instrumentation import capture, timer
+from pyspec.metrics import FrameMetrics, ThroughputReport
+from pyspec.precision import (
+    WORKING_DTYPES, get_working_dtype, set_working_dtype
+)
+from pyspec.spectrum import Spectrum
+
+logger = logging.getLogger(__name__)
+
+def find_frames(paths):
+    """Find the frames to reduce
+
+    Arguments
+    ---------
+    paths: list of str
+    Frames or directories containing frames
+
+    Return
+    ------
+    filenames: list of str
+    The sorted names of the frames
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += [
+                os.path.join(path, filename)
+                for filename in os.listdir(path)
+                if any(filename.endswith(format_check)
+                       for format_check in ACCEPTED_FORMATS)
+            ]
+        else:
+            filenames.append(path)
+    return sorted(filenames)
+
+def reduce_frame(filename, rotation_angle, lower_limit, upper_limit,
+                 calibration=None, output_dir=None, sensitivity=None,
+                 save=True):
+    """Reduce a single frame and save the extracted spectrum
+
+    The image data is only read if the products are not in the disk cache
+    (see pyspec.cache)
+
+    Arguments
+    ---------
+    filename: str
+    Name of the frame
+
+    rotation_angle: float
+    Rotation angle in degrees
+
+    lower_limit: int
+    Lower limit of the extraction region
+
+    upper_limit: int
+    Upper limit of the extraction region
+
+    calibration: Calibration or None - Default: None
+    Wavelength calibration. If None, the spectrum is not calibrated
+
+    output_dir: str or None - Default: None
+    Directory where the spectrum is saved. If None, it is saved next to the
+    frame
+
+    sensitivity: SensitivityFunction or None - Default: None
+    Sensitivity function (see pyspec.flux_calibration). If None, the
+    spectrum is not flux calibrated. Requires calibration and the EXPTIME and
+    AIRMASS keywords
+
+    save: bool - Default: True
+    If False, the spectrum is not saved. Its name is still the one it would be
+    saved with
+
+    Return
+    ------
+    spectrum: Spectrum
+    The extracted spectrum
+
+    metrics: FrameMetrics
+    The timings of the reduction
+    """
+    metrics = FrameMetrics(filename)
+    with metrics.measure(), timer("reduce_frame"):
+        image = Image(filename, load=False)
+        metrics.num_pixels = (image.header.get("NAXIS1", 0) *
+                              image.header.get("NAXIS2", 0))
+        if rotation_angle != 0.0:
+            image.set_operations([("rotate", float(rotation_angle))])
+
+        spectrum = Spectrum.from_image(image, lower_limit, upper_limit)
+        if calibration is not None:
+            spectrum.wavelength = calibration.calibrate(spectrum.flux.size)
+        if sensitivity is not None:
+            spectrum.flux_calibrate(sensitivity,
+                                    exptime=image.header.get("EXPTIME"),
+                                    airmass=image.header.get("AIRMASS"))
+
+        if output_dir is not None:
+            spectrum.name = os.path.join(
+                output_dir, os.path.basename(spectrum.name))
+        if save:
+            spectrum.save()
+
+    return spectrum, metrics
+
+def log_metrics(metrics):
+    """Log the metrics of a frame
+
+    The metrics are attached to the log record as the attribute "metrics"
+
+    Arguments
+    ---------
+    metrics: FrameMetrics
+    The metrics
+    """
+    logger.info(
+        "%s: %.1f ms (load %.1f ms, rotate %.1f ms, extract %.1f ms), "
+        "%.2f Mpixels/s", metrics.filename, metrics.total_time * 1e3,
+        metrics.load_time * 1e3, metrics.rotate_time * 1e3,
+        metrics.extract_time * 1e3, metrics.pixels_per_second / 1e6,
+        extra={"metrics": metrics.to_dict()})
+
+def _init_worker(cache_dir, cache_size, profile, dtype):
+    """Activate the disk cache, the instrumentation and the working precision
+    in a worker process
+
+    Arguments
+    ---------
+    cache_dir: str or None
+    The cache directory. None to disable the cache
+
+    cache_size: int
+    Maximum size of the cache in bytes
+
+    profile: bool
+    Whether to enable the instrumentation
+
+    dtype: str
+    The working dtype (see pyspec.precision)
+    """
+    if cache_dir is not None:
+        set_cache(ResultCache(cache_dir, cache_size))
+    if profile:
+        instrumentation.enable()
+    set_working_dtype(dtype)
+
+def _reduce_frame_star(args):
+    """Unpack the arguments of reduce_frame (see Pool.imap)
+
+    Errors reading or extracting the frame are returned instead of raised, so
+    that one bad frame does not stop the reduction of the others
+
+    Arguments
+    ---------
+    args: tuple
+    The arguments of reduce_frame
+
+    Return
+    ------
+    spectrum: Spectrum or None
+    The saved spectrum. None if the reduction failed
+
+    metrics: FrameMetrics or None
+    The timings of the reduction. None if the reduction failed
+
+    records: list of instrumentation.Record
+    The instrumentation records of this frame
+
+    error: str or None
+    The error message if the reduction failed
+    """
+    instrumentation.reset()
+    try:
+        spectrum, metrics = reduce_frame(*args)
+    except (ImageError, SpectrumError) as error:
+        return None, None, instrumentation.records(), str(error)
+    return spectrum, metrics, instrumentation.records(), None
+
+def _arc_calibrations(filenames, arc_calibrations, calibration):
+    """Assign the drift corrected calibrations of the arcs to the frames
+
+    Each frame gets the calibration of the last arc before it, or of the first
+    arc if there are no arcs before it
+
+    Arguments
+    ---------
+    filenames: list of str
+    Names of the frames, in observing order
+
+    arc_calibrations: dict
+    Keys are the names of the arcs and values their calibration
+
+    calibration: Calibration
+    Calibration of the frames if there are no arcs
+
+    Return
+    ------
+    frame_calibrations: dict
+    Keys are the filenames and values their calibration
+    """
+    current = next(
+        (arc_calibrations[filename] for filename in filenames
+         if filename in arc_calibrations),
+        calibration)
+    frame_calibrations = {}
+    for filename in filenames:
+        current = arc_calibrations.get(filename, current)
+        frame_calibrations[filename] = current
+    return frame_calibrations
+
+def _reduce_frames(args, num_processors):
+    """Reduce frames in this process or in a pool of workers
+
+    Workers share the disk cache of the calling process, if any, and their
+    instrumentation records are merged as they finish
+
+    Arguments
+    ---------
+    args: list of tuple
+    The arguments of reduce_frame of each frame
+
+    num_processors: int
+    Number of worker processes
+
+    Return
+    ------
+    results: generator of (str, Spectrum, FrameMetrics, str)
+    The name of each frame, the saved spectrum and the metrics of its
+    reduction, in the order of args. If the reduction failed, the spectrum and
+    the metrics are None and the last item is the error message (otherwise
+    None)
+    """
+    if num_processors <= 1:
+        for arg in args:
+            try:
+                spectrum, metrics = reduce_frame(*arg)
+            except (ImageError, SpectrumError) as error:
+                yield arg[0], None, None, str(error)
+                continue
+            yield arg[0], spectrum, metrics, None
+        return
+
+    cache = get_cache()
+    initargs = (None, 0) if cache is None else (cache.directory, cache.max_size)
+    initargs += (instrumentation.is_enabled(), get_working_dtype().name)
+    with multiprocessing.Pool(num_processors, _init_worker,
+                              initargs) as pool:
+        results = pool.imap(_reduce_frame_star, args)
+        for arg, (spectrum, metrics, records, error) in zip(args, results):
+            instrumentation.merge(records)
+            yield arg[0], spectrum, metrics, error
+
+def route_frames(filenames):
+    """Classify frames into the stages of the reduction
+
+    Arguments
+    ---------
+    filenames: list of str
+    Names of the frames
+
+    Return
+    ------
+    frame_types: dict
+    Keys are the filenames and values their frame type (see
+    pyspec.frame_types). Frames that cannot be read are not included
+    """
+    frame_types = {}
+    for filename in filenames:
+        try:
+            frame_type, _ = classify_frame(filename)
+        except ImageError as error:
+            logger.error("%s: classification failed: %s", filename, error)
+            continue
+        logger.debug("%s: %s frame", filename, frame_type)
+        frame_types[filename] = frame_type
+    for frame_type in FRAME_TYPES:
+        count = sum(value == frame_type for value in frame_types.values())
+        if count > 0:
+            logger.info(
+                "%d %s frames%s", count, frame_type,
+                "" if frame_type in EXTRACTED_FRAME_TYPES else " (skipped)")
+    return frame_types
+
+def reduce_night(filenames, rotation_angle, lower_limit, upper_limit,
+                 calibration=None, output_dir=None, num_processors=1,
+                 archive=None, sensitivity=None, route=False,
+                 reference_arc=None, stretch=False, spectra=None):
+    """Reduce many frames with the same settings
+
+    Workers share the disk cache of the calling process, if any. The metrics
+    of each frame are logged as they finish. Spectra are appended to the
+    archive by the calling process, as workers finish. Frames that cannot be
+    read, classified or extracted are logged and recorded as failed in the
+    report, and the reduction continues with the next frame
+
+    Arguments
+    ---------
+    filenames: list of str
+    Names of the frames
+
+    rotation_angle: float
+    Rotation angle in degrees
+
+    lower_limit: int
+    Lower limit of the extraction region
+
+    upper_limit: int
+    Upper limit of the extraction region
+
+    calibration: Calibration or None - Default: None
+    Wavelength calibration. If None, the spectra are not calibrated
+
+    output_dir: str or None - Default: None
+    Directory where the spectra are saved. If None, they are saved next to the
+    frames
+
+    num_processors: int - Default: 1
+    Number of worker processes
+
+    archive: SpectralArchive or None - Default: None
+    Archive where the spectra are also stored
+
+    sensitivity: SensitivityFunction or None - Default: None
+    Sensitivity function. If None, the spectra are not flux calibrated
+
+    route: bool - Default: False
+    If True, classify the frames first (see route_frames). Only arcs and
+    science frames are reduced, and arcs are not flux calibrated
+
+    reference_arc: array of float or None - Default: None
+    Flux of the arc of the calibration. If given with route and calibration,
+    the arcs are reduced first and the calibration is corrected for the drift
+    of each arc (see pyspec.drift). Each frame is calibrated with the
+    calibration of the last arc before it (in the order of filenames)
+
+    stretch: bool - Default: False
+    If True, the drift also corrects the stretch
+
+    spectra: list or None - Default: None
+    List where the spectra are also appended, e.g. to gather them in a
+    SpectrumCollection without reading the saved files
+
+    Return
+    ------
+    names: list of str
+    Names of the saved spectra
+
+    report: ThroughputReport
+    The metrics of all the frames
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    names = []
+    report = ThroughputReport()
+
+    def collect(filename, spectrum, metrics, error):
+        if error is not None:
+            logger.error("%s: reduction failed: %s", filename, error)
+            report.add_failure(filename, error)
+            return
+        names.append(spectrum.name)
+        if archive is not None:
+            archive.append(spectrum)
+        if spectra is not None:
+            spectra.append(spectrum)
+        report.add(metrics)
+        log_metrics(metrics)
+
+    if route:
+        frame_types = route_frames(filenames)
+        for filename in filenames:
+            if filename not in frame_types:
+                report.add_failure(filename, "the frame cannot be classified")
+        frame_calibrations = dict.fromkeys(frame_types, calibration)
+        if reference_arc is not None and calibration is not None:
+            arcs = [filename for filename, frame_type in frame_types.items()
+                    if frame_type == "arc"]
+            # the arcs are saved once their drift is corrected
+            arc_args = [(filename, rotation_angle, lower_limit, upper_limit,
+                         None, output_dir, None, False)
+                        for filename in arcs]
+            arc_calibrations = {}
+            for filename, spectrum, metrics, error in _reduce_frames(
+                    arc_args, num_processors):
+                if error is not None:
+                    collect(filename, spectrum, metrics, error)
+                    continue
+                try:
+                    arc_calibration = track_drift(
+                        calibration, reference_arc, spectrum.flux,
+                        stretch=stretch)
+                except CalibrationError as error:
+                    logger.error("%s: drift tracking failed: %s",
+                                 metrics.filename, error)
+                    arc_calibration = calibration
+                arc_calibrations[metrics.filename] = arc_calibration
+                spectrum.wavelength = arc_calibration.calibrate(
+                    spectrum.flux.size)
+                with capture() as saving:
+                    spectrum.save()
+                save_time = sum(record.wall_time for record in saving.records
+                                if record.stage == "Spectrum.save")
+                metrics.save_time += save_time
+                metrics.total_time += save_time
+                collect(filename, spectrum, metrics, error)
+            frame_calibrations = _arc_calibrations(
+                list(frame_types), arc_calibrations, calibration)
+            frame_types = {
+                filename: frame_type
+                for filename, frame_type in frame_types.items()
+                if frame_type != "arc"
+            }
+        args = [(filename, rotation_angle, lower_limit, upper_limit,
+                 frame_calibrations[filename], output_dir,
+                 None if frame_type == "arc" else sensitivity)
+                for filename, frame_type in frame_types.items()
+                if frame_type in EXTRACTED_FRAME_TYPES]
+    else:
+        args = [(filename, rotation_angle, lower_limit, upper_limit,
+                 calibration, output_dir, sensitivity)
+                for filename in filenames]
+
+    for result in _reduce_frames(args, num_processors):
+        collect(*result)
+    return names, report
+
+def main(cmdargs=None):
+    """Run the batch reduction from the command line
+
+    Arguments
+    ---------
+    cmdargs: list of str or None - Default: None
+    Command line arguments. If None, use sys.argv
+    """
+    # pylint: disable-next=import-outside-toplevel
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Extract and calibrate the spectra of many frames with the "
+                    "same settings")
+    parser.add_argument("paths",
+                        nargs="+",
+                        help="Frames or directories containing frames")
+    parser.add_argument("--lower-limit",
+                        type=int,
+                        required=True,
+                        help="Lower limit of the extraction region")
+    parser.add_argument("--upper-limit",
+                        type=int,
+                        required=True,
+                        help="Upper limit of the extraction region")
+    parser.add_argument("--rotation-angle",
+                        type=float,
+                        default=0.0,
+                        help="Rotation angle in degrees")
+    parser.add_argument("--calibration",
+                        default=None,
+                        help="File with the calibration points")
+    parser.add_argument("--sensitivity",
+                        default=None,
+                        help="File with the sensitivity function (see "
+                             "pyspec.flux_calibration). Requires --calibration")
+    parser.add_argument("--output-dir",
+                        default=None,
+                        help="Directory where the spectra are saved")
+    parser.add_argument("--collection",
+                        default=None,
+                        help="Also save all the spectra into a single .npz file "
+                             "(see pyspec.collection)")
+    parser.add_argument("--archive",
+                        default=None,
+                        help="Also store all the spectra into an HDF5 archive "
+                             "(.h5, see pyspec.archive). Requires h5py")
+    parser.add_argument("--num-processors",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes")
+    parser.add_argument("--cache-dir",
+                        default=None,
+                        help="Directory of the result cache. Reruns with the "
+                             "same inputs and settings reuse the products")
+    parser.add_argument("--cache-size",
+                        type=float,
+                        default=10.0,
+                        help="Maximum size of the result cache in GB")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Print a per-stage timing summary at the end")
+    parser.add_argument("--profile-json",
+                        default=None,
+                        help="Save the timing records and summary as JSON")
+    parser.add_argument("--trace",
+                        default=None,
+                        help="Save the timing records in the Chrome trace "
+                             "format")
+    parser.add_argument("--metrics-json",
+                        default=None,
+                        help="Save the per-frame metrics and the throughput "
+                             "report as JSON")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="Watch the directory given in paths and reduce the "
+                             "new frames as they are written, until Ctrl+C")
+    parser.add_argument("--poll-interval",
+                        type=float,
+                        default=2.0,
+                        help="Time between checks for new frames in watch "
+                             "mode, in seconds")
+    parser.add_argument("--precision",
+                        default=None,
+                        choices=WORKING_DTYPES,
+                        help="Working dtype of the pixel data and the "
+                             "extracted fluxes (see pyspec.precision). "
+                             "Default: PYSPEC_PRECISION or float32")
+    parser.add_argument("--route",
+                        action="store_true",
+                        help="Classify the frames (from the header or the "
+                             "pixels, see pyspec.frame_types) and only reduce "
+                             "the arcs and the science frames. Arcs are not "
+                             "flux calibrated")
+    parser.add_argument("--reference-arc",
+                        default=None,
+                        help="Spectrum of the arc of the calibration (saved "
+                             "with Spectrum.save). Requires --calibration and "
+                             "--route. The calibration is corrected for the "
+                             "drift of each arc of the night, measured by "
+                             "cross-correlation (see pyspec.drift)")
+    parser.add_argument("--drift-stretch",
+                        action="store_true",
+                        help="Also correct the stretch of the arcs. Requires "
+                             "--reference-arc")
+    parser.add_argument("--log-level",
+                        default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level")
+    args = parser.parse_args(cmdargs)
+
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(name)s %(levelname)s: "
+                               "%(message)s")
+
+    if args.precision is not None:
+        set_working_dtype(args.precision)
+    if args.cache_dir is not None:
+        set_cache(ResultCache(args.cache_dir, int(args.cache_size * 1024**3)))
+    if (args.profile or args.profile_json is not None
+            or args.trace is not None):
+        instrumentation.enable()
+
+    calibration = None
+    if args.calibration is not None:
+        calibration = Calibration.from_file(args.calibration)
+    sensitivity = None
+    if args.sensitivity is not None:
+        if calibration is None:
+            parser.error("--sensitivity requires --calibration")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.flux_calibration import SensitivityFunction
+        sensitivity = SensitivityFunction.from_file(args.sensitivity)
+
+    reference_arc = None
+    if args.reference_arc is not None:
+        if calibration is None or not args.route:
+            parser.error("--reference-arc requires --calibration and --route")
+        if args.watch:
+            parser.error("--reference-arc is not supported with --watch")
+        reference_arc = Spectrum.from_file(args.reference_arc).flux
+    elif args.drift_stretch:
+        parser.error("--drift-stretch requires --reference-arc")
+
+    # the spectra are only kept in memory to gather them in a collection
+    spectra = [] if args.collection is not None else None
+
+    archive = None
+    if args.archive is not None:
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.archive import SpectralArchive
+        archive = SpectralArchive(args.archive)
+
+    if args.watch:
+        if len(args.paths) != 1 or not os.path.isdir(args.paths[0]):
+            parser.error("--watch requires a single directory")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.watcher import DirectoryWatcher
+        with DirectoryWatcher(args.paths[0],
+                              args.rotation_angle,
+                              args.lower_limit,
+                              args.upper_limit,
+                              calibration=calibration,
+                              output_dir=args.output_dir,
+                              num_processors=args.num_processors,
+                              sensitivity=sensitivity,
+                              poll_interval=args.poll_interval,
+                              archive=archive,
+                              route=args.route,
+                              spectra=spectra) as watcher:
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                logger.info("Waiting for the queued frames")
+        report = watcher.report
+    else:
+        _, report = reduce_night(find_frames(args.paths),
+                                 args.rotation_angle,
+                                 args.lower_limit,
+                                 args.upper_limit,
+                                 calibration=calibration,
+                                 output_dir=args.output_dir,
+                                 num_processors=args.num_processors,
+                                 archive=archive,
+                                 sensitivity=sensitivity,
+                                 route=args.route,
+                                 reference_arc=reference_arc,
+                                 stretch=args.drift_stretch,
+                                 spectra=spectra)
+    if archive is not None:
+        archive.close()
+
+    if spectra:
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.collection import SpectrumCollection
+        SpectrumCollection.from_spectra(spectra).save(args.collection)
+
+    logger.info("Throughput report\n%s", report.format())
+    if args.metrics_json is not None:
+        report.export_json(args.metrics_json)
+    if args.profile:
+        print(instrumentation.format_summary())
+    if args.profile_json is not None:
+        instrumentation.export_json(args.profile_json)
+    if args.trace is not None:
+        instrumentation.export_chrome_trace(args.trace)
+
+    if report.failed:
+        logger.error("%d frames failed: %s", len(report.failed),
+                     ", ".join(report.failed))
+        sys.exit(1)
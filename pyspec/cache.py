@@ -0,0 +1,337 @@
+""" Content-addressed disk cache for the reduction products
+
+Results are stored as .npy files named after the hash of the input file
+identity, the operation, its parameters and the pyspec version. Files are
+written to a temporary file and atomically moved into place, so several
+processes can share the same cache directory: readers never see partially
+written entries and concurrent evictions tolerate entries that were already
+removed.
+
+The cache is disabled by default. Enable it with set_cache or by setting
+the environment variable PYSPEC_CACHE_DIR (and optionally
+PYSPEC_CACHE_SIZE, in bytes).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from pyspec._version import __version__
+from pyspec.errors import CacheError
+from pyspec.instrumentation import add_bytes_read
+
+DEFAULT_MAX_SIZE = 10 * 1024**3  # in bytes
+# evictions shrink the cache to this fraction of max_size, so that they are
+# not needed again on the next put
+EVICTION_TARGET = 0.9
+# puts between two rescans of the cache size, to count the entries written by
+# other processes
+RESCAN_INTERVAL = 1000
+# temporary files older than this were left by crashed writers
+ORPHAN_AGE = 3600  # in seconds
+CACHE_DIR_ENV = "PYSPEC_CACHE_DIR"
+CACHE_SIZE_ENV = "PYSPEC_CACHE_SIZE"
+
+_active_cache = None
+
+class ResultCache:
+    """ Content-addressed disk cache of arrays
+
+    The least recently used entries are removed when the size of the cache
+    exceeds max_size. The modification time of the entries is used as their
+    last access time, as access times are often not updated by the file
+    system.
+
+    The size of the cache is estimated by adding the size of the stored
+    entries to the size found by the last scan of the directory, so the
+    directory is only scanned when the estimate exceeds max_size or every
+    RESCAN_INTERVAL puts. Evictions shrink the cache to EVICTION_TARGET times
+    max_size.
+
+    Methods
+    -------
+    __init__
+    _entries
+    _path
+    clear
+    evict
+    get
+    input_key
+    key
+    put
+    size
+
+    Attributes
+    ----------
+    directory: str
+    Directory where the entries are stored
+
+    hash_content: bool
+    If True, input files are identified by the hash of their content.
+    Otherwise by their path, size and modification time
+
+    max_size: int
+    Maximum size of the cache in bytes
+
+    _num_puts: int
+    Number of puts since the last scan of the directory
+
+    _size_estimate: int or None
+    Estimated size of the cache in bytes. None before the first scan
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE,
+                 hash_content=False):
+        """Initialize instance
+
+        Arguments
+        ---------
+        directory: str
+        Directory where the entries are stored. Created if it does not exist
+
+        max_size: int - Default: DEFAULT_MAX_SIZE
+        Maximum size of the cache in bytes
+
+        hash_content: bool - Default: False
+        If True, input files are identified by the hash of their content.
+        Otherwise by their path, size and modification time
+
+        Raise
+        -----
+        CacheError if the directory cannot be created
+        """
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as error:
+            raise CacheError(
+                f"Cache: Cannot create directory {directory}: {str(error)}"
+                ) from error
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_content = hash_content
+        self._num_puts = 0
+        self._size_estimate = None
+
+    def _path(self, key):
+        """Get the path of an entry
+
+        Arguments
+        ---------
+        key: str
+        The entry key
+
+        Return
+        ------
+        path: str
+        The path of the entry
+        """
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    def _entries(self, remove_orphans=False):
+        """List the entries in the cache
+
+        Arguments
+        ---------
+        remove_orphans: bool - Default: False
+        If True, remove the temporary files older than ORPHAN_AGE
+
+        Return
+        ------
+        entries: list of (float, int, str)
+        Modification time, size and path of each entry
+        """
+        entries = []
+        orphan_time = time.time() - ORPHAN_AGE
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                is_orphan = remove_orphans and entry.name.endswith(".tmp")
+                if not (entry.name.endswith(".npy") or is_orphan):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if is_orphan:
+                        if stat.st_mtime < orphan_time:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def clear(self):
+        """Remove all the entries"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size_estimate = None
+
+    def evict(self):
+        """Remove the least recently used entries if the cache size exceeds
+        max_size
+
+        The entries are removed until the cache size is within EVICTION_TARGET
+        times max_size. Temporary files left by crashed writers are also
+        removed
+        """
+        entries = sorted(self._entries(remove_orphans=True))
+        total_size = sum(size for _, size, _ in entries)
+        if total_size > self.max_size:
+            for _, size, path in entries:
+                if total_size <= EVICTION_TARGET * self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+        self._num_puts = 0
+        self._size_estimate = total_size
+
+    def get(self, key):
+        """Get an entry and mark it as recently used
+
+        Arguments
+        ---------
+        key: str
+        The entry key
+
+        Return
+        ------
+        array: np.ndarray or None
+        The stored array. None if the entry is not in the cache
+        """
+        path = self._path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+            add_bytes_read(array.nbytes)
+        except (FileNotFoundError, ValueError, OSError):
+            # missing, evicted while reading or corrupted entries are misses
+            return None
+        return array
+
+    def input_key(self, filename):
+        """Identify an input file
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Return
+        ------
+        input_key: str
+        The file identity
+        """
+        if self.hash_content:
+            # pylint: disable-next=import-outside-toplevel
+            from pyspec.session import file_hash
+            return file_hash(filename)
+        stat = os.stat(filename)
+        return f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    @staticmethod
+    def key(input_key, operation, parameters):
+        """Compute the key of an entry
+
+        Arguments
+        ---------
+        input_key: str
+        Identity of the input (see input_key)
+
+        operation: str
+        Name of the operation
+
+        parameters: dict
+        The operation parameters. Must be JSON serializable
+
+        Return
+        ------
+        key: str
+        The entry key
+        """
+        content = json.dumps(
+            [input_key, operation, parameters, __version__], sort_keys=True)
+        return hashlib.sha256(content.encode("UTF-8")).hexdigest()
+
+    def put(self, key, array):
+        """Store an entry and evict old entries if needed
+
+        The cache is only scanned if the estimated size exceeds max_size or
+        every RESCAN_INTERVAL puts (see evict)
+
+        Arguments
+        ---------
+        key: str
+        The entry key
+
+        array: np.ndarray
+        The array to store
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.save(file, array)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is an optimization, failing to write is not an error
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._num_puts += 1
+        if self._size_estimate is not None:
+            self._size_estimate += array.nbytes
+        if (self._size_estimate is None or
+                self._size_estimate > self.max_size or
+                self._num_puts >= RESCAN_INTERVAL):
+            self.evict()
+
+    def size(self):
+        """Compute the size of the cache
+
+        Return
+        ------
+        size: int
+        Size of the stored entries in bytes
+        """
+        return sum(size for _, size, _ in self._entries())
+
+def get_cache():
+    """Get the active cache
+
+    If no cache was set with set_cache and the environment variable
+    PYSPEC_CACHE_DIR is set, a cache in that directory is activated
+
+    Return
+    ------
+    cache: ResultCache or None
+    The active cache. None if caching is disabled
+    """
+    global _active_cache  # pylint: disable=global-statement
+    if _active_cache is None and os.environ.get(CACHE_DIR_ENV):
+        _active_cache = ResultCache(
+            os.environ[CACHE_DIR_ENV],
+            int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_MAX_SIZE)))
+    return _active_cache
+
+def set_cache(cache):
+    """Set the active cache
+
+    Arguments
+    ---------
+    cache: ResultCache or None
+    The cache. None to disable caching (unless PYSPEC_CACHE_DIR is set)
+    """
+    global _active_cache  # pylint: disable=global-statement
+    _active_cache = cache
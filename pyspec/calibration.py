@@ -1,10 +1,19 @@
 """Calibration class """
+import hashlib
+
 import numpy as np
 
+from pyspec.cache import get_cache
 from pyspec.errors import CalibrationError
+from pyspec.instrumentation import instrument
 
 MIN_CALIBRATION_POINTS = 5
+SOLUTION_DEGREE = 3
 ACCEPTED_FORMATS = [".dat"]
+# calibration points with a larger standardized residual are outliers
+OUTLIER_THRESHOLD = 2.0  # in pixels
+RESIDUALS_DTYPE = [("x", float), ("wave", float), ("residual", float),
+                   ("pixel_residual", float), ("outlier", bool)]
 
 class Calibration():
     """Computes and stores the wavelength solution for flux calibration
@@ -16,6 +25,9 @@ class Calibration():
     Methods
     -------
     __init__
+    calibrate
+    corrected
+    save
 
     Attributes
     ----------
@@ -26,6 +38,7 @@ class Calibration():
     wave_solution: np.Polynomial
     Wavelength solution
     """
+    @instrument("Calibration.__init__")
     def __init__(self, calibration_points):
         """Initialize class instance
 
@@ -52,17 +65,62 @@ class Calibration():
         self.wave_solution = np.polynomial.Polynomial.fit(
             calibration_points["x"],
             calibration_points["wave"],
-            3)
+            SOLUTION_DEGREE)
 
+    @instrument("Calibration.calibrate")
     def calibrate(self, size):
         """Return the wavelength solution
 
+        The result is taken from the disk cache (see pyspec.cache) if active
+
         Arguments
         ---------
         size: int
         Size of the spectrum array
         """
-        return self.wave_solution(np.arange(size))
+        cache = get_cache()
+        if cache is None:
+            return self.wave_solution(np.arange(size))
+
+        key = cache.key(
+            hashlib.sha256(self.calibration_points.tobytes()).hexdigest(),
+            "calibrate", {"size": int(size)})
+        wavelength = cache.get(key)
+        if wavelength is None:
+            wavelength = self.wave_solution(np.arange(size))
+            cache.put(key, wavelength)
+        return wavelength
+
+    def corrected(self, offset, stretch=1.0):
+        """Correct the calibration for a drift of the pixels
+
+        The calibration points are moved so that the corrected solution is the
+        composition of this solution with the drift (see pyspec.drift)
+
+        Arguments
+        ---------
+        offset: float
+        Pixel p of the new spectrum matches pixel offset + stretch * p of the
+        calibrated one
+
+        stretch: float - Default: 1.0
+        The stretch. Must be positive
+
+        Return
+        ------
+        calibration: Calibration
+        The corrected calibration
+
+        Raise
+        -----
+        CalibrationError if stretch is not positive
+        """
+        if stretch <= 0:
+            raise CalibrationError(
+                "Correct Calibration: Error: stretch must be positive")
+        calibration_points = self.calibration_points.copy()
+        calibration_points["x"] = (calibration_points["x"] - offset) / stretch
+        return Calibration(calibration_points)
 
     @classmethod
     def from_file(cls, filename):
@@ -128,3 +186,206 @@ class Calibration():
             file.write("# x wave\n")
             for item in self.calibration_points:
                 file.write(f"{item['x']} {item['wave']}\n")
+
+class IncrementalFit():
+    """Least-squares fit of the wavelength solution updated point by point
+
+    The normal equations (A^T A) c = A^T y of the polynomial fit are kept and
+    updated when points are added or removed, so refitting after each point
+    only solves a (SOLUTION_DEGREE + 1) x (SOLUTION_DEGREE + 1) system. The
+    polynomial uses the pixels scaled to [-1, 1], so that the normal equations
+    are well conditioned. With less than degree + 1 points, the degree is
+    lowered (the normal equations of a lower degree are the leading block of
+    those of the full degree)
+
+    Outliers are found from the standardized residuals in pixels: the
+    residuals divided by sqrt(1 - h), where h is the leverage of the point,
+    so that points at the edges, which pull the fit towards them, are not
+    missed. The worst point is flagged while its residual is larger than
+    OUTLIER_THRESHOLD and it is removed from the fit (downdating the normal
+    equations). Flagged points keep their plain residual with respect to the
+    fit of the other points. Points are only flagged while there are at least
+    twice as many points as coefficients: with fewer points a bad point drags
+    the fit towards it and good points look worse. A point alone at an edge of
+    the spectrum has a leverage close to 1: the fit goes through it and it
+    cannot be flagged
+
+    Methods
+    -------
+    __init__
+    __len__
+    add
+    remove
+    solve
+    update
+
+    Attributes
+    ----------
+    degree: int
+    Degree of the polynomial
+
+    points: dict
+    The calibration points in the fit. Keys are the position in pixels and
+    values are the wavelengths
+
+    size: int
+    Size of the spectrum
+
+    _normal_matrix: np.ndarray
+    The matrix A^T A
+
+    _normal_vector: np.ndarray
+    The vector A^T y
+    """
+    def __init__(self, size, degree=SOLUTION_DEGREE):
+        """Initialize instance
+
+        Arguments
+        ---------
+        size: int
+        Size of the spectrum
+
+        degree: int - Default: SOLUTION_DEGREE
+        Degree of the polynomial
+        """
+        self.size = size
+        self.degree = degree
+        self.points = {}
+        self._normal_matrix = np.zeros((degree + 1, degree + 1))
+        self._normal_vector = np.zeros(degree + 1)
+
+    def __len__(self):
+        """Number of points in the fit"""
+        return len(self.points)
+
+    def _basis(self, x_values):
+        """Evaluate the polynomial basis
+
+        Arguments
+        ---------
+        x_values: float or array of float
+        Positions in pixels
+
+        Return
+        ------
+        basis: np.ndarray
+        The powers of the scaled positions, with one row per position
+        """
+        scaled = 2 * np.asarray(x_values, dtype=float) / max(self.size - 1, 1) - 1
+        return scaled[..., np.newaxis] ** np.arange(self.degree + 1)
+
+    def add(self, x_pos, wavelength):
+        """Add a point to the fit. It replaces the point at the same position
+
+        Arguments
+        ---------
+        x_pos: int
+        Position in pixels
+
+        wavelength: float
+        Wavelength of the point
+        """
+        if x_pos in self.points:
+            self.remove(x_pos)
+        basis = self._basis(x_pos)
+        self._normal_matrix += np.outer(basis, basis)
+        self._normal_vector += basis * wavelength
+        self.points[x_pos] = wavelength
+
+    def remove(self, x_pos):
+        """Remove a point from the fit
+
+        Arguments
+        ---------
+        x_pos: int
+        Position in pixels of the point
+        """
+        wavelength = self.points.pop(x_pos)
+        basis = self._basis(x_pos)
+        self._normal_matrix -= np.outer(basis, basis)
+        self._normal_vector -= basis * wavelength
+
+    def solve(self):
+        """Solve the fit and find the outliers
+
+        Return
+        ------
+        solution: np.Polynomial or None
+        The wavelength solution, without the outliers. None if there are less
+        than two points
+
+        residuals: np.ndarray
+        Named array with one row per point, sorted by position (see
+        RESIDUALS_DTYPE): position, wavelength, residual with respect to
+        solution (in Angstroms), standardized residual (in pixels) and
+        whether it is an outlier
+        """
+        residuals = np.zeros(len(self.points), dtype=RESIDUALS_DTYPE)
+        if len(self.points) == 0:
+            return None, residuals
+        residuals["x"], residuals["wave"] = zip(*sorted(self.points.items()))
+        if len(self.points) < 2:
+            return None, residuals
+
+        basis = self._basis(residuals["x"])
+        matrix = self._normal_matrix.copy()
+        vector = self._normal_vector.copy()
+        outlier = residuals["outlier"]
+        while True:
+            num_points = np.sum(~outlier)
+            degree = min(num_points - 1, self.degree)
+            try:
+                inverse = np.linalg.inv(matrix[:degree + 1, :degree + 1])
+            except np.linalg.LinAlgError:
+                return None, residuals
+            coefficients = inverse @ vector[:degree + 1]
+            fitted = basis[:, :degree + 1] @ coefficients
+            # standardize with the diagonal of the hat matrix
+            leverage = np.einsum("ij,jk,ik->i", basis[:, :degree + 1], inverse,
+                                 basis[:, :degree + 1])
+            standardized = residuals["wave"] - fitted
+            if num_points > degree + 1:
+                standardized[~outlier] /= np.sqrt(np.clip(
+                    1 - leverage[~outlier], np.finfo(float).eps, None))
+            else:
+                # the fit goes through all the points
+                standardized[~outlier] = 0
+            # derivative of the solution (Angstroms per pixel)
+            dispersion = basis[:, :degree] @ (
+                coefficients[1:] * np.arange(1, degree + 1)
+            ) * 2 / max(self.size - 1, 1)
+            residuals["pixel_residual"] = standardized / np.where(
+                dispersion == 0, np.inf, dispersion)
+            residuals["residual"] = residuals["wave"] - fitted
+
+            # flag the worst point while the fit is redundant enough
+            candidates = np.abs(np.where(outlier, 0, residuals["pixel_residual"]))
+            worst = np.argmax(candidates)
+            if (candidates[worst] <= OUTLIER_THRESHOLD or
+                    num_points < 2 * (self.degree + 1)):
+                break
+            outlier[worst] = True
+            matrix -= np.outer(basis[worst], basis[worst])
+            vector -= basis[worst] * residuals["wave"][worst]
+
+        solution = np.polynomial.Polynomial(
+            coefficients, domain=[0, max(self.size - 1, 1)], window=[-1, 1])
+        return solution, residuals
+
+    def update(self, points):
+        """Update the fit to a new set of points
+
+        Only the points that changed are added or removed
+
+        Arguments
+        ---------
+        points: dict
+        The new calibration points. Keys are the position in pixels and values
+        are the wavelengths
+        """
+        for x_pos in list(self.points):
+            if points.get(x_pos) != self.points[x_pos]:
+                self.remove(x_pos)
+        for x_pos, wavelength in points.items():
+            if x_pos not in self.points:
+                self.add(x_pos, wavelength)
@@ -0,0 +1,360 @@
+""" Catalog of the frames of a night
+
+The catalog is a SQLite database with one row per frame: the path, the file
+size and modification time, the key header fields (see CATALOG_COLUMNS) and
+the full primary header as JSON. Scanning only reads the header blocks of each
+file (see fits_utils.read_primary_header), in parallel threads, and skips the
+files whose size and modification time did not change since the last scan,
+so rescanning a night that is still being observed only reads the new frames.
+"""
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from pyspec.errors import CatalogError, ImageError
+from pyspec.fits_utils import read_primary_header
+from pyspec.image import ACCEPTED_FORMATS
+from pyspec.instrumentation import instrument
+
+logger = logging.getLogger(__name__)
+
+# column name: (header keyword, SQLite type)
+CATALOG_COLUMNS = {
+    "object": ("OBJECT", "TEXT"),
+    "imagetyp": ("IMAGETYP", "TEXT"),
+    "exptime": ("EXPTIME", "REAL"),
+    "date_obs": ("DATE-OBS", "TEXT"),
+    "filter": ("FILTER", "TEXT"),
+    "airmass": ("AIRMASS", "REAL"),
+    "naxis1": ("NAXIS1", "INTEGER"),
+    "naxis2": ("NAXIS2", "INTEGER"),
+    "instrume": ("INSTRUME", "TEXT"),
+}
+INDEXED_COLUMNS = ["imagetyp", "object", "date_obs"]
+DEFAULT_NUM_THREADS = 8
+# rows written per transaction while scanning
+COMMIT_SIZE = 500
+
+def _read_frame(path):
+    """Read the header of a frame, catching the errors
+
+    Arguments
+    ---------
+    path: str
+    Name of the frame
+
+    Return
+    ------
+    header: dict or None
+    The primary header. None if it could not be read
+
+    error: str or None
+    The error message. None if the header was read
+    """
+    try:
+        return read_primary_header(path), None
+    except ImageError as error:
+        return None, str(error)
+
+def _column_value(header, keyword, sql_type):
+    """Convert a header value to the type of its catalog column
+
+    Arguments
+    ---------
+    header: dict
+    The primary header
+
+    keyword: str
+    The header keyword
+
+    sql_type: str
+    The SQLite type of the column
+
+    Return
+    ------
+    value: str, int, float or None
+    The value. None if the keyword is missing or has the wrong type
+    """
+    value = header.get(keyword)
+    if value is None:
+        return None
+    try:
+        if sql_type == "REAL":
+            return float(value)
+        if sql_type == "INTEGER":
+            return int(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+class FrameCatalog:
+    """ Catalog of the frames of one or more directories
+
+    Methods
+    -------
+    __init__
+    __enter__
+    __exit__
+    __len__
+    close
+    frames
+    header
+    scan
+
+    Attributes
+    ----------
+    connection: sqlite3.Connection
+    The connection to the database
+
+    filename: str
+    Name of the database
+    """
+    def __init__(self, filename):
+        """Initialize instance. Create the database if it does not exist
+
+        Arguments
+        ---------
+        filename: str
+        Name of the database (e.g. "night.sqlite")
+
+        Raise
+        -----
+        CatalogError if the database cannot be opened
+        """
+        self.filename = filename
+        try:
+            self.connection = sqlite3.connect(filename)
+            columns = ", ".join(
+                f"{column} {sql_type}"
+                for column, (_, sql_type) in CATALOG_COLUMNS.items())
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS frames (path TEXT PRIMARY KEY, "
+                f"size INTEGER, mtime_ns INTEGER, {columns}, header TEXT, "
+                "error TEXT)")
+            for column in INDEXED_COLUMNS:
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS frames_{column} "
+                    f"ON frames ({column})")
+            self.connection.commit()
+        except sqlite3.Error as error:
+            raise CatalogError(
+                f"Catalog: Could not open {filename}: {str(error)}") from error
+
+    def __enter__(self):
+        """Enter the context manager"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the catalog when leaving the context manager"""
+        self.close()
+
+    def __len__(self):
+        """Number of frames in the catalog"""
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
+
+    def frames(self, **criteria):
+        """Select frames by the values of the catalog columns
+
+        Arguments
+        ---------
+        **criteria: dict
+        Column name and value. The value can be a single value (equality) or
+        a tuple (min, max) (inclusive range; None for an open end). The frames
+        that could not be read are never selected
+
+        Return
+        ------
+        frames: list of dict
+        The selected frames, sorted by path. Each frame has the keys path,
+        size, mtime_ns and those of CATALOG_COLUMNS
+
+        Raise
+        -----
+        CatalogError if a column is not valid
+        """
+        conditions = ["error IS NULL"]
+        parameters = []
+        for column, value in criteria.items():
+            if column not in CATALOG_COLUMNS and column not in ("path", "size"):
+                raise CatalogError(
+                    f"Catalog: Unknown column {column}. Valid columns are " +
+                    ", ".join(CATALOG_COLUMNS))
+            if isinstance(value, tuple):
+                minimum, maximum = value
+                if minimum is not None:
+                    conditions.append(f"{column} >= ?")
+                    parameters.append(minimum)
+                if maximum is not None:
+                    conditions.append(f"{column} <= ?")
+                    parameters.append(maximum)
+            else:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+
+        names = ["path", "size", "mtime_ns"] + list(CATALOG_COLUMNS)
+        rows = self.connection.execute(
+            f"SELECT {', '.join(names)} FROM frames "
+            f"WHERE {' AND '.join(conditions)} ORDER BY path",
+            parameters)
+        return [dict(zip(names, row)) for row in rows]
+
+    def header(self, path):
+        """Get the full primary header of a frame
+
+        Arguments
+        ---------
+        path: str
+        Name of the frame, as stored in the catalog
+
+        Return
+        ------
+        header: dict
+        The primary header
+
+        Raise
+        -----
+        CatalogError if the frame is not in the catalog or could not be read
+        """
+        row = self.connection.execute(
+            "SELECT header, error FROM frames WHERE path = ?",
+            (os.path.abspath(path), )).fetchone()
+        if row is None:
+            raise CatalogError(f"Catalog: {path} is not in the catalog")
+        if row[1] is not None:
+            raise CatalogError(f"Catalog: {row[1]}")
+        return json.loads(row[0])
+
+    @instrument("scan")
+    def scan(self, paths, num_threads=DEFAULT_NUM_THREADS):
+        """Add the new and modified frames to the catalog
+
+        Files whose size and modification time are those of the catalog are
+        not read. Frames of the scanned directories that no longer exist are
+        removed from the catalog
+
+        Arguments
+        ---------
+        paths: list of str
+        Frames or directories containing frames
+
+        num_threads: int - Default: DEFAULT_NUM_THREADS
+        Number of threads reading headers
+
+        Return
+        ------
+        summary: dict
+        Number of frames "scanned" (read), "unchanged", "removed" and
+        "failed" (could not be read)
+        """
+        found = {}
+        scanned_dirs = []
+        for path in paths:
+            if os.path.isdir(path):
+                directory = os.path.abspath(path)
+                scanned_dirs.append(directory)
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if (entry.is_file() and any(
+                                entry.name.endswith(format_check)
+                                for format_check in ACCEPTED_FORMATS)):
+                            stat = entry.stat()
+                            found[os.path.join(directory, entry.name)] = (
+                                stat.st_size, stat.st_mtime_ns)
+            else:
+                stat = os.stat(path)
+                found[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns)
+
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.connection.execute(
+                "SELECT path, size, mtime_ns FROM frames")
+        }
+        changed = sorted(path for path, stats in found.items()
+                         if known.get(path) != stats)
+        removed = [
+            path for path in known
+            if path not in found and os.path.dirname(path) in scanned_dirs
+        ]
+
+        summary = {"scanned": len(changed),
+                   "unchanged": len(found) - len(changed),
+                   "removed": len(removed),
+                   "failed": 0}
+        insert = (
+            f"INSERT OR REPLACE INTO frames (path, size, mtime_ns, "
+            f"{', '.join(CATALOG_COLUMNS)}, header, error) VALUES "
+            f"({', '.join(['?'] * (len(CATALOG_COLUMNS) + 5))})")
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+            rows = []
+            for path, (header, error) in zip(
+                    changed, executor.map(_read_frame, changed)):
+                if error is not None:
+                    logger.warning("Could not read %s: %s", path, error)
+                    summary["failed"] += 1
+                    header = {}
+                values = [
+                    _column_value(header, keyword, sql_type)
+                    for keyword, sql_type in CATALOG_COLUMNS.values()
+                ]
+                rows.append((path, *found[path], *values,
+                             None if error else json.dumps(header), error))
+                if len(rows) == COMMIT_SIZE:
+                    with self.connection:
+                        self.connection.executemany(insert, rows)
+                    rows = []
+            with self.connection:
+                self.connection.executemany(insert, rows)
+                self.connection.executemany(
+                    "DELETE FROM frames WHERE path = ?",
+                    [(path, ) for path in removed])
+
+        logger.info(
+            "Scanned %d frames (%d unchanged, %d removed, %d failed)",
+            summary["scanned"], summary["unchanged"], summary["removed"],
+            summary["failed"])
+        return summary
+
+def main(cmdargs=None):
+    """Scan directories into a frame catalog from the command line
+
+    Arguments
+    ---------
+    cmdargs: list of str or None - Default: None
+    Command line arguments. If None, use sys.argv
+    """
+    # pylint: disable-next=import-outside-toplevel
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Catalog the headers of the frames of a night. Rescans "
+                    "only read the new and modified frames")
+    parser.add_argument("paths",
+                        nargs="+",
+                        help="Frames or directories containing frames")
+    parser.add_argument("--catalog",
+                        required=True,
+                        help="SQLite database of the catalog (created if it "
+                             "does not exist)")
+    parser.add_argument("--num-threads",
+                        type=int,
+                        default=DEFAULT_NUM_THREADS,
+                        help="Number of threads reading headers")
+    parser.add_argument("--log-level",
+                        default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level")
+    args = parser.parse_args(cmdargs)
+
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(name)s %(levelname)s: "
+                               "%(message)s")
+
+    with FrameCatalog(args.catalog) as catalog:
+        catalog.scan(args.paths, num_threads=args.num_threads)
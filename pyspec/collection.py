@@ -0,0 +1,488 @@
+""" Collection of many spectra with the same setup stored in one array """
+import json
+
+import numpy as np
+
+from pyspec.errors import SpectrumCollectionError
+from pyspec.instrumentation import add_allocation, instrument
+from pyspec.spectrum import Spectrum
+
+ACCEPTED_FORMATS = [".npz"]
+NORMALIZATION_METHODS = {
+    "max": np.nanmax,
+    "mean": np.nanmean,
+    "median": np.nanmedian,
+}
+
+class SpectrumCollection:
+    """ Many spectra with the same number of pixels
+
+    The fluxes are stored in a single 2D array (one row per spectrum), so
+    operations on all the spectra are done at once. The wavelength can be
+    shared by all the spectra (1D array) or given per spectrum (2D array)
+
+    Class methods
+    -------------
+    from_spectra
+    load
+
+    Methods
+    -------
+    __init__
+    __getitem__
+    __iter__
+    __len__
+    calibrate
+    find_redshifts
+    fit_lines
+    flux_calibrate
+    normalize
+    normalize_continuum
+    resample
+    save
+
+    Properties
+    ----------
+    nbytes
+    shared_wavelength
+
+    Attributes
+    ----------
+    flux: array of float
+    The fluxes. One row per spectrum
+
+    names: list of str
+    The name of each spectrum
+
+    sources: list of dict or None
+    The provenance of each spectrum (see Spectrum.source)
+
+    wavelength: array of float or None
+    The wavelength. A 1D array if shared by all spectra, a 2D array with the
+    shape of flux otherwise. None if the spectra are not calibrated
+    """
+    def __init__(self, flux, wavelength=None, names=None, sources=None):
+        """Initialize instance
+
+        Arguments
+        ---------
+        flux: array of float
+        The fluxes. One row per spectrum
+
+        wavelength: array of float or None - Default: None
+        The wavelength. A 1D array shared by all spectra or a 2D array with
+        the shape of flux. None if the spectra are not calibrated
+
+        names: list of str or None - Default: None
+        The name of each spectrum. If None, "spectrum<index>.dat"
+
+        sources: list of dict or None - Default: None
+        The provenance of each spectrum. If None, no provenance
+
+        Raise
+        -----
+        SpectrumCollectionError if the shapes are not consistent
+        """
+        self.flux = np.asarray(flux)
+        if self.flux.ndim != 2:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: 'flux' must be a 2D array. Found shape "
+                f"{self.flux.shape}")
+        if wavelength is not None:
+            wavelength = np.asarray(wavelength)
+            if wavelength.shape not in (self.flux.shape[1:], self.flux.shape):
+                raise SpectrumCollectionError(
+                    "SpectrumCollection: 'wavelength' shape "
+                    f"{wavelength.shape} does not match 'flux' shape "
+                    f"{self.flux.shape}")
+        self.wavelength = wavelength
+        if names is None:
+            names = [f"spectrum{index}.dat" for index in range(len(self))]
+        if sources is None:
+            sources = [None] * len(self)
+        if len(names) != len(self) or len(sources) != len(self):
+            raise SpectrumCollectionError(
+                "SpectrumCollection: 'names' and 'sources' must have one entry "
+                "per spectrum")
+        self.names = list(names)
+        self.sources = list(sources)
+
+    def __getitem__(self, index):
+        """Get a spectrum
+
+        The flux (and wavelength) of the spectrum are views of the collection
+        arrays
+
+        Arguments
+        ---------
+        index: int
+        Index of the spectrum
+
+        Return
+        ------
+        spectrum: Spectrum
+        The spectrum
+        """
+        wavelength = self.wavelength
+        if wavelength is not None and not self.shared_wavelength:
+            wavelength = wavelength[index]
+        return Spectrum(self.flux[index], wavelength, self.names[index],
+                        self.sources[index])
+
+    def __iter__(self):
+        """Iterate over the spectra (see __getitem__)"""
+        return (self[index] for index in range(len(self)))
+
+    def __len__(self):
+        """Number of spectra"""
+        return self.flux.shape[0]
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the fluxes and wavelengths"""
+        nbytes = self.flux.nbytes
+        if self.wavelength is not None:
+            nbytes += self.wavelength.nbytes
+        return nbytes
+
+    @property
+    def shared_wavelength(self):
+        """True if all the spectra share the same wavelength array"""
+        return self.wavelength is not None and self.wavelength.ndim == 1
+
+    @instrument("SpectrumCollection.calibrate")
+    def calibrate(self, calibration):
+        """Apply a wavelength solution to all the spectra
+
+        Arguments
+        ---------
+        calibration: Calibration
+        The wavelength solution. The same solution is shared by all the spectra
+        """
+        self.wavelength = calibration.calibrate(self.flux.shape[1])
+
+    @classmethod
+    def from_spectra(cls, spectra):
+        """Gather many spectra into a collection
+
+        The fluxes and wavelengths are copied into the collection arrays
+
+        Arguments
+        ---------
+        spectra: list of Spectrum
+        The spectra. Must have the same number of pixels
+
+        Return
+        ------
+        collection: SpectrumCollection
+        The initialized collection
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra have different sizes or only
+        some of them are calibrated
+        """
+        if len(spectra) == 0:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Cannot create an empty collection")
+        sizes = {spectrum.flux.size for spectrum in spectra}
+        if len(sizes) > 1:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: All spectra must have the same number of "
+                f"pixels. Found sizes {sorted(sizes)}")
+        calibrated = {spectrum.wavelength is not None for spectrum in spectra}
+        if len(calibrated) > 1:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Either all or none of the spectra must be "
+                "calibrated")
+
+        flux = np.stack([spectrum.flux for spectrum in spectra])
+        add_allocation(flux)
+        wavelength = None
+        if calibrated == {True}:
+            wavelength = np.stack([spectrum.wavelength for spectrum in spectra])
+            if np.all(wavelength == wavelength[0]):
+                wavelength = wavelength[0].copy()
+        return cls(flux, wavelength, [spectrum.name for spectrum in spectra],
+                   [spectrum.source for spectrum in spectra])
+
+    @classmethod
+    @instrument("SpectrumCollection.load")
+    def load(cls, filename):
+        """Load a collection saved with save
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Return
+        ------
+        collection: SpectrumCollection
+        The loaded collection
+
+        Raise
+        -----
+        SpectrumCollectionError if the file cannot be read
+        """
+        try:
+            with np.load(filename) as arrays:
+                flux = arrays["flux"]
+                wavelength = arrays.get("wavelength")
+                metadata = json.loads(str(arrays["metadata"]))
+        except (IOError, KeyError, ValueError) as error:
+            raise SpectrumCollectionError(
+                f"SpectrumCollection: Error reading {filename}: {str(error)}"
+                ) from error
+        sources = [
+            None if source is None else {
+                **source,
+                "operations": tuple(
+                    tuple(operation) for operation in source["operations"]),
+            }
+            for source in metadata["sources"]
+        ]
+        return cls(flux, wavelength, metadata["names"], sources)
+
+    @instrument("SpectrumCollection.normalize")
+    def normalize(self, method="median"):
+        """Divide each spectrum by a statistic of its flux
+
+        Arguments
+        ---------
+        method: str - Default: "median"
+        The statistic. One of NORMALIZATION_METHODS
+
+        Return
+        ------
+        norms: array of float
+        The statistic of each spectrum
+
+        Raise
+        -----
+        SpectrumCollectionError if the method is not valid
+        """
+        if method not in NORMALIZATION_METHODS:
+            raise SpectrumCollectionError(
+                f"SpectrumCollection: Unknown normalization method {method}. "
+                "Valid methods are " + ", ".join(NORMALIZATION_METHODS))
+        norms = NORMALIZATION_METHODS[method](self.flux, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.flux = self.flux / norms[:, np.newaxis]
+        return norms
+
+    def find_redshifts(self, templates, **kwargs):
+        """Find the redshift and the best template of all the spectra at once
+
+        See redshift.find_redshifts
+
+        Arguments
+        ---------
+        templates: TemplateSet
+        The templates
+
+        **kwargs: dict
+        Other arguments of redshift.find_redshifts (z_min, z_max, log_step
+        and weights)
+
+        Return
+        ------
+        results: structured array
+        The redshift, its uncertainty and the best template of each spectrum
+        (see redshift.REDSHIFT_DTYPE)
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra are not calibrated
+        """
+        if self.wavelength is None:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Cannot find the redshifts of uncalibrated "
+                "spectra")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.redshift import find_redshifts
+        return find_redshifts(self.flux, self.wavelength, templates, **kwargs)
+
+    def fit_lines(self, centres, **kwargs):
+        """Fit the profiles of several lines in all the spectra
+
+        All the lines of all the spectra are fitted together (see
+        line_fitting.fit_lines)
+
+        Arguments
+        ---------
+        centres: array of float
+        Expected centre of each line, in wavelength
+
+        **kwargs: dict
+        Other arguments of line_fitting.fit_lines (profile, half_window,
+        sigma, max_iterations and tolerance)
+
+        Return
+        ------
+        results: structured array
+        The fitted lines (see line_fitting.LINE_FIT_DTYPE). One row per
+        spectrum and one column per line
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra are not calibrated
+        """
+        if self.wavelength is None:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Cannot fit lines of uncalibrated spectra")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.line_fitting import fit_lines
+        return fit_lines(self.flux, self.wavelength, centres, **kwargs)
+
+    @instrument("SpectrumCollection.flux_calibrate")
+    def flux_calibrate(self, sensitivity, exptime=None, airmass=None):
+        """Convert the fluxes of all the spectra into flux densities at once
+
+        Arguments
+        ---------
+        sensitivity: SensitivityFunction
+        The sensitivity function (see pyspec.flux_calibration)
+
+        exptime: array of float or None - Default: None
+        Exposure time of each spectrum in seconds. If None, the EXPTIME
+        keyword of the source frames
+
+        airmass: array of float or None - Default: None
+        Airmass of each spectrum. If None, the AIRMASS keyword of the source
+        frames
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra are not calibrated
+        SpectrumCollectionError if the exposure times or the airmasses are not
+        known
+        """
+        if self.wavelength is None:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Cannot flux calibrate uncalibrated "
+                "spectra")
+        if exptime is None or airmass is None:
+            headers = [spectrum.read_source_header() or {} for spectrum in self]
+            if exptime is None:
+                exptime = [header.get("EXPTIME") for header in headers]
+            if airmass is None:
+                airmass = [header.get("AIRMASS") for header in headers]
+        if any(value is None for value in list(exptime) + list(airmass)):
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Exposure times and airmasses are needed "
+                "to flux calibrate")
+        self.flux = sensitivity.calibrate(
+            self.flux, self.wavelength, exptime, airmass).astype(
+                self.flux.dtype, copy=False)
+
+    @instrument("SpectrumCollection.normalize_continuum")
+    def normalize_continuum(self, masked_ranges=None, **kwargs):
+        """Divide each spectrum by its continuum
+
+        The continua of all the spectra are fitted at once (see
+        continuum.fit_continuum)
+
+        Arguments
+        ---------
+        masked_ranges: list of (float, float) or None - Default: None
+        Ranges excluded from the fit, in wavelength if the spectra are
+        calibrated or in pixels otherwise
+
+        **kwargs: dict
+        Other arguments of continuum.fit_continuum (model, num_coefficients,
+        sigma_lower, sigma_upper and max_iterations)
+
+        Return
+        ------
+        continuum: array of float
+        The continuum of each spectrum. One row per spectrum
+
+        Raise
+        -----
+        SpectrumError if the continua cannot be fitted
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.continuum import fit_continuum
+        continuum, _ = fit_continuum(self.flux, self.wavelength, masked_ranges,
+                                     **kwargs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.flux = (self.flux / continuum).astype(self.flux.dtype,
+                                                       copy=False)
+        return continuum
+
+    @instrument("SpectrumCollection.resample")
+    def resample(self, wavelength):
+        """Linearly interpolate all the spectra into a common wavelength grid
+
+        Pixels outside the wavelength range of a spectrum are set to nan
+
+        Arguments
+        ---------
+        wavelength: array of float
+        The new wavelength grid. Must be increasing
+
+        Return
+        ------
+        collection: SpectrumCollection
+        The resampled spectra, sharing the new wavelength grid
+
+        Raise
+        -----
+        SpectrumCollectionError if the spectra are not calibrated
+        """
+        if self.wavelength is None:
+            raise SpectrumCollectionError(
+                "SpectrumCollection: Cannot resample uncalibrated spectra")
+        wavelength = np.asarray(wavelength, dtype=float)
+
+        if self.shared_wavelength:
+            # the interpolation weights are computed once for all the spectra
+            old = self.wavelength
+            right = np.clip(np.searchsorted(old, wavelength), 1, old.size - 1)
+            weight = ((wavelength - old[right - 1]) /
+                      (old[right] - old[right - 1])).astype(self.flux.dtype)
+            # in place, so that only the two gathered arrays are allocated
+            flux = self.flux[:, right - 1]
+            flux *= 1.0 - weight
+            right_flux = self.flux[:, right]
+            right_flux *= weight
+            flux += right_flux
+            flux[:, (wavelength < old[0]) | (wavelength > old[-1])] = np.nan
+        else:
+            flux = np.stack([
+                np.interp(wavelength, row_wavelength, row_flux,
+                          left=np.nan, right=np.nan)
+                for row_wavelength, row_flux in zip(self.wavelength, self.flux)
+            ])
+        add_allocation(flux)
+
+        return SpectrumCollection(flux, wavelength, self.names, self.sources)
+
+    @instrument("SpectrumCollection.save")
+    def save(self, filename):
+        """Save the collection in a single file
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Raise
+        -----
+        SpectrumCollectionError if the filename does not have the correct format
+        """
+        if not any(filename.endswith(format_check)
+                   for format_check in ACCEPTED_FORMATS):
+            raise SpectrumCollectionError(
+                "SpectrumCollection: 'filename' has incorrect extension. Valid "
+                "extensions are " + ", ".join(ACCEPTED_FORMATS))
+
+        arrays = {"flux": self.flux}
+        if self.wavelength is not None:
+            arrays["wavelength"] = self.wavelength
+        arrays["metadata"] = np.array(json.dumps({
+            "names": self.names,
+            "sources": self.sources,
+        }))
+        np.savez(filename, **arrays)
@@ -0,0 +1,183 @@
+""" Continuum fitting of one spectrum or a stack of spectra
+
+The continuum is a linear combination of basis functions of the pixel
+position: Legendre polynomials or cubic B-splines with uniformly spaced knots.
+All the spectra of a stack share the same basis, so each iteration of the fit
+solves the weighted normal equations of all the spectra at once:
+- the normal matrices of all the spectra are a single matrix product of the
+  weights and the pairwise products of the basis functions
+- the coefficients come from a single batched np.linalg.solve
+
+Pixels in masked wavelength ranges (e.g. known lines) and non-finite pixels are
+never used. Pixels further than sigma_lower (sigma_upper) times the residual
+dispersion below (above) the continuum are rejected and the fit is repeated
+until no pixel changes or max_iterations is reached.
+"""
+import numpy as np
+
+from pyspec.errors import SpectrumError
+from pyspec.instrumentation import instrument
+
+CONTINUUM_MODELS = ["spline", "polynomial"]
+DEFAULT_CONTINUUM_MODEL = "spline"
+DEFAULT_NUM_COEFFICIENTS = 8
+DEFAULT_SIGMA_LOWER = 2.0
+DEFAULT_SIGMA_UPPER = 3.0
+DEFAULT_MAX_ITERATIONS = 10
+SPLINE_DEGREE = 3
+
+def continuum_basis(size, model=DEFAULT_CONTINUUM_MODEL,
+                    num_coefficients=DEFAULT_NUM_COEFFICIENTS):
+    """Compute the basis functions of the continuum
+
+    Arguments
+    ---------
+    size: int
+    Number of pixels of the spectra
+
+    model: str - Default: DEFAULT_CONTINUUM_MODEL
+    "polynomial" for Legendre polynomials or "spline" for cubic B-splines
+
+    num_coefficients: int - Default: DEFAULT_NUM_COEFFICIENTS
+    Number of basis functions (polynomial order + 1, or number of splines)
+
+    Return
+    ------
+    basis: array of float
+    The basis functions evaluated at each pixel (one column per function)
+
+    Raise
+    -----
+    SpectrumError if the model is not valid
+    SpectrumError if there are too many or too few coefficients
+    """
+    if model not in CONTINUUM_MODELS:
+        raise SpectrumError(
+            f"Spectrum: Unknown continuum model {model}. Valid models are " +
+            ", ".join(CONTINUUM_MODELS))
+    min_coefficients = SPLINE_DEGREE + 1 if model == "spline" else 1
+    if not min_coefficients <= num_coefficients <= size:
+        raise SpectrumError(
+            f"Spectrum: The continuum needs between {min_coefficients} and "
+            f"{size} coefficients. Found {num_coefficients}")
+
+    if model == "polynomial":
+        return np.polynomial.legendre.legvander(
+            np.linspace(-1.0, 1.0, size), num_coefficients - 1)
+
+    # scipy is imported on first use to keep the application start-up fast
+    # pylint: disable-next=import-outside-toplevel
+    from scipy.interpolate import BSpline
+
+    pixels = np.arange(size, dtype=float)
+    interior = np.linspace(
+        0.0, size - 1.0, num_coefficients - SPLINE_DEGREE + 1)[1:-1]
+    knots = np.concatenate(([0.0] * (SPLINE_DEGREE + 1), interior,
+                            [size - 1.0] * (SPLINE_DEGREE + 1)))
+    return BSpline.design_matrix(pixels, knots, SPLINE_DEGREE).toarray()
+
+@instrument("fit_continuum")
+# pylint: disable-next=too-many-arguments,too-many-locals
+def fit_continuum(flux, wavelength=None, masked_ranges=None,
+                  model=DEFAULT_CONTINUUM_MODEL,
+                  num_coefficients=DEFAULT_NUM_COEFFICIENTS,
+                  sigma_lower=DEFAULT_SIGMA_LOWER,
+                  sigma_upper=DEFAULT_SIGMA_UPPER,
+                  max_iterations=DEFAULT_MAX_ITERATIONS):
+    """Fit the continuum of one spectrum or a stack of spectra
+
+    Arguments
+    ---------
+    flux: array of float
+    The flux of one spectrum (1D) or of a stack of spectra (2D, one row per
+    spectrum)
+
+    wavelength: array of float or None - Default: None
+    The wavelength, shared (1D) or one row per spectrum (2D). If None,
+    masked_ranges are in pixels
+
+    masked_ranges: list of (float, float) or None - Default: None
+    Wavelength ranges (or pixel ranges if wavelength is None) excluded from
+    the fit, e.g. the lines of the spectra
+
+    model: str - Default: DEFAULT_CONTINUUM_MODEL
+    "polynomial" or "spline" (see continuum_basis)
+
+    num_coefficients: int - Default: DEFAULT_NUM_COEFFICIENTS
+    Number of basis functions
+
+    sigma_lower: float - Default: DEFAULT_SIGMA_LOWER
+    Pixels more than sigma_lower times the residual dispersion below the
+    continuum are rejected
+
+    sigma_upper: float - Default: DEFAULT_SIGMA_UPPER
+    Pixels more than sigma_upper times the residual dispersion above the
+    continuum are rejected
+
+    max_iterations: int - Default: DEFAULT_MAX_ITERATIONS
+    Maximum number of rejection iterations
+
+    Return
+    ------
+    continuum: array of float
+    The continuum, with the same shape as flux
+
+    used: array of bool
+    True for the pixels used in the final fit, with the same shape as flux
+
+    Raise
+    -----
+    SpectrumError if the model or the number of coefficients are not valid
+    SpectrumError if a spectrum does not have enough pixels to fit
+    """
+    flux_2d = np.atleast_2d(flux).astype(np.float64, copy=False)
+    basis = continuum_basis(flux_2d.shape[1], model, num_coefficients)
+    # products of all the pairs of basis functions: the normal matrices are
+    # weights @ products
+    products = (basis[:, :, np.newaxis] * basis[:, np.newaxis, :]).reshape(
+        basis.shape[0], -1)
+
+    valid = np.isfinite(flux_2d)
+    if masked_ranges:
+        positions = (np.arange(flux_2d.shape[1]) if wavelength is None
+                     else np.asarray(wavelength))
+        for start, end in masked_ranges:
+            valid &= ~((positions >= min(start, end)) &
+                       (positions <= max(start, end)))
+    flux_2d = np.where(valid, flux_2d, 0.0)
+
+    if np.any(valid.sum(axis=1) <= num_coefficients):
+        raise SpectrumError(
+            "Spectrum: Not enough pixels to fit the continuum. Reduce the "
+            "number of coefficients or the masked ranges")
+
+    used = valid
+    for _ in range(max(max_iterations, 1)):
+        weights = used.astype(np.float64)
+        num_used = weights.sum(axis=1)
+        normal_matrices = (weights @ products).reshape(
+            -1, num_coefficients, num_coefficients)
+        projections = (weights * flux_2d) @ basis
+        try:
+            coefficients = np.linalg.solve(
+                normal_matrices, projections[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError as error:
+            raise SpectrumError(
+                "Spectrum: The continuum fit is singular. Reduce the number "
+                "of coefficients or the masked ranges") from error
+        continuum = coefficients @ basis.T
+
+        residuals = flux_2d - continuum
+        dispersion = np.sqrt(
+            (weights * residuals**2).sum(axis=1) /
+            (num_used - num_coefficients))[:, np.newaxis]
+        new_used = (valid & (residuals >= -sigma_lower * dispersion) &
+                    (residuals <= sigma_upper * dispersion))
+        if (np.array_equal(new_used, used) or
+                np.any(new_used.sum(axis=1) <= num_coefficients)):
+            break
+        used = new_used
+
+    if np.ndim(flux) == 1:
+        return continuum[0], used[0]
+    return continuum, used
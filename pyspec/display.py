@@ -0,0 +1,182 @@
+""" Display levels of images
+
+The levels are computed from a fixed-size strided sample of the pixels, so
+their cost does not depend on the image size, and ignore the outliers (hot
+pixels, cosmic rays, saturated stars) that make min/max levels unusable:
+- "zscale": the IRAF zscale algorithm. A line is fitted to the sorted sample
+  around its median, rejecting outliers, and the levels are the values of the
+  line at both ends divided by the contrast
+- "percentile": the lower and upper percentiles of the sample
+"""
+import math
+
+import numpy as np
+
+from pyspec.errors import ImageError
+
+LEVELS_METHODS = ["zscale", "percentile"]
+DEFAULT_LEVELS_METHOD = "zscale"
+DEFAULT_SAMPLE_SIZE = 10000  # in pixels
+# zscale parameters (as in IRAF)
+ZSCALE_CONTRAST = 0.25
+ZSCALE_REJECTION = 2.5  # in units of the residual dispersion
+ZSCALE_MAX_ITERATIONS = 5
+ZSCALE_MIN_FRACTION = 0.5  # minimum fraction of pixels kept in the fit
+# fraction of the pixels rejected around each outlier
+ZSCALE_GROW_FRACTION = 0.01
+# percentile parameters
+LOWER_PERCENTILE = 0.5
+UPPER_PERCENTILE = 99.5
+
+def sample_pixels(data, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Get a strided sample of the pixels of an image
+
+    Rows and columns are sampled with the same step, so the sample covers the
+    whole image
+
+    Arguments
+    ---------
+    data: array
+    The image data
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels of the sample
+
+    Return
+    ------
+    sample: array of float
+    The finite sampled pixels (1D)
+    """
+    step = max(int(math.sqrt(data.size / sample_size)), 1)
+    sample = np.asarray(data[::step, ::step], dtype=np.float64).ravel()
+    return sample[np.isfinite(sample)]
+
+def _level_range(lower, upper):
+    """Make sure that the display levels are not degenerate
+
+    Arguments
+    ---------
+    lower: float
+    The lower level
+
+    upper: float
+    The upper level
+
+    Return
+    ------
+    levels: (float, float)
+    The levels. (lower, lower + 1) if upper is not larger than lower (e.g.
+    for constant images)
+    """
+    if upper <= lower:
+        return float(lower), float(lower) + 1.0
+    return float(lower), float(upper)
+
+def zscale_levels(sample, contrast=ZSCALE_CONTRAST):
+    """Compute the zscale levels of a sample of pixels
+
+    Arguments
+    ---------
+    sample: array of float
+    The pixels (see sample_pixels)
+
+    contrast: float - Default: ZSCALE_CONTRAST
+    Contrast. Smaller values give wider levels
+
+    Return
+    ------
+    levels: (float, float)
+    The lower and upper levels. The upper level is always larger
+    """
+    sample = np.sort(sample)
+    num_pixels = sample.size
+    if num_pixels == 0:
+        return 0.0, 1.0
+    minimum, maximum = sample[0], sample[-1]
+    center = (num_pixels - 1) // 2
+    median = (sample[center] if num_pixels % 2 == 1 else
+              0.5 * (sample[center] + sample[center + 1]))
+
+    # fit a line to the sorted sample, rejecting the outliers and their
+    # neighbours
+    x_values = np.arange(num_pixels, dtype=np.float64)
+    min_pixels = max(int(num_pixels * ZSCALE_MIN_FRACTION), 5)
+    grow_kernel = np.ones(max(int(num_pixels * ZSCALE_GROW_FRACTION), 1))
+    used = np.ones(num_pixels, dtype=bool)
+    slope = 0.0
+    for _ in range(ZSCALE_MAX_ITERATIONS):
+        num_used = used.sum()
+        slope, intercept = np.polyfit(x_values[used], sample[used], 1)
+        residuals = sample - (intercept + slope * x_values)
+        threshold = ZSCALE_REJECTION * np.std(residuals[used])
+        rejected = ~used | (np.abs(residuals) > threshold)
+        used = np.convolve(rejected, grow_kernel, mode="same") == 0
+        if used.sum() >= num_used or used.sum() < min_pixels:
+            break
+
+    if used.sum() < min_pixels:
+        return _level_range(minimum, maximum)
+    if contrast > 0:
+        slope /= contrast
+    lower = max(minimum, median - (center - 1) * slope)
+    upper = min(maximum, median + (num_pixels - center) * slope)
+    if upper <= lower:
+        return _level_range(minimum, maximum)
+    return float(lower), float(upper)
+
+def percentile_levels(sample, lower=LOWER_PERCENTILE, upper=UPPER_PERCENTILE):
+    """Compute the percentile levels of a sample of pixels
+
+    Arguments
+    ---------
+    sample: array of float
+    The pixels (see sample_pixels)
+
+    lower: float - Default: LOWER_PERCENTILE
+    Percentile of the lower level
+
+    upper: float - Default: UPPER_PERCENTILE
+    Percentile of the upper level
+
+    Return
+    ------
+    levels: (float, float)
+    The lower and upper levels. The upper level is always larger
+    """
+    if sample.size == 0:
+        return 0.0, 1.0
+    lower_level, upper_level = np.percentile(sample, [lower, upper])
+    return _level_range(lower_level, upper_level)
+
+def display_levels(data, method=DEFAULT_LEVELS_METHOD,
+                   sample_size=DEFAULT_SAMPLE_SIZE):
+    """Compute the display levels of an image
+
+    Arguments
+    ---------
+    data: array
+    The image data
+
+    method: str - Default: DEFAULT_LEVELS_METHOD
+    "zscale" or "percentile"
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels used
+
+    Return
+    ------
+    levels: (float, float)
+    The lower and upper levels
+
+    Raise
+    -----
+    ImageError if the method is not valid
+    """
+    if method not in LEVELS_METHODS:
+        raise ImageError(
+            f"Image: Unknown levels method {method}. Valid methods are " +
+            ", ".join(LEVELS_METHODS))
+    sample = sample_pixels(data, sample_size)
+    if method == "zscale":
+        return zscale_levels(sample)
+    return percentile_levels(sample)
@@ -0,0 +1,207 @@
+""" Drift of the wavelength solution between arcs
+
+The drift of a new arc with respect to the reference arc of a Calibration is
+measured by FFT cross-correlation of the two arcs, so updating a solution takes
+milliseconds instead of a new calibration session. The drift maps each pixel p
+of the new arc to the pixel offset + stretch * p of the reference arc:
+- offset: the peak of the cross-correlation of the whole arcs
+- stretch: from the shifts of NUM_SEGMENTS segments of the new arc, searched
+  around the global shift. A line is fitted to the shifts against the
+  positions of the segments
+"""
+import logging
+
+import numpy as np
+
+from pyspec.errors import CalibrationError
+from pyspec.instrumentation import instrument
+
+logger = logging.getLogger(__name__)
+
+# fraction of the arc tapered at each edge
+TAPER_FRACTION = 0.05
+# minimum normalized cross-correlation peak of matching arcs
+MIN_CORRELATION = 0.5
+NUM_SEGMENTS = 4
+SEGMENT_SEARCH_RADIUS = 10  # in pixels
+
+def _prepare(flux):
+    """Prepare an arc for the cross-correlation
+
+    The background is subtracted, only the emission is kept and the edges are
+    tapered
+
+    Arguments
+    ---------
+    flux: array of float
+    The arc
+
+    Return
+    ------
+    flux: array of float
+    The prepared arc
+    """
+    flux = np.nan_to_num(np.asarray(flux, dtype=np.float64))
+    flux = np.clip(flux - np.median(flux), 0, None)
+    taper_size = int(flux.size * TAPER_FRACTION)
+    if taper_size > 0:
+        taper = 0.5 * (1 - np.cos(np.pi * np.arange(taper_size) / taper_size))
+        flux[:taper_size] *= taper
+        flux[-taper_size:] *= taper[::-1]
+    return flux
+
+def _correlation_peak(reference_fft, flux, size, min_lag, max_lag):
+    """Find the peak of the cross-correlation of two arcs
+
+    Arguments
+    ---------
+    reference_fft: array of complex
+    Real FFT of the prepared reference arc, with size points
+
+    flux: array of float
+    The prepared new arc
+
+    size: int
+    Size of the FFTs. At least the sum of the sizes of the arcs so that the
+    correlation does not wrap around
+
+    min_lag: int
+    Minimum lag searched
+
+    max_lag: int
+    Maximum lag searched
+
+    Return
+    ------
+    lag: float
+    The lag of the peak, with sub-pixel precision. Pixel p of the new arc
+    matches pixel p + lag of the reference arc
+
+    value: float
+    The cross-correlation at the peak
+    """
+    correlation = np.fft.irfft(
+        reference_fft * np.conj(np.fft.rfft(flux, size)), size)
+    lags = np.arange(min_lag, max_lag + 1)
+    values = correlation[lags % size]
+    peak = int(np.argmax(values))
+    lag = float(lags[peak])
+    if 0 < peak < values.size - 1:
+        # parabola through the peak and its neighbours
+        curvature = values[peak - 1] - 2 * values[peak] + values[peak + 1]
+        if curvature < 0:
+            lag += 0.5 * (values[peak - 1] - values[peak + 1]) / curvature
+    return lag, values[peak]
+
+@instrument("measure_drift")
+def measure_drift(reference_flux, flux, stretch=False, max_shift=None):
+    """Measure the drift of an arc with respect to a reference arc
+
+    Arguments
+    ---------
+    reference_flux: array of float
+    The reference arc
+
+    flux: array of float
+    The new arc
+
+    stretch: bool - Default: False
+    If True, also measure the stretch. Otherwise it is 1
+
+    max_shift: float or None - Default: None
+    Maximum shift searched, in pixels. If None, all the shifts with some
+    overlap of the arcs
+
+    Return
+    ------
+    offset: float
+    Pixel p of the new arc matches pixel offset + stretch * p of the
+    reference arc
+
+    stretch: float
+    The stretch
+
+    Raise
+    -----
+    CalibrationError if the arcs do not match
+    """
+    reference_flux = _prepare(reference_flux)
+    flux = _prepare(flux)
+    reference_norm = np.sqrt(np.sum(reference_flux**2))
+    norm = np.sqrt(np.sum(flux**2))
+    if reference_norm == 0 or norm == 0:
+        raise CalibrationError("Arc drift: Error: an arc has no lines")
+
+    size = 1 << int(reference_flux.size + flux.size - 1).bit_length()
+    reference_fft = np.fft.rfft(reference_flux, size)
+    min_lag, max_lag = -(flux.size - 1), reference_flux.size - 1
+    if max_shift is not None:
+        min_lag = max(min_lag, -int(np.ceil(max_shift)))
+        max_lag = min(max_lag, int(np.ceil(max_shift)))
+    shift, value = _correlation_peak(
+        reference_fft, flux, size, min_lag, max_lag)
+    if value / (reference_norm * norm) < MIN_CORRELATION:
+        raise CalibrationError(
+            "Arc drift: Error: the arcs do not match (correlation "
+            f"{value / (reference_norm * norm):.2f})")
+    if not stretch:
+        return float(shift), 1.0
+
+    # shifts of the segments of the new arc
+    pixels = np.arange(flux.size)
+    centers = []
+    shifts = []
+    weights = []
+    for segment_pixels in np.array_split(pixels, NUM_SEGMENTS):
+        segment = np.zeros_like(flux)
+        segment[segment_pixels] = flux[segment_pixels]
+        segment_norm = np.sqrt(np.sum(segment**2))
+        if segment_norm == 0:
+            continue
+        segment_shift, value = _correlation_peak(
+            reference_fft, segment, size,
+            int(shift) - SEGMENT_SEARCH_RADIUS,
+            int(shift) + SEGMENT_SEARCH_RADIUS)
+        if value / (reference_norm * segment_norm) <= 0:
+            continue
+        centers.append(np.sum(pixels * segment) / np.sum(segment))
+        shifts.append(segment_shift)
+        weights.append(value / (reference_norm * segment_norm))
+    if len(shifts) < 2:
+        logger.warning("Arc drift: not enough lines to measure the stretch")
+        return float(shift), 1.0
+
+    # shift(p) = offset + (stretch - 1) * p
+    slope, offset = np.polyfit(centers, shifts, 1, w=np.sqrt(weights))
+    return float(offset), float(1 + slope)
+
+def track_drift(calibration, reference_flux, flux, stretch=False):
+    """Correct a calibration for the drift of a new arc
+
+    Arguments
+    ---------
+    calibration: Calibration
+    Calibration of the reference arc
+
+    reference_flux: array of float
+    The reference arc
+
+    flux: array of float
+    The new arc
+
+    stretch: bool - Default: False
+    If True, also correct the stretch
+
+    Return
+    ------
+    calibration: Calibration
+    Calibration of the new arc
+
+    Raise
+    -----
+    CalibrationError if the arcs do not match
+    """
+    offset, stretch = measure_drift(reference_flux, flux, stretch=stretch)
+    logger.info("Arc drift: offset %+.3f pixels, stretch %.6f", offset,
+                stretch)
+    return calibration.corrected(offset, stretch)
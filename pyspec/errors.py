@@ -15,3 +15,53 @@ class SpectrumError(Exception):
     """
         Exceptions occurred in class Spectrum
     """
+
+class WorkspaceError(Exception):
+    """
+        Exceptions occurred in class Workspace
+    """
+
+class HistoryError(Exception):
+    """
+        Exceptions occurred in class History
+    """
+
+class SessionError(Exception):
+    """
+        Exceptions occurred when saving or loading a session
+    """
+
+class CacheError(Exception):
+    """
+        Exceptions occurred in class ResultCache
+    """
+
+class SpectrumCollectionError(Exception):
+    """
+        Exceptions occurred in class SpectrumCollection
+    """
+
+class ArchiveError(Exception):
+    """
+        Exceptions occurred in class SpectralArchive
+    """
+
+class FluxCalibrationError(Exception):
+    """
+        Exceptions occurred in class SensitivityFunction
+    """
+
+class CatalogError(Exception):
+    """
+        Exceptions occurred in class FrameCatalog
+    """
+
+class PrecisionError(Exception):
+    """
+        Exceptions occurred when setting the working precision
+    """
+
+class LineAtlasError(Exception):
+    """
+        Exceptions occurred in class LineAtlas
+    """
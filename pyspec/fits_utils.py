@@ -0,0 +1,495 @@
+""" Access to the image data of FITS files
+
+Supports files with the data in an extension, data cubes (only the selected
+plane is read) and multi-amplifier frames, which are assembled into a single
+mosaic from the DATASEC and DETSEC keywords of each amplifier.
+
+The functions work on opened HDU lists (see astropy.io.fits.open), except
+list_image_hdus, read_primary_header, memmap_primary_data and
+read_primary_rows, which open the file themselves. The last three do not use
+astropy: they read and parse only the header blocks, which is much faster when
+scanning many files.
+"""
+import gzip
+import re
+
+import numpy as np
+
+from pyspec.errors import ImageError
+
+CARD_SIZE = 80  # in bytes
+FITS_BLOCK_SIZE = 2880  # in bytes
+MAX_HEADER_BLOCKS = 1000  # headers longer than this are considered corrupted
+# data types of the BITPIX values (FITS data are big-endian)
+BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4",
+                 -64: ">f8"}
+SECTION_REGEX = re.compile(
+    r"^\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]$")
+
+def assemble_mosaic(hdus):
+    """Assemble the data of the amplifiers of a frame into a mosaic
+
+    The data section of each amplifier (DATASEC) is copied into its place in
+    the detector (DETSEC), flipping it if the two sections have different
+    orientations. Overscan regions are dropped.
+
+    Arguments
+    ---------
+    hdus: list of astropy.io.fits.ImageHDU
+    The amplifiers
+
+    Return
+    ------
+    mosaic: array of float
+    The assembled data
+
+    Raise
+    -----
+    ImageError if the sections are missing, malformed or inconsistent
+    """
+    placements = []
+    for hdu in hdus:
+        data_slices, data_flips = parse_section(_keyword(hdu, "DATASEC"))
+        det_slices, det_flips = parse_section(_keyword(hdu, "DETSEC"))
+        data_shape = tuple(item.stop - item.start for item in data_slices)
+        det_shape = tuple(item.stop - item.start for item in det_slices)
+        if data_shape != det_shape:
+            raise ImageError(
+                f"Image: DATASEC {hdu.header['DATASEC']} and DETSEC "
+                f"{hdu.header['DETSEC']} have different sizes")
+        flips = tuple(
+            slice(None, None, -1) if data_flip != det_flip else slice(None)
+            for data_flip, det_flip in zip(data_flips, det_flips))
+        placements.append((hdu, data_slices, det_slices, flips))
+
+    shape = mosaic_shape(hdus)
+    mosaic = None
+    for hdu, data_slices, det_slices, flips in placements:
+        # only the data section is read from disk
+        section = hdu.section[data_slices]
+        if mosaic is None:
+            mosaic = np.zeros(shape, dtype=section.dtype)
+        mosaic[det_slices] = section[flips]
+    return mosaic
+
+def _keyword(hdu, keyword):
+    """Get a keyword from the header of an HDU
+
+    Arguments
+    ---------
+    hdu: astropy.io.fits.ImageHDU
+    The HDU
+
+    keyword: str
+    The keyword
+
+    Return
+    ------
+    value: str
+    The keyword value
+
+    Raise
+    -----
+    ImageError if the keyword is missing
+    """
+    try:
+        return hdu.header[keyword]
+    except KeyError as error:
+        raise ImageError(
+            f"Image: Missing section keyword {keyword}") from error
+
+def find_image_hdus(hdu_list):
+    """Find the HDUs with 2D images or 3D cubes
+
+    Only the headers are read
+
+    Arguments
+    ---------
+    hdu_list: astropy.io.fits.HDUList
+    The opened file
+
+    Return
+    ------
+    indices: list of int
+    Indices of the HDUs with image data
+    """
+    return [
+        index for index, hdu in enumerate(hdu_list)
+        if hdu.is_image and hdu.header.get("NAXIS", 0) in (2, 3)
+    ]
+
+def is_mosaic(hdu_list, indices):
+    """Check if the image HDUs of a file are the amplifiers of a mosaic
+
+    Arguments
+    ---------
+    hdu_list: astropy.io.fits.HDUList
+    The opened file
+
+    indices: list of int
+    Indices of the HDUs with image data (see find_image_hdus)
+
+    Return
+    ------
+    mosaic: bool
+    True if there are several 2D image HDUs and all of them have the DATASEC
+    and DETSEC keywords
+    """
+    return len(indices) > 1 and all(
+        hdu_list[index].header.get("NAXIS") == 2
+        and "DATASEC" in hdu_list[index].header
+        and "DETSEC" in hdu_list[index].header
+        for index in indices)
+
+def list_image_hdus(filename):
+    """List the image HDUs of a file
+
+    Only the headers are read
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file
+
+    Return
+    ------
+    hdus: list of dict
+    One entry per HDU with image data, with the keys "index", "name" (the
+    EXTNAME), "shape" (in numpy order) and "mosaic" (True if the HDU is an
+    amplifier of a mosaic, see is_mosaic)
+
+    Raise
+    -----
+    ImageError if the file cannot be read
+    """
+    # astropy is imported on first use to keep the application start-up fast
+    from astropy.io import fits  # pylint: disable=import-outside-toplevel
+
+    try:
+        with fits.open(filename) as hdu_list:
+            indices = find_image_hdus(hdu_list)
+            mosaic = is_mosaic(hdu_list, indices)
+            return [{
+                "index": index,
+                "name": hdu_list[index].name,
+                "shape": tuple(
+                    hdu_list[index].header[f"NAXIS{axis}"]
+                    for axis in range(hdu_list[index].header["NAXIS"], 0, -1)),
+                "mosaic": mosaic,
+            } for index in indices]
+    except (IOError, KeyError) as error:
+        raise ImageError(f"Image: {str(error)}") from error
+
+def mosaic_shape(hdus):
+    """Compute the shape of a mosaic from the DETSEC keywords of its amplifiers
+
+    Only the headers are read
+
+    Arguments
+    ---------
+    hdus: list of astropy.io.fits.ImageHDU
+    The amplifiers
+
+    Return
+    ------
+    shape: (int, int)
+    Shape of the mosaic in numpy order
+
+    Raise
+    -----
+    ImageError if the DETSEC keywords are missing or malformed
+    """
+    det_slices = [parse_section(_keyword(hdu, "DETSEC"))[0] for hdu in hdus]
+    return tuple(
+        max(slices[axis].stop for slices in det_slices) for axis in range(2))
+
+def parse_section(section):
+    """Parse a FITS section keyword (e.g. DATASEC = '[1:1024,1:2048]')
+
+    Arguments
+    ---------
+    section: str
+    The section, in FITS order (x first), 1-based and inclusive
+
+    Return
+    ------
+    slices: (slice, slice)
+    The section as ascending slices in numpy order (rows first)
+
+    flips: (bool, bool)
+    True for each axis (in numpy order) that is given in descending order
+
+    Raise
+    -----
+    ImageError if the section is malformed
+    """
+    match = SECTION_REGEX.match(str(section).strip())
+    if match is None:
+        raise ImageError(f"Image: Malformed section {section}")
+    x_1, x_2, y_1, y_2 = (int(value) for value in match.groups())
+    slices = (slice(min(y_1, y_2) - 1, max(y_1, y_2)),
+              slice(min(x_1, x_2) - 1, max(x_1, x_2)))
+    return slices, (y_1 > y_2, x_1 > x_2)
+
+def _parse_value(text):
+    """Parse the value of a header card
+
+    Arguments
+    ---------
+    text: str
+    The value and comment (card columns 11 to 80)
+
+    Return
+    ------
+    value: str, int, float, bool or None
+    The value. None if the value is empty
+    """
+    text = text.strip()
+    if text.startswith("'"):
+        # quotes inside strings are doubled
+        end = 1
+        while True:
+            end = text.find("'", end)
+            if end == -1 or text[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return text[1:end if end != -1 else None].replace("''", "'").rstrip()
+    text = text.split("/", 1)[0].strip()
+    if text == "":
+        return None
+    if text in ("T", "F"):
+        return text == "T"
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace("D", "E"))
+    except ValueError:
+        return text
+
+def _read_header(filename):
+    """Read and parse the primary header blocks of a FITS file
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file (.fits, .fit, .fts or .gz)
+
+    Return
+    ------
+    header: dict
+    The header (see read_primary_header)
+
+    header_size: int
+    Size of the header in bytes. The primary data starts here
+
+    Raise
+    -----
+    ImageError if the file cannot be read or is not a FITS file
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    header = {}
+    # keyword of a long string value continued in the next card
+    continued = None
+    try:
+        with opener(filename, "rb") as file:
+            for block_index in range(MAX_HEADER_BLOCKS):
+                block = file.read(FITS_BLOCK_SIZE)
+                if len(block) < FITS_BLOCK_SIZE:
+                    raise ImageError(f"Image: {filename} has a truncated header")
+                if block_index == 0 and not block.startswith(b"SIMPLE  ="):
+                    raise ImageError(f"Image: {filename} is not a FITS file")
+                block = block.decode("ascii", errors="replace")
+                for start in range(0, FITS_BLOCK_SIZE, CARD_SIZE):
+                    card = block[start:start + CARD_SIZE]
+                    keyword = card[:8].rstrip()
+                    if keyword == "END":
+                        return header, (block_index + 1) * FITS_BLOCK_SIZE
+                    if keyword == "CONTINUE" and continued is not None:
+                        value = _parse_value(card[10:])
+                        if not isinstance(value, str):
+                            value = ""
+                        header[continued] = header[continued][:-1] + value
+                        if not value.endswith("&"):
+                            continued = None
+                        continue
+                    continued = None
+                    if card[8:10] == "= " and keyword not in header:
+                        header[keyword] = _parse_value(card[10:])
+                        if (card[10:].lstrip().startswith("'")
+                                and header[keyword].endswith("&")):
+                            continued = keyword
+    except (OSError, EOFError) as error:
+        raise ImageError(f"Image: {str(error)}") from error
+    raise ImageError(f"Image: {filename} has no END card")
+
+def read_primary_header(filename):
+    """Read the primary header of a FITS file without reading the data
+
+    Only the header blocks are read (for compressed files, only they are
+    decompressed). COMMENT, HISTORY and blank cards are ignored. Only the
+    first value of repeated keywords is kept. Long strings split into CONTINUE
+    cards are joined
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file (.fits, .fit, .fts or .gz)
+
+    Return
+    ------
+    header: dict
+    The header. Keys are the keywords and values the parsed values
+
+    Raise
+    -----
+    ImageError if the file cannot be read or is not a FITS file
+    """
+    return _read_header(filename)[0]
+
+def memmap_primary_data(filename):
+    """Memory-map the primary image of an uncompressed FITS file
+
+    No data is read until the returned array is indexed, so strided samples
+    only read the pages they touch. The values are the stored ones: BSCALE
+    and BZERO are not applied
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file
+
+    Return
+    ------
+    header: dict
+    The primary header (see read_primary_header)
+
+    data: numpy.memmap
+    The stored data, with shape (NAXIS2, NAXIS1) or (NAXIS3, NAXIS2, NAXIS1)
+
+    Raise
+    -----
+    ImageError if the file is compressed, cannot be read or has no 2D image
+    or data cube in the primary HDU
+    """
+    if filename.endswith(".gz"):
+        raise ImageError(f"Image: {filename} is compressed")
+    header, header_size = _read_header(filename)
+    if (header.get("NAXIS") not in (2, 3)
+            or header.get("BITPIX") not in BITPIX_DTYPES):
+        raise ImageError(
+            f"Image: The primary HDU of {filename} does not contain a 2D "
+            "image or a data cube")
+    shape = tuple(
+        header.get(f"NAXIS{axis}", 0) for axis in range(header["NAXIS"], 0, -1))
+    try:
+        data = np.memmap(filename, dtype=BITPIX_DTYPES[header["BITPIX"]],
+                         mode="r", offset=header_size, shape=shape)
+    except (OSError, ValueError) as error:
+        raise ImageError(f"Image: {str(error)}") from error
+    return header, data
+
+def read_primary_rows(filename, step):
+    """Read every n-th row of the primary image of a FITS file
+
+    Uncompressed files are memory-mapped, so only the pages of the selected
+    rows are read. Compressed files are decompressed in a single pass, keeping
+    only the selected rows. For cubes, the rows of the first plane are read
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file
+
+    step: int
+    Read one row every step rows
+
+    Return
+    ------
+    header: dict
+    The primary header (see read_primary_header)
+
+    rows: array of float
+    The selected rows, with BSCALE and BZERO applied
+
+    Raise
+    -----
+    ImageError if the file cannot be read or has no 2D image or data cube in
+    the primary HDU
+    """
+    if not filename.endswith(".gz"):
+        header, data = memmap_primary_data(filename)
+        if data.ndim == 3:
+            data = data[0]
+        rows = np.asarray(data[::step], dtype=np.float64)
+    else:
+        header, header_size = _read_header(filename)
+        if (header.get("NAXIS") not in (2, 3)
+                or header.get("BITPIX") not in BITPIX_DTYPES):
+            raise ImageError(
+                f"Image: The primary HDU of {filename} does not contain a 2D "
+                "image or a data cube")
+        dtype = np.dtype(BITPIX_DTYPES[header["BITPIX"]])
+        num_rows, row_size = header["NAXIS2"], header["NAXIS1"]
+        rows = np.empty(((num_rows + step - 1) // step, row_size))
+        try:
+            with gzip.open(filename, "rb") as file:
+                file.seek(header_size)
+                for index in range(rows.shape[0]):
+                    buffer = file.read(row_size * dtype.itemsize)
+                    if len(buffer) < row_size * dtype.itemsize:
+                        raise ImageError(f"Image: {filename} is truncated")
+                    rows[index] = np.frombuffer(buffer, dtype=dtype)
+                    if index < rows.shape[0] - 1:
+                        # skip the rows in between
+                        file.seek((step - 1) * row_size * dtype.itemsize, 1)
+        except (OSError, EOFError) as error:
+            raise ImageError(f"Image: {str(error)}") from error
+    rows *= header.get("BSCALE", 1)
+    rows += header.get("BZERO", 0)
+    return header, rows
+
+def read_plane(hdu, plane=None, rows=None):
+    """Read the data of an image HDU
+
+    For cubes, only the selected plane is read from disk when possible. When
+    rows is given, only those rows are read
+
+    Arguments
+    ---------
+    hdu: astropy.io.fits.ImageHDU or astropy.io.fits.PrimaryHDU
+    The HDU
+
+    plane: int or None - Default: None
+    Plane to read from a cube. If None, the first plane. Ignored for 2D images
+
+    rows: slice or None - Default: None
+    Rows to read. If None, all of them
+
+    Return
+    ------
+    data: array
+    The 2D image data
+
+    Raise
+    -----
+    ImageError if the plane is out of range
+    """
+    if hdu.header["NAXIS"] == 2:
+        if rows is None:
+            return hdu.data
+        index = (rows,)
+    else:
+        plane = 0 if plane is None else plane
+        num_planes = hdu.header["NAXIS3"]
+        if not 0 <= plane < num_planes:
+            raise ImageError(
+                f"Image: Plane {plane} out of range. The cube has {num_planes} "
+                "planes")
+        index = (plane,) if rows is None else (plane, rows)
+    try:
+        return hdu.section[index]
+    except (AttributeError, ValueError, OSError):
+        # sections are not available for some compressed files
+        return hdu.data[index]
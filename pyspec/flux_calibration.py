@@ -0,0 +1,374 @@
+""" Flux calibration with a sensitivity function measured on a standard star
+
+The sensitivity function converts count rates (counts / s / Angs, corrected
+for the atmospheric extinction) into flux densities (erg / s / cm2 / Angs).
+It is stored in magnitudes:
+    sensitivity = 2.5 log10(reference flux / corrected count rate)
+and measured by comparing the spectrum of a standard star with its reference
+table. The ratio is smoothed with continuum.fit_continuum, ignoring the
+telluric bands (TELLURIC_BANDS) and the pixels rejected by the clipping.
+
+Reference tables are read from files (see read_standard). Two formats are
+accepted:
+- three columns: wavelength (Angs), AB magnitude and bandpass (Angs), as the
+  IRAF onedstds tables
+- two columns: wavelength (Angs) and flux density (erg / s / cm2 / Angs), as
+  the ESO and CALSPEC ASCII tables
+
+The extinction (mag / airmass) is taken from a table or from an analytic model
+with Rayleigh scattering and an aerosol power law (see extinction_curve).
+
+Applying the sensitivity function to a stack of spectra sharing the wavelength
+interpolates the sensitivity and the extinction once for all the spectra and
+scales all the fluxes with array operations.
+"""
+import numpy as np
+
+from pyspec.continuum import fit_continuum
+from pyspec.errors import FluxCalibrationError
+from pyspec.instrumentation import instrument
+
+ACCEPTED_FORMATS = [".dat"]
+AB_ZERO_POINT = 48.60  # AB magnitude of 1 erg / s / cm2 / Hz is -48.60
+SPEED_OF_LIGHT = 2.99792458e18  # in Angs / s
+STANDARD_PRESSURE = 1013.25  # in hPa
+DEFAULT_PRESSURE = STANDARD_PRESSURE
+DEFAULT_AEROSOL_EXTINCTION = 0.05  # mag / airmass at AEROSOL_WAVELENGTH
+DEFAULT_AEROSOL_EXPONENT = 1.3
+AEROSOL_WAVELENGTH = 5500.0  # in Angs
+DEFAULT_SENSITIVITY_COEFFICIENTS = 12
+# O2 B and A bands (in Angs)
+TELLURIC_BANDS = [(6860.0, 6950.0), (7590.0, 7700.0)]
+
+def extinction_curve(wavelength, pressure=DEFAULT_PRESSURE,
+                     aerosol_extinction=DEFAULT_AEROSOL_EXTINCTION,
+                     aerosol_exponent=DEFAULT_AEROSOL_EXPONENT):
+    """Compute the atmospheric extinction from an analytic model
+
+    The model adds the Rayleigh scattering (Hansen & Travis 1974, scaled to
+    the site pressure) and the aerosol scattering (a power law of the
+    wavelength). Ozone and molecular bands are not included
+
+    Arguments
+    ---------
+    wavelength: array of float
+    The wavelength, in Angs
+
+    pressure: float - Default: DEFAULT_PRESSURE
+    Atmospheric pressure at the site, in hPa
+
+    aerosol_extinction: float - Default: DEFAULT_AEROSOL_EXTINCTION
+    Aerosol extinction at AEROSOL_WAVELENGTH, in mag / airmass
+
+    aerosol_exponent: float - Default: DEFAULT_AEROSOL_EXPONENT
+    Power law index of the aerosol extinction
+
+    Return
+    ------
+    extinction: array of float
+    The extinction, in mag / airmass
+    """
+    microns = np.asarray(wavelength, dtype=float) / 1e4
+    rayleigh_depth = (0.008569 * microns**-4 *
+                      (1.0 + 0.0113 * microns**-2 + 0.00013 * microns**-4) *
+                      pressure / STANDARD_PRESSURE)
+    aerosol = aerosol_extinction * (
+        microns * 1e4 / AEROSOL_WAVELENGTH)**-aerosol_exponent
+    return 2.5 * np.log10(np.e) * rayleigh_depth + aerosol
+
+def read_extinction(filename):
+    """Read an extinction table
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file with two columns: wavelength (Angs) and extinction
+    (mag / airmass). Lines starting with "#" are ignored
+
+    Return
+    ------
+    wavelength: array of float
+    The wavelength, sorted
+
+    extinction: array of float
+    The extinction
+
+    Raise
+    -----
+    FluxCalibrationError if the file cannot be read
+    """
+    try:
+        table = np.loadtxt(filename, usecols=(0, 1), ndmin=2)
+    except (IOError, ValueError) as error:
+        raise FluxCalibrationError(
+            f"FluxCalibration: Cannot read {filename}: {str(error)}"
+            ) from error
+    order = np.argsort(table[:, 0])
+    return table[order, 0], table[order, 1]
+
+def read_standard(filename):
+    """Read the reference table of a standard star
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file. Three columns for AB magnitudes (IRAF onedstds format),
+    two columns for flux densities. Lines starting with "#" are ignored
+
+    Return
+    ------
+    wavelength: array of float
+    The wavelength, in Angs, sorted
+
+    flux: array of float
+    The flux density, in erg / s / cm2 / Angs
+
+    Raise
+    -----
+    FluxCalibrationError if the file cannot be read
+    """
+    try:
+        table = np.loadtxt(filename, ndmin=2)
+    except (IOError, ValueError) as error:
+        raise FluxCalibrationError(
+            f"FluxCalibration: Cannot read {filename}: {str(error)}"
+            ) from error
+    if table.shape[1] not in (2, 3):
+        raise FluxCalibrationError(
+            f"FluxCalibration: {filename} must have 2 or 3 columns")
+
+    order = np.argsort(table[:, 0])
+    wavelength = table[order, 0]
+    if table.shape[1] == 3:
+        # AB magnitudes
+        flux = (10**(-0.4 * (table[order, 1] + AB_ZERO_POINT)) *
+                SPEED_OF_LIGHT / wavelength**2)
+    else:
+        flux = table[order, 1]
+    return wavelength, flux
+
+class SensitivityFunction:
+    """ Conversion from count rates to flux densities
+
+    Class methods
+    -------------
+    from_file
+    from_standard
+
+    Methods
+    -------
+    __init__
+    calibrate
+    save
+
+    Attributes
+    ----------
+    extinction: array of float
+    The extinction at each wavelength, in mag / airmass
+
+    sensitivity: array of float
+    The sensitivity at each wavelength, in mag (see module docstring)
+
+    wavelength: array of float
+    The wavelength, in Angs, increasing
+    """
+    def __init__(self, wavelength, sensitivity, extinction):
+        """Initialize instance
+
+        Arguments
+        ---------
+        wavelength: array of float
+        The wavelength, in Angs, increasing
+
+        sensitivity: array of float
+        The sensitivity at each wavelength, in mag
+
+        extinction: array of float
+        The extinction at each wavelength, in mag / airmass
+
+        Raise
+        -----
+        FluxCalibrationError if the arrays have different sizes
+        """
+        if not len(wavelength) == len(sensitivity) == len(extinction):
+            raise FluxCalibrationError(
+                "FluxCalibration: 'wavelength', 'sensitivity' and 'extinction' "
+                "must have the same size")
+        self.wavelength = np.asarray(wavelength, dtype=float)
+        self.sensitivity = np.asarray(sensitivity, dtype=float)
+        self.extinction = np.asarray(extinction, dtype=float)
+
+    @instrument("SensitivityFunction.calibrate")
+    def calibrate(self, flux, wavelength, exptime, airmass):
+        """Convert counts into flux densities
+
+        Arguments
+        ---------
+        flux: array of float
+        The counts of one spectrum (1D) or a stack of spectra (2D, one row per
+        spectrum)
+
+        wavelength: array of float
+        The wavelength, in Angs. Shared (1D) or one row per spectrum (2D)
+
+        exptime: float or array of float
+        Exposure time in seconds. One value per spectrum for stacks
+
+        airmass: float or array of float
+        Airmass. One value per spectrum for stacks
+
+        Return
+        ------
+        flux: array of float
+        The flux densities, in erg / s / cm2 / Angs. nan outside the
+        wavelength range of the sensitivity function
+        """
+        wavelength = np.asarray(wavelength, dtype=float)
+        exptime = np.asarray(exptime, dtype=float)
+        airmass = np.asarray(airmass, dtype=float)
+        if np.ndim(flux) == 2:
+            exptime = exptime.reshape(-1, 1)
+            airmass = airmass.reshape(-1, 1)
+
+        sensitivity = np.interp(wavelength, self.wavelength, self.sensitivity,
+                                left=np.nan, right=np.nan)
+        extinction = np.interp(wavelength, self.wavelength, self.extinction)
+        dispersion = np.abs(np.gradient(wavelength, axis=-1))
+        # the factors that do not depend on the spectrum are computed once
+        calibrated = flux * np.exp((0.4 * np.log(10.0)) * extinction * airmass)
+        calibrated *= 10**(0.4 * sensitivity) / dispersion
+        calibrated /= exptime
+        return calibrated
+
+    @classmethod
+    def from_file(cls, filename):
+        """Load a sensitivity function saved with save
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Return
+        ------
+        instance: SensitivityFunction
+        The loaded instance
+
+        Raise
+        -----
+        FluxCalibrationError if the file cannot be read
+        """
+        try:
+            table = np.genfromtxt(filename, names=True)
+            return cls(table["wave"], table["sensitivity"], table["extinction"])
+        except (IOError, ValueError) as error:
+            raise FluxCalibrationError(
+                f"FluxCalibration: Cannot read {filename}: {str(error)}"
+                ) from error
+
+    @classmethod
+    @instrument("SensitivityFunction.from_standard")
+    # pylint: disable-next=too-many-arguments
+    def from_standard(cls, spectrum, standard, exptime, airmass,
+                      extinction=None, masked_ranges=None,
+                      num_coefficients=DEFAULT_SENSITIVITY_COEFFICIENTS,
+                      **kwargs):
+        """Measure the sensitivity function on the spectrum of a standard star
+
+        Arguments
+        ---------
+        spectrum: Spectrum
+        The calibrated spectrum of the standard star, in counts
+
+        standard: str or (array of float, array of float)
+        Reference table of the star: a file (see read_standard) or its
+        wavelength (Angs) and flux density (erg / s / cm2 / Angs)
+
+        exptime: float
+        Exposure time of the spectrum, in seconds
+
+        airmass: float
+        Airmass of the spectrum
+
+        extinction: (array of float, array of float) or None - Default: None
+        Wavelength (Angs) and extinction (mag / airmass), e.g. from
+        read_extinction. If None, the model of extinction_curve with the
+        default parameters
+
+        masked_ranges: list of (float, float) or None - Default: None
+        Wavelength ranges excluded from the fit. If None, TELLURIC_BANDS
+
+        num_coefficients: int - Default: DEFAULT_SENSITIVITY_COEFFICIENTS
+        Number of coefficients of the fit (see continuum.fit_continuum)
+
+        **kwargs: dict
+        Other arguments of continuum.fit_continuum (model, sigma_lower,
+        sigma_upper and max_iterations)
+
+        Return
+        ------
+        instance: SensitivityFunction
+        The measured sensitivity function, defined in the wavelength range
+        covered by both the spectrum and the reference table
+
+        Raise
+        -----
+        FluxCalibrationError if the spectrum is not calibrated or does not
+        overlap with the reference table
+        SpectrumError if the fit fails
+        """
+        if spectrum.wavelength is None:
+            raise FluxCalibrationError(
+                "FluxCalibration: The standard star spectrum is not "
+                "calibrated")
+        if isinstance(standard, str):
+            standard = read_standard(standard)
+        if masked_ranges is None:
+            masked_ranges = TELLURIC_BANDS
+
+        wavelength = np.asarray(spectrum.wavelength, dtype=float)
+        if extinction is None:
+            extinction = extinction_curve(wavelength)
+        else:
+            extinction = np.interp(wavelength, *extinction)
+
+        reference = np.interp(wavelength, *standard, left=np.nan,
+                              right=np.nan)
+        rate = (spectrum.flux / (exptime * np.abs(np.gradient(wavelength))) *
+                10**(0.4 * extinction * airmass))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = 2.5 * np.log10(reference / rate)
+        values[~np.isfinite(values)] = np.nan
+
+        valid = np.flatnonzero(np.isfinite(values))
+        if valid.size == 0:
+            raise FluxCalibrationError(
+                "FluxCalibration: The spectrum does not overlap with the "
+                "reference table")
+        covered = slice(valid[0], valid[-1] + 1)
+        sensitivity, _ = fit_continuum(
+            values[covered], wavelength[covered], masked_ranges,
+            num_coefficients=num_coefficients, **kwargs)
+        return cls(wavelength[covered], sensitivity, extinction[covered])
+
+    def save(self, filename):
+        """Save the sensitivity function
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Raise
+        -----
+        FluxCalibrationError if the filename does not have the correct format
+        """
+        if not any(filename.endswith(format_check)
+                   for format_check in ACCEPTED_FORMATS):
+            raise FluxCalibrationError(
+                "FluxCalibration: 'filename' has incorrect extension. Valid "
+                "extensions are " + ", ".join(ACCEPTED_FORMATS))
+        np.savetxt(filename,
+                   np.column_stack([self.wavelength, self.sensitivity,
+                                    self.extinction]),
+                   header="wave sensitivity extinction", comments="")
@@ -0,0 +1,382 @@
+""" Classification of frames into bias, dark, flat, arc and science frames
+
+The type is taken from the header when it has one of FRAME_TYPE_KEYWORDS with
+a recognised value (see FRAME_TYPE_ALIASES). Otherwise it is guessed from
+statistics of a subsample of the pixels: every n-th row of the image, so that
+the spectral direction keeps its full resolution. For uncompressed files the
+rows are read from the memory-mapped file, so only the pages of the sampled
+rows are read and full frames are never loaded. Compressed files are
+decompressed once, keeping only the sampled rows.
+
+The statistics are (see pixel_statistics):
+- signal: how far the brightest pixels are above the pedestal, in units of
+  the pixel noise. Bias and dark frames have no signal
+- line_density and line_fraction: number of narrow emission lines in the
+  spectral profile per 1000 pixels and the fraction of the flux above the
+  continuum (a running low percentile). Arcs have many lines and little
+  continuum
+- trace_contrast: how much a narrow band of rows stands out from the
+  neighbouring rows. Science frames have a narrow trace, flats a plateau
+- illuminated_fraction: fraction of rows illuminated
+- saturated_fraction: fraction of pixels at the saturation level
+
+Dispersion is assumed to run along the rows (as in Spectrum.from_image).
+"""
+import logging
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from pyspec.errors import ImageError
+from pyspec.fits_utils import (
+    find_image_hdus, read_plane, read_primary_header, read_primary_rows
+)
+
+FRAME_TYPES = ["bias", "dark", "flat", "arc", "science"]
+# frame types whose spectra are extracted by the batch reduction
+EXTRACTED_FRAME_TYPES = ["arc", "science"]
+FRAME_TYPE_KEYWORDS = ["IMAGETYP", "OBSTYPE", "FRAMETYP", "IMAGE-TYP"]
+# words in the header values of each frame type, checked in order
+FRAME_TYPE_ALIASES = {
+    "bias": ["bias", "zero"],
+    "dark": ["dark"],
+    "flat": ["flat", "flatfield", "domeflat", "skyflat", "twilight"],
+    "arc": ["arc", "comp", "comparison", "lamp", "wave", "wavecal", "thar",
+            "neon", "hgar"],
+    "science": ["object", "science", "light", "sci", "std", "standard",
+                "target"],
+}
+DEFAULT_SAMPLE_SIZE = 200000  # in pixels
+# larger steps could miss a trace a few pixels wide
+MAX_ROW_STEP = 4
+# widths of the running filters of the spectral profile (in pixels) and of
+# the spatial profile (in sampled rows)
+CONTINUUM_WINDOW = 51
+SPATIAL_WINDOW = 15
+# thresholds of classify_statistics
+MIN_SIGNAL = 10.0
+LINE_SIGMA = 10.0
+MIN_LINE_DENSITY = 3.0
+MIN_LINE_FRACTION = 0.25
+MIN_TRACE_CONTRAST = 0.3
+MIN_ILLUMINATED_FRACTION = 0.5
+
+logger = logging.getLogger(__name__)
+
+def classify_header(header):
+    """Get the frame type from the header keywords
+
+    Arguments
+    ---------
+    header: dict or astropy.io.fits.Header
+    The header
+
+    Return
+    ------
+    frame_type: str or None
+    One of FRAME_TYPES. None if the header does not have the frame type
+    """
+    for keyword in FRAME_TYPE_KEYWORDS:
+        value = header.get(keyword)
+        if not isinstance(value, str):
+            continue
+        words = value.lower().replace("_", " ").replace("-", " ").split()
+        words.append("".join(words))
+        for frame_type, aliases in FRAME_TYPE_ALIASES.items():
+            if any(word in aliases for word in words):
+                return frame_type
+    return None
+
+def _row_step(shape, sample_size):
+    """Get the step between the sampled rows
+
+    Arguments
+    ---------
+    shape: (int, int)
+    Number of rows and columns of the image
+
+    sample_size: int
+    Approximate number of pixels of the sample
+
+    Return
+    ------
+    step: int
+    Step between the sampled rows. At most MAX_ROW_STEP
+    """
+    return min(max(math.ceil(shape[0] * shape[1] / sample_size), 1),
+               MAX_ROW_STEP)
+
+def sample_rows(data, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Get a strided subsample of the rows of an image
+
+    Arguments
+    ---------
+    data: array
+    The image data. Can be a memory map, only the sampled rows are read
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels of the sample. Rows are never skipped by
+    more than MAX_ROW_STEP
+
+    Return
+    ------
+    sample: array of float
+    Every n-th row of the image
+    """
+    return np.asarray(data[::_row_step(data.shape, sample_size)],
+                      dtype=np.float64)
+
+def read_sample(filename, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Read the header and a strided subsample of the rows of a frame
+
+    Images in the primary HDU are read with fits_utils.read_primary_rows
+    (memory-mapped, or decompressed in a single pass). Images in extensions
+    are read with astropy sections. For cubes, the first plane is sampled. For
+    mosaics, the first amplifier
+
+    Arguments
+    ---------
+    filename: str
+    Name of the frame
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels of the sample. Rows are never skipped by
+    more than MAX_ROW_STEP
+
+    Return
+    ------
+    header: dict or astropy.io.fits.Header
+    The header of the sampled image
+
+    sample: array of float
+    The sampled rows
+
+    Raise
+    -----
+    ImageError if the file cannot be read or does not contain image data
+    """
+    header = read_primary_header(filename)
+    if header.get("NAXIS") in (2, 3):
+        step = _row_step((header["NAXIS2"], header["NAXIS1"]), sample_size)
+        return read_primary_rows(filename, step)
+
+    # astropy is imported on first use to keep the application start-up fast
+    from astropy.io import fits  # pylint: disable=import-outside-toplevel
+
+    try:
+        with fits.open(filename) as hdu_list:
+            indices = find_image_hdus(hdu_list)
+            if len(indices) == 0:
+                raise ImageError(
+                    f"Image: {filename} does not contain image data")
+            hdu = hdu_list[indices[0]]
+            step = _row_step(
+                (hdu.header["NAXIS2"], hdu.header["NAXIS1"]), sample_size)
+            sample = np.asarray(
+                read_plane(hdu, rows=slice(None, None, step)), dtype=np.float64)
+            return hdu.header, sample
+    except OSError as error:
+        raise ImageError(f"Image: {str(error)}") from error
+
+def _saturation_level(header):
+    """Get the saturation level of a frame
+
+    Arguments
+    ---------
+    header: dict or astropy.io.fits.Header
+    The header
+
+    Return
+    ------
+    level: float or None
+    The SATURATE keyword or, for integer data, the largest stored value. None
+    for floating point data without SATURATE
+    """
+    if header.get("SATURATE") is not None:
+        return float(header["SATURATE"])
+    bitpix = header.get("BITPIX")
+    if bitpix is None or bitpix < 0:
+        return None
+    maximum = 2**bitpix - 1 if bitpix == 8 else 2**(bitpix - 1) - 1
+    return maximum * header.get("BSCALE", 1) + header.get("BZERO", 0)
+
+def _running_filter(profile, window, percentile):
+    """Compute a running percentile of a profile
+
+    Arguments
+    ---------
+    profile: array of float
+    The profile
+
+    window: int
+    Width of the window. Clipped to the profile size
+
+    percentile: float
+    The percentile (50 for a running median)
+
+    Return
+    ------
+    filtered: array of float
+    The running percentile, with the same size as profile
+    """
+    window = min(window, profile.size)
+    return np.percentile(sliding_window_view(
+        np.pad(profile, (window // 2, (window - 1) // 2), mode="edge"),
+        window), percentile, axis=1)
+
+def pixel_statistics(sample, saturation=None):
+    """Compute the statistics used to classify a frame
+
+    Arguments
+    ---------
+    sample: array of float
+    Sampled rows of the frame (see sample_rows)
+
+    saturation: float or None - Default: None
+    Saturation level. If None, saturated_fraction is 0
+
+    Return
+    ------
+    statistics: dict
+    The statistics (see the module documentation)
+    """
+    sample = np.where(np.isfinite(sample), sample, np.nanmedian(sample))
+    pedestal = np.percentile(sample, 1)
+    # pixel noise from the differences between neighbouring pixels
+    noise = max(
+        1.4826 * np.median(np.abs(np.diff(sample, axis=1))) / np.sqrt(2),
+        np.finfo(float).eps)
+    signal = (np.percentile(sample, 99.9) - pedestal) / noise
+
+    # spectral profile: emission lines over a smooth continuum
+    spectral = np.median(sample, axis=0) - pedestal
+    continuum = _running_filter(spectral, CONTINUUM_WINDOW, 10)
+    excess = spectral - continuum
+    profile_noise = (1.4826 * np.median(np.abs(excess - np.median(excess))) +
+                     noise / np.sqrt(sample.shape[0]))
+    peaks = ((excess[1:-1] > LINE_SIGMA * profile_noise) &
+             (excess[1:-1] >= excess[:-2]) & (excess[1:-1] > excess[2:]))
+    line_density = peaks.sum() * 1000.0 / spectral.size
+    line_fraction = (np.clip(excess, 0.0, None).sum() /
+                     max(np.clip(spectral, 0.0, None).sum(), noise))
+
+    # spatial profile: a narrow trace or an illuminated plateau
+    spatial = np.median(sample, axis=1) - pedestal
+    median_row = max(np.median(spatial), 0.0)
+    trace_contrast = (
+        np.max(spatial - _running_filter(spatial, SPATIAL_WINDOW, 50)) /
+        (median_row + noise))
+    illuminated_fraction = np.mean(
+        spatial > 0.5 * np.percentile(spatial, 90))
+
+    saturated_fraction = 0.0
+    if saturation is not None:
+        saturated_fraction = np.mean(sample >= saturation)
+
+    return {
+        "signal": float(signal),
+        "line_density": float(line_density),
+        "line_fraction": float(line_fraction),
+        "trace_contrast": float(trace_contrast),
+        "illuminated_fraction": float(illuminated_fraction),
+        "saturated_fraction": float(saturated_fraction),
+    }
+
+def classify_statistics(statistics, exptime=None):
+    """Guess the frame type from the pixel statistics
+
+    Arguments
+    ---------
+    statistics: dict
+    The statistics (see pixel_statistics)
+
+    exptime: float or None - Default: None
+    Exposure time. Frames without signal are darks if it is positive and
+    biases otherwise
+
+    Return
+    ------
+    frame_type: str
+    One of FRAME_TYPES
+    """
+    if statistics["signal"] < MIN_SIGNAL:
+        return "dark" if exptime is not None and exptime > 0 else "bias"
+    if (statistics["line_density"] >= MIN_LINE_DENSITY and
+            statistics["line_fraction"] >= MIN_LINE_FRACTION):
+        return "arc"
+    if statistics["trace_contrast"] >= MIN_TRACE_CONTRAST:
+        return "science"
+    if statistics["illuminated_fraction"] >= MIN_ILLUMINATED_FRACTION:
+        return "flat"
+    return "science"
+
+def classify_data(header, data, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Classify an image already in memory
+
+    Arguments
+    ---------
+    header: dict or astropy.io.fits.Header
+    The header
+
+    data: array
+    The image data
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels used for the statistics
+
+    Return
+    ------
+    frame_type: str
+    One of FRAME_TYPES
+
+    statistics: dict or None
+    The pixel statistics. None if the type was taken from the header
+    """
+    frame_type = classify_header(header)
+    if frame_type is not None:
+        return frame_type, None
+    statistics = pixel_statistics(
+        sample_rows(data, sample_size), _saturation_level(header))
+    return classify_statistics(statistics, header.get("EXPTIME")), statistics
+
+def classify_frame(filename, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Classify a frame on disk
+
+    The pixels are only read if the headers do not have the frame type, and
+    then only a subsample of the rows (see read_sample)
+
+    Arguments
+    ---------
+    filename: str
+    Name of the frame
+
+    sample_size: int - Default: DEFAULT_SAMPLE_SIZE
+    Approximate number of pixels used for the statistics
+
+    Return
+    ------
+    frame_type: str
+    One of FRAME_TYPES
+
+    statistics: dict or None
+    The pixel statistics. None if the type was taken from the header
+
+    Raise
+    -----
+    ImageError if the file cannot be read
+    """
+    frame_type = classify_header(read_primary_header(filename))
+    if frame_type is not None:
+        return frame_type, None
+    # the frame type can also be in the header of an image extension
+    header, sample = read_sample(filename, sample_size)
+    frame_type = classify_header(header)
+    if frame_type is not None:
+        return frame_type, None
+
+    statistics = pixel_statistics(sample, _saturation_level(header))
+    if statistics["saturated_fraction"] > 0.01:
+        logger.warning("%s: %.1f%% of the pixels are saturated", filename,
+                       100 * statistics["saturated_fraction"])
+    return classify_statistics(statistics, header.get("EXPTIME")), statistics
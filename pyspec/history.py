@@ -0,0 +1,209 @@
+""" Undo/redo history of operations """
+from collections import OrderedDict
+
+from pyspec.errors import HistoryError
+
+class History:
+    """ Undo/redo stack of operations
+
+    Only the operations (and their parameters) are stored. The owner of the
+    history is responsible of recomputing its state from the applied
+    operations.
+
+    Methods
+    -------
+    __init__
+    clear
+    push
+    redo
+    undo
+
+    Properties
+    ----------
+    applied_operations
+    can_redo
+    can_undo
+
+    Attributes
+    ----------
+    operations: list of tuple
+    All the operations in the stack, including the undone ones that can be
+    redone. Each operation is a tuple with the operation name followed by its
+    parameters
+
+    position: int
+    Number of applied operations
+    """
+    def __init__(self):
+        """Initialize instance"""
+        self.operations = []
+        self.position = 0
+
+    @property
+    def applied_operations(self):
+        """Tuple with the operations that are currently applied"""
+        return tuple(self.operations[:self.position])
+
+    @property
+    def can_redo(self):
+        """True if there are undone operations to redo"""
+        return self.position < len(self.operations)
+
+    @property
+    def can_undo(self):
+        """True if there are applied operations to undo"""
+        return self.position > 0
+
+    def clear(self):
+        """Remove all the operations"""
+        self.operations = []
+        self.position = 0
+
+    def push(self, operation):
+        """Add a new operation
+
+        Undone operations are discarded and can no longer be redone
+
+        Arguments
+        ---------
+        operation: tuple
+        The operation name followed by its parameters
+        """
+        del self.operations[self.position:]
+        self.operations.append(operation)
+        self.position += 1
+
+    def redo(self):
+        """Redo the last undone operation
+
+        Return
+        ------
+        operation: tuple
+        The redone operation
+
+        Raise
+        -----
+        HistoryError if there is nothing to redo
+        """
+        if not self.can_redo:
+            raise HistoryError("History: Nothing to redo")
+        self.position += 1
+        return self.operations[self.position - 1]
+
+    def undo(self):
+        """Undo the last applied operation
+
+        Return
+        ------
+        operation: tuple
+        The undone operation
+
+        Raise
+        -----
+        HistoryError if there is nothing to undo
+        """
+        if not self.can_undo:
+            raise HistoryError("History: Nothing to undo")
+        self.position -= 1
+        return self.operations[self.position]
+
+
+class LRUCache:
+    """ Small least-recently-used cache of materialized states
+
+    Methods
+    -------
+    __init__
+    __contains__
+    __len__
+    clear
+    get
+    put
+    values
+
+    Properties
+    ----------
+    nbytes
+
+    Attributes
+    ----------
+    max_size: int
+    Maximum number of stored states
+
+    _states: OrderedDict
+    The stored states sorted from the least to the most recently used
+    """
+    def __init__(self, max_size):
+        """Initialize instance
+
+        Arguments
+        ---------
+        max_size: int
+        Maximum number of stored states. If 0, nothing is stored
+        """
+        self.max_size = max_size
+        self._states = OrderedDict()
+
+    def __contains__(self, key):
+        """Check if a state is stored"""
+        return key in self._states
+
+    def __len__(self):
+        """Number of stored states"""
+        return len(self._states)
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the stored arrays"""
+        return sum(
+            getattr(state, "nbytes", 0) for state in self._states.values())
+
+    def clear(self):
+        """Remove all the stored states"""
+        self._states.clear()
+
+    def get(self, key):
+        """Get a stored state and mark it as the most recently used
+
+        Arguments
+        ---------
+        key: hashable
+        The state key
+
+        Return
+        ------
+        state: object or None
+        The stored state. None if the state is not stored
+        """
+        if key not in self._states:
+            return None
+        self._states.move_to_end(key)
+        return self._states[key]
+
+    def put(self, key, state):
+        """Store a state, removing the least recently used ones if needed
+
+        Arguments
+        ---------
+        key: hashable
+        The state key
+
+        state: object
+        The state
+        """
+        if self.max_size <= 0:
+            return
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    def values(self):
+        """Get the stored states, from the least to the most recently used
+
+        Return
+        ------
+        states: list
+        The stored states
+        """
+        return list(self._states.values())
@@ -1,10 +1,101 @@
 """ Basic Image """
-from astropy.io import fits
-from scipy.ndimage import rotate
+import contextlib
+import logging
 
+import numpy as np
+
+from pyspec.cache import get_cache
+from pyspec.display import DEFAULT_LEVELS_METHOD, display_levels
 from pyspec.errors import ImageError
+from pyspec.fits_utils import (
+    assemble_mosaic, find_image_hdus, is_mosaic, mosaic_shape, read_plane
+)
+from pyspec.history import History, LRUCache
+from pyspec.instrumentation import (
+    add_allocation, add_bytes_read, instrument, timer
+)
+from pyspec.precision import get_working_dtype
 
 ACCEPTED_FORMATS = [".fit", ".fits", ".fits.gz",".FIT"]
+STATE_CACHE_SIZE = 2
+LEVELS_CACHE_SIZE = 8
+# extra rows read around the band when streaming a rotated image, so that the
+# spline interpolation matches the one of the full image
+STREAM_MARGIN = 16
+
+logger = logging.getLogger(__name__)
+
+def rotation_geometry(shape, rotation_angle):
+    """Compute the transformation of a rotation, as in scipy.ndimage.rotate
+
+    Arguments
+    ---------
+    shape: (int, int)
+    Shape of the input image
+
+    rotation_angle: float
+    Rotation angle in degrees
+
+    Return
+    ------
+    rot_matrix: array of float
+    The rotation matrix (from output to input coordinates)
+
+    offset: array of float
+    The offset (input coordinates of the first output pixel)
+
+    out_shape: array of int
+    Shape of the rotated image
+    """
+    # scipy is imported on first use to keep the application start-up fast
+    from scipy import special  # pylint: disable=import-outside-toplevel
+
+    in_shape = np.array(shape)
+    cos, sin = (special.cosdg(rotation_angle), special.sindg(rotation_angle))
+    rot_matrix = np.array([[cos, sin], [-sin, cos]])
+    out_bounds = rot_matrix @ [[0, 0, in_shape[0], in_shape[0]],
+                               [0, in_shape[1], 0, in_shape[1]]]
+    out_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    offset = (in_shape - 1) / 2 - rot_matrix @ ((out_shape - 1) / 2)
+    return rot_matrix, offset, out_shape
+
+def transform(data, rot_matrix, offset, out_shape):
+    """Apply an affine transformation with cubic splines, in the working
+    precision
+
+    Same as scipy.ndimage.affine_transform, except that the spline
+    coefficients are stored in the working dtype (see pyspec.precision)
+    instead of float64, and the output has the working dtype instead of that
+    of the input
+
+    Arguments
+    ---------
+    data: array
+    The input image
+
+    rot_matrix: array of float
+    The transformation matrix
+
+    offset: array of float
+    The offset
+
+    out_shape: tuple of int
+    Shape of the output
+
+    Return
+    ------
+    transformed: array of float
+    The transformed image
+    """
+    # scipy is imported on first use to keep the application start-up fast
+    from scipy import ndimage  # pylint: disable=import-outside-toplevel
+
+    dtype = get_working_dtype()
+    coefficients = ndimage.spline_filter(
+        data, order=3, output=dtype, mode="constant")
+    return ndimage.affine_transform(
+        coefficients, rot_matrix, offset, tuple(out_shape), output=dtype,
+        order=3, mode="constant", prefilter=False)
 
 class Image:
     """ Basic Image
@@ -12,29 +103,68 @@ class Image:
     Methods
     -------
     __init__
+    _open_hdus
+    _read_data
+    _stream_band
+    _update_data
+    _update_rotation_angle
+    display_levels
+    load_data
+    read_band
+    redo
+    release_data
     rotate
+    set_operations
+    undo
+
+    Properties
+    ----------
+    is_loaded
+    nbytes
+    selection
 
     Attributes
     ----------
-    data: array of float
-    The current image data
+    data: array or None
+    The current image data. None if the data was released (see release_data).
+    When the image is not rotated this is the same array as original_data.
+    Rotated data has the working dtype (see pyspec.precision)
 
     filename: str
     Name of the file containing the image
 
+    hdu: int, str or None
+    Index or name (EXTNAME) of the HDU with the image. None to use the first
+    HDU with image data, or all of them if they are the amplifiers of a mosaic
+
     header: astropy.io.fits.header.Header
-    The image header
+    The image header. For mosaics, the primary header
+
+    history: History
+    The applied operations. Only the operation parameters are stored, the
+    data is recomputed from original_data on undo/redo
 
     image_extension: str
     Extension of the loaded file
 
-    original_data: array of float
-    The original image data
+    original_data: array or None
+    The original image data (read-only), with the dtype of the file. None if
+    the data was released
+
+    plane: int or None
+    Plane of a data cube. None for the first plane
 
     rotation_angle: float
     Current rotation angle. This is the sum of all rotation angles applied
+
+    _levels: LRUCache
+    The display levels of the most recently shown data. Keys are the rotation
+    angle and the levels method
+
+    _states: LRUCache
+    The most recently used rotated images. Keys are the rotation angles
     """
-    def __init__(self, filename):
+    def __init__(self, filename, load=True, hdu=None, plane=None):
         """Initialize instance
 
         Arguments
@@ -42,10 +172,23 @@ class Image:
         filename: str
         Filename to open
 
+        load: bool - Default: True
+        If True, read the image data. Otherwise only the header is read and
+        the data is read when calling load_data
+
+        hdu: int, str or None - Default: None
+        Index or name (EXTNAME) of the HDU with the image. If None, use the
+        first HDU with image data, or assemble all of them if they are the
+        amplifiers of a mosaic (see pyspec.fits_utils)
+
+        plane: int or None - Default: None
+        Plane of a data cube. If None, the first plane. Only this plane is read
+
         Raise
         -----
         ImageError if filename is not a string
         ImageError if filename does not have the correct format
+        ImageError if the file does not have the selected image
         """
         # check filename type
         if not isinstance(filename, str):
@@ -64,19 +207,343 @@ class Image:
                 "extensions are " + ", ".join(ACCEPTED_FORMATS)
                 )
 
+        self.filename = filename
+        self.hdu = hdu
+        self.plane = plane
+        self.header = None
+        self.data = None
+        self.original_data = None
+        self.rotation_angle = 0.0
+        self.history = History()
+        self._states = LRUCache(STATE_CACHE_SIZE)
+        self._levels = LRUCache(LEVELS_CACHE_SIZE)
+
+        if load:
+            self.load_data()
+        else:
+            with self._open_hdus() as (hdu_list, hdus):
+                self.header = self._mosaic_header(hdu_list, hdus)
+
+    @property
+    def is_loaded(self):
+        """True if the image data is in memory, False otherwise"""
+        return self.original_data is not None
+
+    @property
+    def selection(self):
+        """The selected HDU and plane, as a dictionary"""
+        return {"hdu": self.hdu, "plane": self.plane}
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the image data"""
+        if not self.is_loaded:
+            return 0
+        arrays = {id(self.original_data): self.original_data,
+                  id(self.data): self.data}
+        nbytes = sum(array.nbytes for array in arrays.values())
+        nbytes += sum(
+            state.nbytes for state in self._states.values()
+            if id(state) not in arrays)
+        return nbytes
+
+    def display_levels(self, method=DEFAULT_LEVELS_METHOD):
+        """Get the display levels of the current data
+
+        The levels are computed from a sample of the pixels (see
+        pyspec.display) and kept until the data changes, so they are not
+        recomputed when the data is released and read again
+
+        Arguments
+        ---------
+        method: str - Default: DEFAULT_LEVELS_METHOD
+        "zscale" or "percentile"
+
+        Return
+        ------
+        levels: (float, float)
+        The lower and upper levels
+
+        Raise
+        -----
+        ImageError if the data is not loaded or the method is not valid
+        """
+        key = (self.rotation_angle, method)
+        levels = self._levels.get(key)
+        if levels is None:
+            if not self.is_loaded:
+                raise ImageError(
+                    f"Image: The data of {self.filename} is not loaded")
+            levels = display_levels(self.data, method)
+            self._levels.put(key, levels)
+        return levels
+
+    def load_data(self):
+        """Read the image data from file
+
+        If the image was rotated, the rotation is applied again. Nothing is
+        done if the data is already loaded
+
+        Raise
+        -----
+        ImageError if the file cannot be read
+        """
+        if self.is_loaded:
+            return
+
+        self._read_data()
+        self._update_data()
+
+    @contextlib.contextmanager
+    def _open_hdus(self):
+        """Open the file and find the selected HDUs
+
+        Only the headers are read
+
+        Usage:
+            with self._open_hdus() as (hdu_list, hdus):
+                ...
+
+        Return
+        ------
+        hdu_list: astropy.io.fits.HDUList
+        The opened file
+
+        hdus: list of astropy.io.fits.ImageHDU
+        The selected HDU, or the amplifiers of a mosaic
+
+        Raise
+        -----
+        ImageError if the file cannot be read or does not have the selected
+        image
+        """
+        # astropy is imported on first use to keep the application start-up
+        # fast
+        from astropy.io import fits  # pylint: disable=import-outside-toplevel
+
         try:
-            hdu = fits.open(filename)
+            hdu_list = fits.open(self.filename)
         except IOError as error:
-            raise ImageError("Image:", str(error)) from error
+            raise ImageError(f"Image: {str(error)}") from error
 
-        self.filename = filename
-        self.header = hdu[0].header
-        self.data = hdu[0].data
-        self.original_data = self.data.copy()
+        try:
+            if self.hdu is None:
+                indices = find_image_hdus(hdu_list)
+                if len(indices) == 0:
+                    raise ImageError(
+                        f"Image: {self.filename} does not contain image data")
+                if not is_mosaic(hdu_list, indices):
+                    indices = indices[:1]
+                hdus = [hdu_list[index] for index in indices]
+            else:
+                try:
+                    hdus = [hdu_list[self.hdu]]
+                except (IndexError, KeyError) as error:
+                    raise ImageError(
+                        f"Image: {self.filename} does not have HDU {self.hdu}"
+                        ) from error
+                if not hdus[0].is_image or hdus[0].header.get(
+                        "NAXIS", 0) not in (2, 3):
+                    raise ImageError(
+                        f"Image: HDU {self.hdu} of {self.filename} does not "
+                        "contain a 2D image or a data cube")
+            yield hdu_list, hdus
+        finally:
+            hdu_list.close()
 
-        self.rotation_angle = 0.0
+    @staticmethod
+    def _mosaic_header(hdu_list, hdus):
+        """Get the header of the selected image
+
+        Arguments
+        ---------
+        hdu_list: astropy.io.fits.HDUList
+        The opened file
+
+        hdus: list of astropy.io.fits.ImageHDU
+        The selected HDU, or the amplifiers of a mosaic (see _open_hdus)
+
+        Return
+        ------
+        header: astropy.io.fits.header.Header
+        The header of the selected HDU. For mosaics, a copy of the primary
+        header with the size of the mosaic
+        """
+        if len(hdus) == 1:
+            return hdus[0].header
+        header = hdu_list[0].header.copy()
+        header["NAXIS2"], header["NAXIS1"] = mosaic_shape(hdus)
+        return header
+
+    @instrument("Image.read")
+    def _read_data(self):
+        """Read the header (if needed) and the original data from file
+
+        Raise
+        -----
+        ImageError if the file cannot be read or does not have the selected
+        image
+        """
+        with self._open_hdus() as (hdu_list, hdus):
+            if self.header is None:
+                self.header = self._mosaic_header(hdu_list, hdus)
+            if len(hdus) > 1:
+                data = assemble_mosaic(hdus)
+            else:
+                data = read_plane(hdus[0], self.plane)
+            if data is None:
+                raise ImageError(
+                    f"Image: {self.filename} does not contain image data")
+            self.original_data = data
+
+        # data and original_data share memory until the image is rotated
+        self.original_data.flags.writeable = False
+        add_bytes_read(self.original_data.nbytes)
+        add_allocation(self.original_data)
+
+    @instrument("Image.read_band")
+    def read_band(self, lower_limit, upper_limit):
+        """Get a band of rows of the current (rotated) image data
+
+        If the data is not loaded, only the rows of the original data needed to
+        compute the band are read, so the memory used is proportional to the
+        band and not to the image (for small rotation angles). The data is not
+        loaded. Mosaics are always loaded (see load_data)
+
+        Arguments
+        ---------
+        lower_limit: int
+        First row of the band
+
+        upper_limit: int
+        Row after the last row of the band
+
+        Return
+        ------
+        band: array of float
+        The rows of the band
+
+        Raise
+        -----
+        ImageError if the file cannot be read
+        """
+        if not self.is_loaded:
+            with self._open_hdus() as (_, hdus):
+                if len(hdus) == 1:
+                    return self._stream_band(hdus[0], lower_limit, upper_limit)
+            self.load_data()
+        return self.data[lower_limit:upper_limit]
+
+    def _stream_band(self, hdu, lower_limit, upper_limit):
+        """Compute a band of rows of the current image reading only the rows
+        of the original data it needs
+
+        The rotation is computed as in scipy.ndimage.rotate, but only for the
+        output rows of the band
+
+        Arguments
+        ---------
+        hdu: astropy.io.fits.ImageHDU
+        The selected HDU
+
+        lower_limit: int
+        First row of the band
+
+        upper_limit: int
+        Row after the last row of the band
+
+        Return
+        ------
+        band: array of float
+        The rows of the band
+        """
+        if self.rotation_angle == 0.0:
+            with timer("Image.read") as record:
+                band = read_plane(
+                    hdu, self.plane, slice(lower_limit, upper_limit))
+                record.add_bytes_read(band.nbytes)
+                record.add_allocation(band)
+            return band
+
+        in_shape = np.array([hdu.header["NAXIS2"], hdu.header["NAXIS1"]])
+        rot_matrix, offset, out_shape = rotation_geometry(
+            in_shape, self.rotation_angle)
+
+        lower_limit, upper_limit, _ = slice(
+            lower_limit, upper_limit).indices(out_shape[0])
+        upper_limit = max(upper_limit, lower_limit)
+
+        # input rows of the corners of the band
+        corner_rows = [
+            rot_matrix[0] @ [row, column] + offset[0]
+            for row in (lower_limit, upper_limit - 1)
+            for column in (0, out_shape[1] - 1)
+        ]
+        first_row = max(int(np.floor(min(corner_rows))) - STREAM_MARGIN, 0)
+        last_row = min(int(np.ceil(max(corner_rows))) + STREAM_MARGIN + 1,
+                       in_shape[0])
+        if upper_limit == lower_limit or last_row <= first_row:
+            # the band is outside the rotated image
+            return np.zeros((upper_limit - lower_limit, out_shape[1]),
+                            dtype=get_working_dtype())
+
+        with timer("Image.read") as record:
+            rows = read_plane(hdu, self.plane, slice(first_row, last_row))
+            record.add_bytes_read(rows.nbytes)
+            record.add_allocation(rows)
+
+        with timer("Image.rotate") as record:
+            band = transform(
+                rows, rot_matrix,
+                offset + rot_matrix[:, 0] * lower_limit - [first_row, 0],
+                (upper_limit - lower_limit, out_shape[1]))
+            record.add_allocation(band)
+        return band
+
+    def release_data(self):
+        """Free the memory used by the image data
+
+        The data can be read again from file with load_data. The header and
+        the rotation angle are kept
+        """
+        self.data = None
+        self.original_data = None
+        self._states.clear()
 
-        hdu.close()
+    def redo(self):
+        """Redo the last undone rotation
+
+        Raise
+        -----
+        HistoryError if there is nothing to redo
+        """
+        self.history.redo()
+        self._update_rotation_angle()
+
+    def set_operations(self, operations):
+        """Replace the history by a list of applied operations
+
+        The data is only recomputed if it is loaded
+
+        Arguments
+        ---------
+        operations: list of tuple
+        The operations, as in History.operations
+        """
+        self.history.clear()
+        for operation in operations:
+            self.history.push(tuple(operation))
+        self._update_rotation_angle()
+
+    def undo(self):
+        """Undo the last rotation
+
+        Raise
+        -----
+        HistoryError if there is nothing to undo
+        """
+        self.history.undo()
+        self._update_rotation_angle()
 
     def rotate(self, rotation_angle_str):
         """Rotate image
@@ -103,12 +570,56 @@ class Image:
                 "Image: rotation angle must be a float. Found "
                 f"{rotation_angle_str}") from error
 
-        self.rotation_angle += rotation_angle
-        print(self.rotation_angle)
+        self.history.push(("rotate", rotation_angle))
+        self._update_rotation_angle()
+        logger.debug("%s: rotation angle set to %g degrees", self.filename,
+                     self.rotation_angle)
+
+    def _update_rotation_angle(self):
+        """Compute the rotation angle from the applied operations and update
+        the data and the header accordingly"""
+        self.rotation_angle = sum(
+            (operation[1] for operation in self.history.applied_operations
+             if operation[0] == "rotate"),
+            0.0)
         self.header["COMMENTS"] = (
-            f"Pyspec: Image rotated by {rotation_angle} degrees")
+            f"Pyspec: Image rotated by {self.rotation_angle} degrees")
+
+        self._update_data()
+
+    def _update_data(self):
+        """Compute the current image data from the original data and the
+        rotation angle.
+
+        Recently used rotations are taken from the in-memory cache. Otherwise,
+        they are taken from the disk cache (see pyspec.cache) if active"""
+        if not self.is_loaded:
+            return
 
         if self.rotation_angle == 0.0:
-            self.data = self.original_data.copy()
-        else:
-            self.data = rotate(self.original_data, self.rotation_angle)
+            self.data = self.original_data
+            return
+
+        self.data = self._states.get(self.rotation_angle)
+        if self.data is not None:
+            return
+
+        cache = get_cache()
+        if cache is not None:
+            key = cache.key(cache.input_key(self.filename), "rotate",
+                            {"rotation_angle": self.rotation_angle,
+                             "dtype": get_working_dtype().name,
+                             **self.selection})
+            self.data = cache.get(key)
+
+        if self.data is None:
+            with timer("Image.rotate") as record:
+                self.data = transform(
+                    self.original_data,
+                    *rotation_geometry(self.original_data.shape,
+                                       self.rotation_angle))
+                record.add_allocation(self.data)
+            if cache is not None:
+                cache.put(key, self.data)
+
+        self._states.put(self.rotation_angle, self.data)
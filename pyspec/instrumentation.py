@@ -0,0 +1,461 @@
+""" Lightweight timing instrumentation of the reduction stages
+
+Instrumentation is disabled by default. When disabled, instrumented functions
+only pay for a flag check. Enable it with enable() or by setting the
+environment variable PYSPEC_PROFILE=1.
+
+Usage:
+    @instrument("Image.rotate")
+    def rotate(...):
+        ...
+
+    with timer("my stage"):
+        ...
+        add_bytes_read(nbytes)
+        add_allocation(array)
+
+The measured records can be summarized per stage (summary, format_summary)
+and exported as JSON (export_json) or in the Chrome trace format
+(export_chrome_trace), which can be opened in chrome://tracing or Perfetto.
+
+The stages executed inside a capture block are also collected by the block,
+even if instrumentation is disabled. This is used to measure per-frame
+metrics (see pyspec.metrics).
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+PROFILE_ENV = "PYSPEC_PROFILE"
+
+_enabled = os.environ.get(PROFILE_ENV, "0") not in ("", "0")
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+class Record:
+    """ Measurements of one execution of an instrumented stage
+
+    Methods
+    -------
+    __init__
+    add_allocation
+    add_bytes_read
+    to_dict
+
+    Properties
+    ----------
+    self_time
+
+    Attributes
+    ----------
+    allocated: int
+    Number of bytes of the arrays allocated by the stage
+
+    bytes_read: int
+    Number of bytes read from disk by the stage
+
+    child_time: float
+    Wall time spent in nested stages in seconds
+
+    cpu_time: float
+    CPU time of the stage (process time, in seconds)
+
+    depth: int
+    Nesting level of the stage (0 for top-level stages)
+
+    pid: int
+    Process id
+
+    stage: str
+    Name of the stage
+
+    start: float
+    Start time (seconds since the epoch)
+
+    thread_id: int
+    Thread id
+
+    wall_time: float
+    Wall time of the stage in seconds
+    """
+    def __init__(self, stage, depth):
+        """Initialize instance
+
+        Arguments
+        ---------
+        stage: str
+        Name of the stage
+
+        depth: int
+        Nesting level of the stage
+        """
+        self.stage = stage
+        self.depth = depth
+        self.pid = os.getpid()
+        self.thread_id = threading.get_ident()
+        self.start = time.time()
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_read = 0
+        self.allocated = 0
+        self.child_time = 0.0
+
+    @property
+    def self_time(self):
+        """Wall time of the stage excluding nested stages, in seconds"""
+        return self.wall_time - self.child_time
+
+    def add_allocation(self, array):
+        """Account for an allocated array
+
+        Arguments
+        ---------
+        array: np.ndarray or int
+        The allocated array or its size in bytes
+        """
+        self.allocated += getattr(array, "nbytes", array)
+
+    def add_bytes_read(self, nbytes):
+        """Account for bytes read from disk
+
+        Arguments
+        ---------
+        nbytes: int
+        Number of bytes read
+        """
+        self.bytes_read += nbytes
+
+    def to_dict(self):
+        """Convert the record to a dictionary
+
+        Return
+        ------
+        record: dict
+        The record attributes
+        """
+        return {
+            "stage": self.stage,
+            "depth": self.depth,
+            "pid": self.pid,
+            "thread_id": self.thread_id,
+            "start": self.start,
+            "wall_time": self.wall_time,
+            "self_time": self.self_time,
+            "cpu_time": self.cpu_time,
+            "bytes_read": self.bytes_read,
+            "allocated": self.allocated,
+        }
+
+class _NullRecord:
+    """Record used when instrumentation is disabled. Ignores everything"""
+    def add_allocation(self, array):
+        """Ignore the allocation"""
+
+    def add_bytes_read(self, nbytes):
+        """Ignore the bytes read"""
+
+_NULL_RECORD = _NullRecord()
+
+def _captures():
+    """Get the active capture blocks of the current thread
+
+    Return
+    ------
+    captures: list of capture
+    The active capture blocks
+    """
+    if not hasattr(_local, "captures"):
+        _local.captures = []
+    return _local.captures
+
+def _stack():
+    """Get the stack of active records of the current thread
+
+    Return
+    ------
+    stack: list of Record
+    The active records, from the outermost to the innermost
+    """
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def add_allocation(array):
+    """Account for an allocated array in the innermost active stage
+
+    Arguments
+    ---------
+    array: np.ndarray or int
+    The allocated array or its size in bytes
+    """
+    if (_enabled or _captures()) and _stack():
+        _stack()[-1].add_allocation(array)
+
+def add_bytes_read(nbytes):
+    """Account for bytes read from disk in the innermost active stage
+
+    Arguments
+    ---------
+    nbytes: int
+    Number of bytes read
+    """
+    if (_enabled or _captures()) and _stack():
+        _stack()[-1].add_bytes_read(nbytes)
+
+def disable():
+    """Disable instrumentation"""
+    global _enabled  # pylint: disable=global-statement
+    _enabled = False
+
+def enable():
+    """Enable instrumentation"""
+    global _enabled  # pylint: disable=global-statement
+    _enabled = True
+
+def is_enabled():
+    """Check if instrumentation is enabled
+
+    Return
+    ------
+    enabled: bool
+    True if instrumentation is enabled
+    """
+    return _enabled
+
+def export_chrome_trace(filename):
+    """Export the records in the Chrome trace event format
+
+    Arguments
+    ---------
+    filename: str
+    Name of the output file
+    """
+    events = [{
+        "name": record.stage,
+        "cat": "pyspec",
+        "ph": "X",
+        "ts": record.start * 1e6,
+        "dur": record.wall_time * 1e6,
+        "pid": record.pid,
+        "tid": record.thread_id,
+        "args": {
+            "cpu_time_ms": record.cpu_time * 1e3,
+            "bytes_read": record.bytes_read,
+            "allocated": record.allocated,
+        },
+    } for record in records()]
+    with open(filename, "w", encoding="UTF-8") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+def export_json(filename):
+    """Export the records and their summary as JSON
+
+    Arguments
+    ---------
+    filename: str
+    Name of the output file
+    """
+    with open(filename, "w", encoding="UTF-8") as file:
+        json.dump({
+            "records": [record.to_dict() for record in records()],
+            "summary": summary(),
+        }, file, indent=2)
+
+def format_summary(separator="\n"):
+    """Format the per-stage summary
+
+    Arguments
+    ---------
+    separator: str - Default: "\\n"
+    Separator between stages
+
+    Return
+    ------
+    text: str
+    One entry per stage with the number of calls and the total wall time
+    """
+    return separator.join(
+        f"{stage}: {values['wall_time'] * 1e3:.1f} ms ({values['count']} calls)"
+        for stage, values in summary().items())
+
+def instrument(stage):
+    """Decorator to record the execution of a function as a stage
+
+    Arguments
+    ---------
+    stage: str
+    Name of the stage
+
+    Return
+    ------
+    decorator: function
+    The decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled and not getattr(_local, "captures", None):
+                return func(*args, **kwargs)
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def merge(new_records):
+    """Add records measured elsewhere (e.g. in worker processes)
+
+    Arguments
+    ---------
+    new_records: list of Record
+    The records
+    """
+    with _records_lock:
+        _records.extend(new_records)
+
+def records():
+    """Get the measured records
+
+    Return
+    ------
+    records: list of Record
+    The records, in the order in which the stages finished
+    """
+    with _records_lock:
+        return list(_records)
+
+def reset():
+    """Remove all the measured records"""
+    with _records_lock:
+        _records.clear()
+
+def summary():
+    """Summarize the records per stage
+
+    Return
+    ------
+    summary: dict
+    Keys are the stage names. Values are dictionaries with the number of calls
+    ("count") and the total "wall_time", "cpu_time", "bytes_read" and
+    "allocated"
+    """
+    stages = {}
+    for record in records():
+        values = stages.setdefault(record.stage, {
+            "count": 0,
+            "wall_time": 0.0,
+            "cpu_time": 0.0,
+            "bytes_read": 0,
+            "allocated": 0,
+        })
+        values["count"] += 1
+        values["wall_time"] += record.wall_time
+        values["cpu_time"] += record.cpu_time
+        values["bytes_read"] += record.bytes_read
+        values["allocated"] += record.allocated
+    return stages
+
+class timer:  # pylint: disable=invalid-name
+    """ Context manager recording the execution of a block as a stage
+
+    When instrumentation is disabled, the context returns a record that ignores
+    all the measurements
+
+    Methods
+    -------
+    __init__
+    __enter__
+    __exit__
+
+    Attributes
+    ----------
+    record: Record or None
+    The record of the current execution
+
+    stage: str
+    Name of the stage
+    """
+    def __init__(self, stage):
+        """Initialize instance
+
+        Arguments
+        ---------
+        stage: str
+        Name of the stage
+        """
+        self.stage = stage
+        self.record = None
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+
+    def __enter__(self):
+        """Start measuring
+
+        Return
+        ------
+        record: Record or _NullRecord
+        The record of this execution
+        """
+        if not _enabled and not _captures():
+            return _NULL_RECORD
+        stack = _stack()
+        self.record = Record(self.stage, len(stack))
+        stack.append(self.record)
+        self._cpu_start = time.process_time()
+        self._wall_start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop measuring and store the record"""
+        if self.record is None:
+            return
+        self.record.wall_time = time.perf_counter() - self._wall_start
+        self.record.cpu_time = time.process_time() - self._cpu_start
+        stack = _stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_time += self.record.wall_time
+        if _enabled:
+            with _records_lock:
+                _records.append(self.record)
+        for active_capture in _captures():
+            active_capture.records.append(self.record)
+        self.record = None
+
+class capture:  # pylint: disable=invalid-name
+    """ Context manager collecting the stages executed in the current thread
+
+    The stages are recorded even if instrumentation is disabled. They are
+    only added to the global registry if instrumentation is enabled
+
+    Methods
+    -------
+    __init__
+    __enter__
+    __exit__
+
+    Attributes
+    ----------
+    records: list of Record
+    The records of the stages that finished inside the block
+    """
+    def __init__(self):
+        """Initialize instance"""
+        self.records = []
+
+    def __enter__(self):
+        """Start collecting
+
+        Return
+        ------
+        capture: capture
+        This instance
+        """
+        _captures().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop collecting"""
+        _captures().remove(self)
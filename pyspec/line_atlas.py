@@ -0,0 +1,183 @@
+""" Atlas of lamp and sky lines
+
+The lines are kept sorted by wavelength, so the lines in a wavelength range
+and the lines nearest to a wavelength are found by binary search
+(np.searchsorted) in O(log n), whatever the size of the atlas. The bundled
+atlas (DEFAULT_ATLAS_FILE) has the strong Hg, He, Ne and Ar lamp lines, the
+Balmer lines, the Na D doublet and the night sky O I lines
+"""
+import os
+
+import numpy as np
+
+from pyspec.errors import LineAtlasError
+
+DEFAULT_ATLAS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "line_atlas.dat")
+DEFAULT_NUM_CANDIDATES = 5
+
+_default_atlas = None
+
+class LineAtlas:
+    """ Sorted table of spectral lines
+
+    Class methods
+    -------------
+    from_file
+
+    Methods
+    -------
+    __init__
+    __len__
+    in_range
+    label
+    nearest
+    select
+
+    Attributes
+    ----------
+    elements: list of str
+    The elements in the atlas, sorted
+
+    lines: np.ndarray
+    Named array with the lines, sorted by wavelength. Fields are "wave" (in
+    Angstroms), "element" and "ion"
+    """
+    def __init__(self, lines):
+        """Initialize instance
+
+        Arguments
+        ---------
+        lines: np.ndarray
+        Named array with the lines. Must have fields "wave", "element" and
+        "ion". They do not need to be sorted
+
+        Raise
+        -----
+        LineAtlasError if a field is missing
+        """
+        for field in ("wave", "element", "ion"):
+            if lines.dtype.names is None or field not in lines.dtype.names:
+                raise LineAtlasError(
+                    f"Line atlas: Error: missing field {field}")
+        self.lines = np.sort(np.atleast_1d(lines), order="wave")
+        self.elements = sorted(set(self.lines["element"].tolist()))
+
+    def __len__(self):
+        """Number of lines in the atlas"""
+        return self.lines.size
+
+    def in_range(self, min_wave, max_wave):
+        """Get the lines in a wavelength range
+
+        Arguments
+        ---------
+        min_wave: float
+        Minimum wavelength (inclusive)
+
+        max_wave: float
+        Maximum wavelength (inclusive)
+
+        Return
+        ------
+        lines: np.ndarray
+        The lines in the range, sorted by wavelength (a view of lines)
+        """
+        start = np.searchsorted(self.lines["wave"], min_wave, side="left")
+        end = np.searchsorted(self.lines["wave"], max_wave, side="right")
+        return self.lines[start:end]
+
+    def label(self, line):
+        """Get the label of a line
+
+        Arguments
+        ---------
+        line: np.void
+        A line of the atlas
+
+        Return
+        ------
+        label: str
+        The label (e.g. "Hg I 5460.74")
+        """
+        return f"{line['element']} {line['ion']} {line['wave']:.2f}"
+
+    def nearest(self, wave, num_candidates=DEFAULT_NUM_CANDIDATES):
+        """Get the lines nearest to a wavelength
+
+        Arguments
+        ---------
+        wave: float
+        The wavelength
+
+        num_candidates: int - Default: DEFAULT_NUM_CANDIDATES
+        Maximum number of lines returned
+
+        Return
+        ------
+        lines: np.ndarray
+        The nearest lines, sorted by distance to wave
+        """
+        index = np.searchsorted(self.lines["wave"], wave)
+        # the nearest lines are among the num_candidates lines at each side
+        candidates = self.lines[max(index - num_candidates, 0):
+                                index + num_candidates]
+        order = np.argsort(np.abs(candidates["wave"] - wave), kind="stable")
+        return candidates[order[:num_candidates]]
+
+    def select(self, elements):
+        """Get the atlas of some elements
+
+        Arguments
+        ---------
+        elements: list of str
+        The elements (e.g. ["Hg", "Ar"])
+
+        Return
+        ------
+        atlas: LineAtlas
+        The atlas with the lines of the elements
+        """
+        return LineAtlas(
+            self.lines[np.isin(self.lines["element"], list(elements))])
+
+    @classmethod
+    def from_file(cls, filename):
+        """Read an atlas
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file. It has one line per row and the columns "wave",
+        "element" and "ion" (the first row has the column names)
+
+        Return
+        ------
+        instance: LineAtlas
+        The atlas
+
+        Raise
+        -----
+        LineAtlasError if the file cannot be read
+        """
+        try:
+            lines = np.genfromtxt(
+                filename, names=True, dtype=None, encoding="UTF-8")
+        except (OSError, ValueError) as error:
+            raise LineAtlasError(
+                f"Line atlas: Error reading {filename}: {str(error)}"
+            ) from error
+        return cls(lines)
+
+def get_line_atlas():
+    """Get the bundled atlas. It is read the first time it is needed
+
+    Return
+    ------
+    atlas: LineAtlas
+    The atlas in DEFAULT_ATLAS_FILE
+    """
+    global _default_atlas  # pylint: disable=global-statement
+    if _default_atlas is None:
+        _default_atlas = LineAtlas.from_file(DEFAULT_ATLAS_FILE)
+    return _default_atlas
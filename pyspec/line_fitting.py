@@ -0,0 +1,461 @@
+""" Batched fitting of line profiles in calibrated spectra
+
+Each line of each spectrum is fitted in a window of pixels around its
+expected centre with a profile on top of a constant background. All the
+windows have the same number of pixels, so the fits of all the lines of all
+the spectra are stacked into arrays and solved together by a vectorized
+Levenberg-Marquardt: every iteration evaluates the profiles and their analytic
+Jacobians for all the fits at once and solves all the damped normal equations
+with a single batched np.linalg.solve. Each fit keeps its own damping factor
+and stops updating once it converged. A fit converged when an accepted step
+changes its parameters but barely changes its chi2. Steps that change nothing
+(e.g. when the line has no signal in its window) are not convergence, and
+neither are fits with singular normal equations. The eta of pseudo-Voigt fits
+is held at its bound while the fit pushes it outside [0, 1] (e.g. for pure
+Gaussian lines), so those fits also converge.
+
+Lines whose expected centre is outside the wavelength coverage of a spectrum,
+and fits whose centre leaves its window, are not converged and have NaN
+parameters.
+
+Profiles:
+- "gaussian": amplitude * exp(-(x - centre)**2 / (2 * sigma**2))
+- "pseudo_voigt": mixture (1 - eta) * gaussian + eta * lorentzian with the
+  same FWHM, where 0 <= eta <= 1 is also fitted
+
+The results are structured arrays (see LINE_FIT_DTYPE) with one entry per
+spectrum and line.
+"""
+import numpy as np
+
+from pyspec.errors import SpectrumError
+from pyspec.instrumentation import instrument
+
+LINE_PROFILES = ["gaussian", "pseudo_voigt"]
+DEFAULT_LINE_PROFILE = "gaussian"
+DEFAULT_HALF_WINDOW = 10  # in pixels
+DEFAULT_MAX_ITERATIONS = 50
+DEFAULT_TOLERANCE = 1e-8  # relative change of chi2
+INITIAL_DAMPING = 1e-3
+MIN_DAMPING = 1e-12
+MAX_DAMPING = 1e10
+GAUSSIAN_FWHM = 2.0 * np.sqrt(2.0 * np.log(2.0))  # FWHM / sigma
+LINE_FIT_DTYPE = np.dtype([
+    ("centre", "f8"),
+    ("centre_error", "f8"),
+    ("sigma", "f8"),
+    ("sigma_error", "f8"),
+    ("fwhm", "f8"),
+    ("amplitude", "f8"),
+    ("amplitude_error", "f8"),
+    ("eta", "f8"),
+    ("eta_error", "f8"),
+    ("background", "f8"),
+    ("background_error", "f8"),
+    ("flux", "f8"),
+    ("flux_error", "f8"),
+    ("equivalent_width", "f8"),
+    ("equivalent_width_error", "f8"),
+    ("chi2", "f8"),
+    ("converged", "?"),
+])
+
+# indices of the parameters
+_BACKGROUND, _AMPLITUDE, _CENTRE, _SIGMA, _ETA = range(5)
+
+def _extract_windows(flux, wavelength, centres, half_window):
+    """Extract the pixels around each line of each spectrum
+
+    Arguments
+    ---------
+    flux: array of float
+    The fluxes. One row per spectrum
+
+    wavelength: array of float
+    The wavelength. Shared (1D) or one row per spectrum (2D)
+
+    centres: array of float
+    Expected centre of each line, in wavelength
+
+    half_window: int
+    Number of pixels on each side of the centres
+
+    Return
+    ------
+    x_values: array of float
+    Wavelength of the pixels of each window (spectra x lines x pixels)
+
+    y_values: array of float
+    Flux of the pixels of each window (spectra x lines x pixels)
+    """
+    num_spectra, num_pixels = flux.shape
+    wavelength = np.broadcast_to(wavelength, flux.shape)
+    rows = np.arange(num_spectra)[:, np.newaxis]
+    nearest = np.empty((num_spectra, centres.size), dtype=int)
+    for row in range(num_spectra):
+        nearest[row] = np.searchsorted(wavelength[row], centres)
+    size = 2 * half_window + 1
+    first = np.clip(nearest - half_window, 0, num_pixels - size)
+    columns = first[:, :, np.newaxis] + np.arange(size)
+    return (wavelength[rows[:, :, np.newaxis], columns],
+            flux[rows[:, :, np.newaxis], columns])
+
+def _levenberg_marquardt(x_values, y_values, weights, params, profile,
+                         max_iterations, tolerance):
+    """Fit the profiles of all the windows at once
+
+    Arguments
+    ---------
+    x_values: array of float
+    Wavelength of the pixels of each fit (fits x pixels)
+
+    y_values: array of float
+    Flux of the pixels of each fit (fits x pixels)
+
+    weights: array of float
+    Weight of each pixel (fits x pixels)
+
+    params: array of float
+    Initial parameters of each fit (fits x parameters). Modified in place
+
+    profile: str
+    One of LINE_PROFILES
+
+    max_iterations: int
+    Maximum number of iterations
+
+    tolerance: float
+    A fit converged when the relative change of its chi2 is smaller than this
+
+    Return
+    ------
+    params: array of float
+    The fitted parameters
+
+    jacobian: array of float
+    Jacobian of the model at params (fits x pixels x parameters)
+
+    chi2: array of float
+    The chi2 of each fit
+
+    converged: array of bool
+    Whether each fit converged. Fits without enough valid pixels are flagged
+    as converged and not updated (see fit_lines)
+    """
+    num_params = params.shape[1]
+    model, jacobian = _profile(x_values, params, profile)
+    chi2 = np.sum(weights * (y_values - model)**2, axis=1)
+    damping = np.full(params.shape[0], INITIAL_DAMPING)
+    converged = weights.sum(axis=1) <= num_params
+    for _ in range(max_iterations):
+        active = ~converged
+        if not np.any(active):
+            break
+        weighted_jacobian = weights[active, :, np.newaxis] * jacobian[active]
+        normal = np.einsum("pwk,pwl->pkl", weighted_jacobian, jacobian[active])
+        gradient = np.einsum("pwk,pw->pk", weighted_jacobian,
+                             y_values[active] - model[active])
+        if profile == "pseudo_voigt":
+            # hold eta at its bound while the fit pushes it outside
+            eta = params[active, _ETA]
+            pinned = (((eta <= 0.0) & (gradient[:, _ETA] < 0.0)) |
+                      ((eta >= 1.0) & (gradient[:, _ETA] > 0.0)))
+            normal[pinned, _ETA, :] = 0.0
+            normal[pinned, :, _ETA] = 0.0
+            normal[pinned, _ETA, _ETA] = 1.0
+            gradient[pinned, _ETA] = 0.0
+        diagonal = np.einsum("pkk->pk", normal)
+        damped = normal + (damping[active, np.newaxis] * diagonal)[
+            :, :, np.newaxis] * np.eye(num_params)
+        try:
+            step = np.linalg.solve(damped, gradient[:, :, np.newaxis])
+        except np.linalg.LinAlgError:
+            # some fits are degenerate
+            step = np.linalg.pinv(damped) @ gradient[:, :, np.newaxis]
+        step = step[:, :, 0]
+
+        trial = params[active] + step
+        trial[:, _SIGMA] = np.abs(trial[:, _SIGMA])
+        if profile == "pseudo_voigt":
+            trial[:, _ETA] = np.clip(trial[:, _ETA], 0.0, 1.0)
+        trial_model, trial_jacobian = _profile(x_values[active], trial, profile)
+        trial_chi2 = np.sum(
+            weights[active] * (y_values[active] - trial_model)**2, axis=1)
+
+        improved = np.isfinite(trial_chi2) & (trial_chi2 <= chi2[active])
+        indices = np.flatnonzero(active)
+        accepted = indices[improved]
+        change = np.abs(chi2[accepted] - trial_chi2[improved])
+        # steps that do not change the parameters are not convergence
+        moved = np.any(trial[improved] != params[accepted], axis=1)
+        params[accepted] = trial[improved]
+        model[accepted] = trial_model[improved]
+        jacobian[accepted] = trial_jacobian[improved]
+        converged[accepted] = moved & (change <= tolerance * np.maximum(
+            trial_chi2[improved], np.finfo(float).tiny))
+        chi2[accepted] = trial_chi2[improved]
+        damping[accepted] = np.maximum(damping[accepted] / 10.0, MIN_DAMPING)
+        rejected = indices[~improved]
+        damping[rejected] *= 10.0
+        converged[rejected] |= damping[rejected] > MAX_DAMPING
+
+    return params, jacobian, chi2, converged
+
+def _profile(x_values, params, profile):
+    """Evaluate the model and its Jacobian
+
+    Arguments
+    ---------
+    x_values: array of float
+    Wavelength of the pixels of each fit (fits x pixels)
+
+    params: array of float
+    Parameters of each fit (fits x parameters)
+
+    profile: str
+    One of LINE_PROFILES
+
+    Return
+    ------
+    model: array of float
+    The model (fits x pixels)
+
+    jacobian: array of float
+    Derivatives of the model with respect to each parameter (fits x pixels x
+    parameters)
+    """
+    background = params[:, _BACKGROUND, np.newaxis]
+    amplitude = params[:, _AMPLITUDE, np.newaxis]
+    offset = x_values - params[:, _CENTRE, np.newaxis]
+    sigma = params[:, _SIGMA, np.newaxis]
+
+    gaussian = np.exp(-0.5 * (offset / sigma)**2)
+    shape = gaussian
+    d_centre = gaussian * offset / sigma**2
+    d_sigma = gaussian * offset**2 / sigma**3
+    jacobian = np.empty(x_values.shape + (params.shape[1],))
+    if profile == "pseudo_voigt":
+        eta = params[:, _ETA, np.newaxis]
+        gamma_2 = (0.5 * GAUSSIAN_FWHM * sigma)**2
+        lorentzian = 1.0 / (1.0 + offset**2 / gamma_2)
+        shape = (1.0 - eta) * gaussian + eta * lorentzian
+        d_centre = ((1.0 - eta) * d_centre +
+                    eta * 2.0 * lorentzian**2 * offset / gamma_2)
+        d_sigma = ((1.0 - eta) * d_sigma +
+                   eta * 2.0 * lorentzian**2 * offset**2 / (gamma_2 * sigma))
+        jacobian[:, :, _ETA] = amplitude * (lorentzian - gaussian)
+
+    jacobian[:, :, _BACKGROUND] = 1.0
+    jacobian[:, :, _AMPLITUDE] = shape
+    jacobian[:, :, _CENTRE] = amplitude * d_centre
+    jacobian[:, :, _SIGMA] = amplitude * d_sigma
+    return background + amplitude * shape, jacobian
+
+def _integrated_flux(params, profile):
+    """Compute the integrated flux of the lines and its gradient
+
+    Arguments
+    ---------
+    params: array of float
+    Parameters of each fit (fits x parameters)
+
+    profile: str
+    One of LINE_PROFILES
+
+    Return
+    ------
+    flux: array of float
+    The flux of each line
+
+    gradient: array of float
+    Derivatives of the flux with respect to each parameter (fits x parameters)
+    """
+    amplitude = params[:, _AMPLITUDE]
+    sigma = params[:, _SIGMA]
+    gaussian_area = np.sqrt(2.0 * np.pi) * sigma
+    gradient = np.zeros(params.shape)
+    if profile == "pseudo_voigt":
+        eta = params[:, _ETA]
+        lorentzian_area = 0.5 * np.pi * GAUSSIAN_FWHM * sigma
+        area = (1.0 - eta) * gaussian_area + eta * lorentzian_area
+        gradient[:, _ETA] = amplitude * (lorentzian_area - gaussian_area)
+    else:
+        area = gaussian_area
+    gradient[:, _AMPLITUDE] = area
+    gradient[:, _SIGMA] = amplitude * area / sigma
+    return amplitude * area, gradient
+
+def _fit_results(params, jacobian, weights, chi2, converged, profile):
+    """Compute the uncertainties and the derived quantities of the fits
+
+    Arguments
+    ---------
+    params: array of float
+    Parameters of each fit (fits x parameters)
+
+    jacobian: array of float
+    Jacobian of the model at params (fits x pixels x parameters)
+
+    weights: array of float
+    Weight of each pixel (fits x pixels)
+
+    chi2: array of float
+    The chi2 of each fit
+
+    converged: array of bool
+    Whether each fit converged. Fits with singular normal equations are
+    flagged as not converged
+
+    profile: str
+    One of LINE_PROFILES
+
+    Return
+    ------
+    results: structured array
+    The fitted lines (see LINE_FIT_DTYPE)
+    """
+    num_params = params.shape[1]
+    # covariance of the parameters, scaled by the reduced chi2
+    dof = np.maximum(weights.sum(axis=1) - num_params, 1.0)
+    normal = np.einsum("pwk,pwl->pkl", weights[:, :, np.newaxis] * jacobian,
+                       jacobian)
+    covariance = np.full(normal.shape, np.nan)
+    invertible = np.abs(np.linalg.det(normal)) > 0.0
+    covariance[invertible] = np.linalg.inv(normal[invertible])
+    covariance *= (chi2 / dof)[:, np.newaxis, np.newaxis]
+    errors = np.sqrt(np.abs(np.einsum("pkk->pk", covariance)))
+
+    line_flux, flux_gradient = _integrated_flux(params, profile)
+    # equivalent width: -flux / background
+    width_gradient = -flux_gradient / params[:, _BACKGROUND, np.newaxis]
+    width_gradient[:, _BACKGROUND] = line_flux / params[:, _BACKGROUND]**2
+
+    results = np.zeros(params.shape[0], dtype=LINE_FIT_DTYPE)
+    results["background"] = params[:, _BACKGROUND]
+    results["background_error"] = errors[:, _BACKGROUND]
+    results["amplitude"] = params[:, _AMPLITUDE]
+    results["amplitude_error"] = errors[:, _AMPLITUDE]
+    results["centre"] = params[:, _CENTRE]
+    results["centre_error"] = errors[:, _CENTRE]
+    results["sigma"] = params[:, _SIGMA]
+    results["sigma_error"] = errors[:, _SIGMA]
+    results["fwhm"] = GAUSSIAN_FWHM * params[:, _SIGMA]
+    if profile == "pseudo_voigt":
+        results["eta"] = params[:, _ETA]
+        results["eta_error"] = errors[:, _ETA]
+    results["flux"] = line_flux
+    results["flux_error"] = np.sqrt(np.abs(np.einsum(
+        "pk,pkl,pl->p", flux_gradient, covariance, flux_gradient)))
+    results["equivalent_width"] = -line_flux / params[:, _BACKGROUND]
+    results["equivalent_width_error"] = np.sqrt(np.abs(np.einsum(
+        "pk,pkl,pl->p", width_gradient, covariance, width_gradient)))
+    results["chi2"] = chi2
+    results["converged"] = converged & invertible
+
+    return results
+
+@instrument("fit_lines")
+# pylint: disable-next=too-many-arguments,too-many-locals,too-many-statements
+def fit_lines(flux, wavelength, centres, profile=DEFAULT_LINE_PROFILE,
+              half_window=DEFAULT_HALF_WINDOW, sigma=None,
+              max_iterations=DEFAULT_MAX_ITERATIONS,
+              tolerance=DEFAULT_TOLERANCE):
+    """Fit the profiles of several lines in one or many spectra
+
+    Arguments
+    ---------
+    flux: array of float
+    The flux of one spectrum (1D) or of many spectra (2D, one row per
+    spectrum)
+
+    wavelength: array of float
+    The wavelength. Shared (1D) or one row per spectrum (2D). Must be
+    increasing
+
+    centres: array of float
+    Expected centre of each line, in wavelength
+
+    profile: str - Default: DEFAULT_LINE_PROFILE
+    One of LINE_PROFILES
+
+    half_window: int - Default: DEFAULT_HALF_WINDOW
+    Number of pixels on each side of the expected centres used in the fits
+
+    sigma: float or None - Default: None
+    Initial width of the lines, in wavelength. If None, two pixels
+
+    max_iterations: int - Default: DEFAULT_MAX_ITERATIONS
+    Maximum number of Levenberg-Marquardt iterations
+
+    tolerance: float - Default: DEFAULT_TOLERANCE
+    A fit converged when the relative change of its chi2 is smaller than this
+
+    Return
+    ------
+    results: structured array
+    The fitted lines (see LINE_FIT_DTYPE). Shape (number of lines,) for one
+    spectrum, (number of spectra, number of lines) otherwise. Errors are
+    scaled by the reduced chi2 of each fit. The equivalent width is positive
+    for absorption lines. Lines outside the wavelength coverage and fits
+    whose centre leaves its window are not converged and have NaN values
+
+    Raise
+    -----
+    SpectrumError if the profile is not valid
+    SpectrumError if the spectra are too short for the windows
+    """
+    if profile not in LINE_PROFILES:
+        raise SpectrumError(
+            f"Spectrum: Unknown line profile {profile}. Valid profiles are " +
+            ", ".join(LINE_PROFILES))
+    flux_2d = np.atleast_2d(flux).astype(np.float64, copy=False)
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    centres = np.atleast_1d(np.asarray(centres, dtype=np.float64))
+    if flux_2d.shape[1] < 2 * half_window + 1:
+        raise SpectrumError(
+            "Spectrum: The spectra are shorter than the line fitting windows")
+
+    x_values, y_values = _extract_windows(
+        flux_2d, wavelength, centres, half_window)
+    output_shape = x_values.shape[:2]
+    x_values = x_values.reshape(-1, x_values.shape[-1])
+    y_values = y_values.reshape(-1, y_values.shape[-1])
+    weights = np.isfinite(y_values).astype(np.float64)
+    y_values = np.where(weights > 0, y_values, 0.0)
+
+    # initial guesses
+    num_params = 5 if profile == "pseudo_voigt" else 4
+    params = np.empty((x_values.shape[0], num_params))
+    params[:, _BACKGROUND] = 0.5 * (y_values[:, 0] + y_values[:, -1])
+    params[:, _CENTRE] = np.tile(centres, output_shape[0])
+    params[:, _AMPLITUDE] = (
+        y_values[np.arange(y_values.shape[0]),
+                 np.argmin(np.abs(x_values - params[:, _CENTRE, np.newaxis]),
+                           axis=1)] - params[:, _BACKGROUND])
+    params[:, _SIGMA] = sigma if sigma is not None else 2.0 * np.abs(
+        x_values[:, 1] - x_values[:, 0])
+    if profile == "pseudo_voigt":
+        params[:, _ETA] = 0.5
+    # fits without enough valid pixels or outside the coverage are not
+    # attempted
+    wavelength_2d = np.broadcast_to(wavelength, flux_2d.shape)
+    covered = ((centres >= wavelength_2d[:, :1]) &
+               (centres <= wavelength_2d[:, -1:])).ravel()
+    skipped = (weights.sum(axis=1) <= num_params) | ~covered
+    params[skipped] = np.nan
+
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        params, jacobian, chi2, converged = _levenberg_marquardt(
+            x_values, y_values, weights, params, profile, max_iterations,
+            tolerance)
+        # fits whose centre left its window did not find the line
+        failed = skipped | ~((params[:, _CENTRE] >= x_values[:, 0]) &
+                             (params[:, _CENTRE] <= x_values[:, -1]))
+        params[failed] = np.nan
+        chi2[failed] = np.nan
+        results = _fit_results(params, jacobian, weights, chi2,
+                               converged & ~failed, profile)
+    results = results.reshape(output_shape)
+    if np.ndim(flux) == 1:
+        return results[0]
+    return results
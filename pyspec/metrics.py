@@ -0,0 +1,258 @@
+""" Per-frame metrics and throughput reports of batch reductions """
+import json
+
+from pyspec.instrumentation import capture
+
+# stages (see pyspec.instrumentation) contributing to each metric
+METRIC_STAGES = {
+    "load_time": ["Image.read"],
+    "rotate_time": ["Image.rotate"],
+    "extract_time": ["Spectrum.from_image", "Image.read_band"],
+    "calibrate_time": ["Calibration.calibrate"],
+    "save_time": ["Spectrum.save"],
+}
+
+class FrameMetrics:
+    """ Timing metrics of the reduction of one frame
+
+    Stage times exclude nested stages, e.g. extract_time does not include the
+    time spent reading or rotating the image during the extraction. Stages
+    skipped thanks to the result cache (see pyspec.cache) have zero time.
+
+    Methods
+    -------
+    __init__
+    measure
+    to_dict
+
+    Properties
+    ----------
+    pixels_per_second
+
+    Attributes
+    ----------
+    filename: str
+    Name of the frame
+
+    num_pixels: int
+    Number of pixels of the frame
+
+    total_time: float
+    Wall time of the full reduction, in seconds
+
+    load_time, rotate_time, extract_time, calibrate_time, save_time: float
+    Wall time of each stage, in seconds
+    """
+    def __init__(self, filename, num_pixels=0):
+        """Initialize instance
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        num_pixels: int - Default: 0
+        Number of pixels of the frame
+        """
+        self.filename = filename
+        self.num_pixels = num_pixels
+        self.total_time = 0.0
+        for metric in METRIC_STAGES:
+            setattr(self, metric, 0.0)
+
+    @property
+    def pixels_per_second(self):
+        """Number of pixels of the frame reduced per second"""
+        if self.total_time <= 0.0:
+            return 0.0
+        return self.num_pixels / self.total_time
+
+    def measure(self):
+        """Measure the stages executed inside a with block
+
+        Usage:
+            with metrics.measure():
+                ...
+
+        Return
+        ------
+        context: _MetricsCapture
+        Context manager filling the metrics at the end of the block
+        """
+        return _MetricsCapture(self)
+
+    def to_dict(self):
+        """Convert the metrics to a dictionary
+
+        Return
+        ------
+        metrics: dict
+        The metrics
+        """
+        metrics = {
+            "filename": self.filename,
+            "num_pixels": self.num_pixels,
+            "total_time": self.total_time,
+            "pixels_per_second": self.pixels_per_second,
+        }
+        for metric in METRIC_STAGES:
+            metrics[metric] = getattr(self, metric)
+        return metrics
+
+class _MetricsCapture(capture):
+    """ Capture the instrumentation records of a block into a FrameMetrics
+
+    Methods
+    -------
+    (see capture)
+    __init__
+    __exit__
+
+    Attributes
+    ----------
+    (see capture)
+
+    metrics: FrameMetrics
+    The metrics to fill
+    """
+    def __init__(self, metrics):
+        """Initialize instance
+
+        Arguments
+        ---------
+        metrics: FrameMetrics
+        The metrics to fill
+        """
+        super().__init__()
+        self.metrics = metrics
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop collecting and fill the metrics"""
+        super().__exit__(exc_type, exc_value, traceback)
+        for metric, stages in METRIC_STAGES.items():
+            setattr(self.metrics, metric, sum(
+                (record.self_time for record in self.records
+                 if record.stage in stages), 0.0))
+        if self.records:
+            top_depth = min(record.depth for record in self.records)
+            self.metrics.total_time = sum(
+                record.wall_time for record in self.records
+                if record.depth == top_depth)
+
+class ThroughputReport:
+    """ Aggregate the metrics of many frames
+
+    Methods
+    -------
+    __init__
+    add
+    add_failure
+    export_json
+    format
+    summary
+
+    Attributes
+    ----------
+    failed: dict
+    Frames whose reduction failed. Keys are the filenames and values the
+    error messages
+
+    frames: list of FrameMetrics
+    The metrics of each reduced frame
+    """
+    def __init__(self):
+        """Initialize instance"""
+        self.failed = {}
+        self.frames = []
+
+    def add(self, metrics):
+        """Add the metrics of a frame
+
+        Arguments
+        ---------
+        metrics: FrameMetrics
+        The metrics
+        """
+        self.frames.append(metrics)
+
+    def add_failure(self, filename, error):
+        """Record a frame whose reduction failed
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        error: Exception or str
+        The error
+        """
+        self.failed[filename] = str(error)
+
+    def export_json(self, filename):
+        """Save the per-frame metrics and the summary as JSON
+
+        Arguments
+        ---------
+        filename: str
+        Name of the output file
+        """
+        with open(filename, "w", encoding="UTF-8") as file:
+            json.dump({
+                "frames": [metrics.to_dict() for metrics in self.frames],
+                "failed": self.failed,
+                "summary": self.summary(),
+            }, file, indent=2)
+
+    def format(self):
+        """Format the summary
+
+        Return
+        ------
+        text: str
+        Human readable summary
+        """
+        summary = self.summary()
+        lines = [
+            f"Frames: {summary['num_frames']}",
+            f"Failed frames: {summary['num_failed']}",
+            f"Total time: {summary['total_time']:.2f} s",
+            f"Throughput: {summary['frames_per_second']:.2f} frames/s, "
+            f"{summary['pixels_per_second'] / 1e6:.2f} Mpixels/s",
+        ]
+        lines += [
+            f"Mean {metric.replace('_', ' ')}: {value * 1e3:.1f} ms"
+            for metric, value in summary["mean"].items()
+        ]
+        return "\n".join(lines)
+
+    def summary(self):
+        """Summarize the metrics
+
+        The throughput is computed from the sum of the per-frame times, i.e.
+        the work done by a single worker
+
+        Return
+        ------
+        summary: dict
+        Number of reduced and failed frames, total time, frames per second,
+        pixels per second and mean time of each stage
+        """
+        total_time = sum(metrics.total_time for metrics in self.frames)
+        num_pixels = sum(metrics.num_pixels for metrics in self.frames)
+        num_frames = len(self.frames)
+        metric_names = ["total_time"] + list(METRIC_STAGES)
+        return {
+            "num_frames": num_frames,
+            "num_failed": len(self.failed),
+            "total_time": total_time,
+            "frames_per_second":
+                num_frames / total_time if total_time > 0 else 0.0,
+            "pixels_per_second":
+                num_pixels / total_time if total_time > 0 else 0.0,
+            "mean": {
+                metric: (sum(getattr(metrics, metric)
+                             for metrics in self.frames) / num_frames
+                         if num_frames > 0 else 0.0)
+                for metric in metric_names
+            },
+        }
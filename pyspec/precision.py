@@ -0,0 +1,95 @@
+""" Working precision of the pixel data
+
+Rotated images and extracted fluxes use the working dtype: float32 by
+default, which halves the memory of the rotated images and of the temporary
+arrays of the spline interpolation with respect to float64. Set the
+environment variable PYSPEC_PRECISION=float64 (or call set_working_dtype) to
+work in double precision.
+
+The original image data keeps the dtype stored in the file (often int16 or
+uint16), and is only converted while computing. The calibration maths
+(wavelength solutions and the fits of pyspec.continuum, pyspec.line_fitting,
+pyspec.flux_calibration and pyspec.redshift) always work in float64: they
+convert their inputs internally and return results with the dtype of the
+flux.
+"""
+import logging
+import os
+
+import numpy as np
+
+from pyspec.errors import PrecisionError
+
+PRECISION_ENV = "PYSPEC_PRECISION"
+WORKING_DTYPES = ["float32", "float64"]
+DEFAULT_WORKING_DTYPE = "float32"
+
+_working_dtype = None
+
+logger = logging.getLogger(__name__)
+
+def get_working_dtype():
+    """Get the working dtype
+
+    If no dtype was set with set_working_dtype, it is read from the
+    environment variable PYSPEC_PRECISION, or DEFAULT_WORKING_DTYPE if unset
+
+    Return
+    ------
+    dtype: numpy.dtype
+    The working dtype
+    """
+    global _working_dtype  # pylint: disable=global-statement
+    if _working_dtype is None:
+        name = os.environ.get(PRECISION_ENV, DEFAULT_WORKING_DTYPE)
+        if name not in WORKING_DTYPES:
+            logger.warning(
+                "Invalid %s=%s. Valid values are %s. Using %s", PRECISION_ENV,
+                name, ", ".join(WORKING_DTYPES), DEFAULT_WORKING_DTYPE)
+            name = DEFAULT_WORKING_DTYPE
+        _working_dtype = np.dtype(name)
+    return _working_dtype
+
+def set_working_dtype(dtype):
+    """Set the working dtype
+
+    Arguments
+    ---------
+    dtype: str, numpy.dtype or None
+    The dtype, one of WORKING_DTYPES. None to use the environment variable
+    PYSPEC_PRECISION again
+
+    Raise
+    -----
+    PrecisionError if the dtype is not valid
+    """
+    global _working_dtype  # pylint: disable=global-statement
+    if dtype is None:
+        _working_dtype = None
+        return
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError as error:
+        raise PrecisionError(
+            f"Precision: Invalid working dtype {dtype}") from error
+    if dtype.name not in WORKING_DTYPES:
+        raise PrecisionError(
+            f"Precision: Invalid working dtype {dtype}. Valid dtypes are " +
+            ", ".join(WORKING_DTYPES))
+    _working_dtype = dtype
+
+def to_working_dtype(array):
+    """Convert an array to the working dtype
+
+    Arguments
+    ---------
+    array: array
+    The array
+
+    Return
+    ------
+    array: array of float
+    The array itself if it already has the working dtype, a converted copy
+    otherwise
+    """
+    return np.asarray(array).astype(get_working_dtype(), copy=False)
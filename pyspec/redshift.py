@@ -0,0 +1,348 @@
+""" Redshift and classification of spectra by template fitting
+
+Spectra and templates are resampled onto grids with a constant step in
+log(wavelength), where a redshift is a shift by a whole number of pixels:
+    log(wavelength_observed) = log(wavelength_rest) + log(1 + z)
+The templates are resampled once per grid and cached by their TemplateSet.
+
+For every spectrum, template and redshift of the grid, the amplitude of the
+template is fitted (linear least squares) and the chi2 is
+    chi2 = sum(w f**2) - sum(w f T)**2 / sum(w T**2)
+where f is the flux, w the weights and T the shifted template. The shifted
+templates of a block of templates are stacked into a matrix, so the sums of
+all the spectra, templates and redshifts of the block are two matrix products
+(BLAS, multithreaded). The minimum of the best template is refined with a
+parabola through its neighbours.
+
+Templates must cover the rest-frame wavelength range of the spectra for all
+the redshifts of the grid. Pixels not covered are ignored in the fit.
+"""
+import os
+
+import numpy as np
+
+from pyspec.errors import SpectrumError
+from pyspec.history import LRUCache
+from pyspec.instrumentation import add_allocation, instrument
+
+DEFAULT_Z_MIN = 0.0
+DEFAULT_Z_MAX = 1.0
+DEFAULT_LOG_STEP = 2e-4  # in natural log units (about 60 km/s)
+BLOCK_SIZE = 64 * 1024**2  # in bytes, memory of the matrices of each block
+TEMPLATE_CACHE_SIZE = 8  # number of resampled grids kept per TemplateSet
+REDSHIFT_DTYPE = np.dtype([
+    ("z", "f8"),
+    ("z_error", "f8"),
+    ("chi2", "f8"),
+    ("delta_chi2", "f8"),
+    ("amplitude", "f8"),
+    ("template", "i4"),
+    ("template_name", "U64"),
+])
+
+class TemplateSet:
+    """ Rest-frame templates for redshift fitting
+
+    Class methods
+    -------------
+    from_files
+
+    Methods
+    -------
+    __init__
+    __len__
+    resampled
+
+    Attributes
+    ----------
+    fluxes: list of array of float
+    The flux of each template
+
+    names: list of str
+    The name of each template (e.g. its class)
+
+    wavelengths: list of array of float
+    The rest-frame wavelength of each template, increasing
+
+    _resampled: LRUCache
+    The templates resampled onto log-wavelength grids. Keys are the grid
+    (start, step, size)
+    """
+    def __init__(self, wavelengths, fluxes, names=None):
+        """Initialize instance
+
+        Arguments
+        ---------
+        wavelengths: list of array of float
+        The rest-frame wavelength of each template, increasing
+
+        fluxes: list of array of float
+        The flux of each template
+
+        names: list of str or None - Default: None
+        The name of each template. If None, "template<index>"
+
+        Raise
+        -----
+        SpectrumError if the sizes are not consistent
+        """
+        if len(wavelengths) != len(fluxes) or len(fluxes) == 0:
+            raise SpectrumError(
+                "Spectrum: Templates need one wavelength array per flux array")
+        if names is None:
+            names = [f"template{index}" for index in range(len(fluxes))]
+        self.wavelengths = [np.asarray(item, dtype=float) for item in wavelengths]
+        self.fluxes = [np.asarray(item, dtype=float) for item in fluxes]
+        self.names = list(names)
+        self._resampled = LRUCache(TEMPLATE_CACHE_SIZE)
+
+    def __len__(self):
+        """Number of templates"""
+        return len(self.fluxes)
+
+    @classmethod
+    def from_files(cls, filenames):
+        """Load templates saved as calibrated spectra (see Spectrum.from_file)
+
+        Arguments
+        ---------
+        filenames: list of str
+        The template files. The names of the templates are the file names
+        without directory and extension
+
+        Return
+        ------
+        templates: TemplateSet
+        The loaded templates
+
+        Raise
+        -----
+        SpectrumError if a file cannot be read or is not calibrated
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.spectrum import Spectrum
+
+        spectra = [Spectrum.from_file(filename) for filename in filenames]
+        if any(spectrum.wavelength is None for spectrum in spectra):
+            raise SpectrumError("Spectrum: Templates must be calibrated")
+        return cls([spectrum.wavelength for spectrum in spectra],
+                   [spectrum.flux for spectrum in spectra],
+                   [os.path.splitext(os.path.basename(filename))[0]
+                    for filename in filenames])
+
+    def resampled(self, start, step, size):
+        """Get the templates resampled onto a log-wavelength grid
+
+        Arguments
+        ---------
+        start: float
+        Natural log of the first wavelength of the grid
+
+        step: float
+        Step of the grid in natural log units
+
+        size: int
+        Number of pixels of the grid
+
+        Return
+        ------
+        fluxes: array of float
+        The resampled templates (one row per template). Pixels outside the
+        template wavelength range are 0
+        """
+        key = (float(start), float(step), int(size))
+        fluxes = self._resampled.get(key)
+        if fluxes is None:
+            grid = np.exp(start + step * np.arange(size))
+            fluxes = np.vstack([
+                np.interp(grid, wavelength, flux, left=0.0, right=0.0)
+                for wavelength, flux in zip(self.wavelengths, self.fluxes)
+            ])
+            add_allocation(fluxes)
+            self._resampled.put(key, fluxes)
+        return fluxes
+
+def _resample_spectra(flux, wavelength, grid):
+    """Resample spectra onto a wavelength grid
+
+    Arguments
+    ---------
+    flux: array of float
+    The fluxes. One row per spectrum
+
+    wavelength: array of float
+    The wavelength. Shared (1D) or one row per spectrum (2D). Increasing
+
+    grid: array of float
+    The new wavelength grid
+
+    Return
+    ------
+    flux: array of float
+    The resampled fluxes. nan outside the wavelength range of each spectrum
+    """
+    if wavelength.ndim == 2:
+        return np.vstack([
+            np.interp(grid, row_wavelength, row_flux, left=np.nan,
+                      right=np.nan)
+            for row_wavelength, row_flux in zip(wavelength, flux)
+        ])
+    # same interpolation weights for all the spectra
+    indices = np.clip(np.searchsorted(wavelength, grid) - 1, 0,
+                      wavelength.size - 2)
+    fractions = ((grid - wavelength[indices]) /
+                 (wavelength[indices + 1] - wavelength[indices]))
+    resampled = (flux[:, indices] * (1.0 - fractions) +
+                 flux[:, indices + 1] * fractions)
+    resampled[:, (grid < wavelength[0]) | (grid > wavelength[-1])] = np.nan
+    return resampled
+
+@instrument("find_redshifts")
+# pylint: disable-next=too-many-arguments,too-many-locals,too-many-statements
+def find_redshifts(flux, wavelength, templates, z_min=DEFAULT_Z_MIN,
+                   z_max=DEFAULT_Z_MAX, log_step=DEFAULT_LOG_STEP,
+                   weights=None):
+    """Find the redshift and the best template of one or many spectra
+
+    Arguments
+    ---------
+    flux: array of float
+    The flux of one spectrum (1D) or of many spectra (2D, one row per
+    spectrum)
+
+    wavelength: array of float
+    The wavelength. Shared (1D) or one row per spectrum (2D). Increasing
+
+    templates: TemplateSet
+    The templates
+
+    z_min: float - Default: DEFAULT_Z_MIN
+    Minimum redshift of the grid
+
+    z_max: float - Default: DEFAULT_Z_MAX
+    Maximum redshift of the grid
+
+    log_step: float - Default: DEFAULT_LOG_STEP
+    Step of the grid in log(1 + z)
+
+    weights: array of float or None - Default: None
+    Weight of each pixel (e.g. the inverse variance), with the shape of flux.
+    If None, all the finite pixels have weight 1. The uncertainties are only
+    meaningful with inverse variance weights
+
+    Return
+    ------
+    results: structured array
+    The redshift, its uncertainty, the chi2, the difference with the chi2 of
+    the second best template (delta_chi2), the template amplitude and the
+    best template of each spectrum (see REDSHIFT_DTYPE). A single record for
+    one spectrum
+
+    Raise
+    -----
+    SpectrumError if the redshift range is not valid
+    """
+    if not -1.0 < z_min < z_max:
+        raise SpectrumError(
+            "Spectrum: The redshift range must satisfy -1 < z_min < z_max")
+    flux_2d = np.atleast_2d(flux).astype(np.float64, copy=False)
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+
+    # log-wavelength grid covering the spectra
+    start = np.log(np.max(wavelength[..., 0]))
+    end = np.log(np.min(wavelength[..., -1]))
+    size = int(np.floor((end - start) / log_step)) + 1
+    grid = np.exp(start + log_step * np.arange(size))
+    resampled = _resample_spectra(flux_2d, wavelength, grid)
+    if weights is None:
+        spectra_weights = np.isfinite(resampled).astype(np.float64)
+    else:
+        spectra_weights = _resample_spectra(
+            np.atleast_2d(weights).astype(np.float64, copy=False), wavelength,
+            grid)
+        spectra_weights[~np.isfinite(resampled)] = 0.0
+    spectra_weights[~np.isfinite(spectra_weights)] = 0.0
+    resampled[spectra_weights == 0.0] = 0.0
+    weighted_flux = spectra_weights * resampled
+    shared_weights = np.all(spectra_weights == spectra_weights[0])
+    flux_term = np.sum(weighted_flux * resampled, axis=1)
+
+    # shift k of the grid is the redshift exp((first_shift + k) * step) - 1
+    first_shift = int(np.floor(np.log1p(z_min) / log_step))
+    num_shifts = int(np.ceil(np.log1p(z_max) / log_step)) - first_shift + 1
+    # template grid: window num_shifts - 1 - k is the template at shift k
+    template_fluxes = templates.resampled(
+        start - (first_shift + num_shifts - 1) * log_step, log_step,
+        size + num_shifts - 1)
+
+    num_spectra, num_templates = flux_2d.shape[0], len(templates)
+    best_chi2 = np.empty((num_spectra, num_templates))
+    best_shift = np.empty((num_spectra, num_templates), dtype=int)
+    neighbours = np.empty((num_spectra, num_templates, 2))
+    amplitudes = np.empty((num_spectra, num_templates))
+    block = max(1, BLOCK_SIZE // (8 * num_shifts * max(size, num_spectra)))
+    for first in range(0, num_templates, block):
+        last = min(first + block, num_templates)
+        windows = np.lib.stride_tricks.sliding_window_view(
+            template_fluxes[first:last], size, axis=1)[:, ::-1]
+        shifted = windows.reshape(-1, size)
+        add_allocation(shifted)
+        cross = (weighted_flux @ shifted.T).reshape(num_spectra, last - first,
+                                                    num_shifts)
+        if shared_weights:
+            # same norms for all the spectra
+            norm = (shifted**2 @ spectra_weights[0]).reshape(
+                1, last - first, num_shifts)
+        else:
+            norm = (spectra_weights @ (shifted**2).T).reshape(
+                num_spectra, last - first, num_shifts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chi2 = np.where(norm > 0.0,
+                            flux_term[:, np.newaxis, np.newaxis] -
+                            cross**2 / norm, np.inf)
+            amplitude = cross / norm
+
+        shifts = np.argmin(chi2, axis=2)
+        best_shift[:, first:last] = shifts
+        best_chi2[:, first:last] = np.take_along_axis(
+            chi2, shifts[:, :, np.newaxis], axis=2)[:, :, 0]
+        amplitudes[:, first:last] = np.take_along_axis(
+            amplitude, shifts[:, :, np.newaxis], axis=2)[:, :, 0]
+        for side, offset in enumerate((-1, 1)):
+            neighbour = np.clip(shifts + offset, 0, num_shifts - 1)
+            values = np.take_along_axis(
+                chi2, neighbour[:, :, np.newaxis], axis=2)[:, :, 0]
+            values[neighbour == shifts] = np.nan
+            neighbours[:, first:last, side] = values
+
+    rows = np.arange(num_spectra)
+    ranking = np.argsort(best_chi2, axis=1)
+    template = ranking[:, 0]
+    chi2 = best_chi2[rows, template]
+    shift = best_shift[rows, template].astype(float)
+    left, right = neighbours[rows, template, 0], neighbours[rows, template, 1]
+
+    # parabola through the minimum and its neighbours
+    curvature = left - 2.0 * chi2 + right
+    refine = np.isfinite(curvature) & (curvature > 0.0)
+    offset = np.zeros(num_spectra)
+    offset[refine] = np.clip(
+        0.5 * (left[refine] - right[refine]) / curvature[refine], -1.0, 1.0)
+    log_redshift = (first_shift + shift + offset) * log_step
+
+    results = np.zeros(num_spectra, dtype=REDSHIFT_DTYPE)
+    results["z"] = np.expm1(log_redshift)
+    results["z_error"] = np.nan
+    # chi2 increases by 1 at log_step / sqrt(curvature / 2)
+    results["z_error"][refine] = (np.exp(log_redshift[refine]) * log_step /
+                                  np.sqrt(0.5 * curvature[refine]))
+    results["chi2"] = chi2
+    results["delta_chi2"] = (best_chi2[rows, ranking[:, 1]] - chi2
+                             if num_templates > 1 else np.inf)
+    results["amplitude"] = amplitudes[rows, template]
+    results["template"] = template
+    results["template_name"] = [templates.names[index] for index in template]
+
+    if np.ndim(flux) == 1:
+        return results[0]
+    return results
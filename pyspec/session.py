@@ -0,0 +1,315 @@
+""" Save and restore working sessions
+
+A session is stored in two files:
+1. A JSON file (with extension SESSION_EXTENSION) with the opened items, the
+   operations applied to them and the state of their views (e.g. extraction
+   limits or calibration points)
+2. A binary sidecar (the same name with extension SIDECAR_EXTENSION) with the
+   derived arrays: the extracted flux and the wavelength grid of the spectra.
+   Images are restored from their operations, loading their data when needed
+
+Input files are identified by their content hash. When restoring a session,
+the stored arrays are used only if the input files did not change. Otherwise
+the products are recomputed from the stored operations. The sidecar is read
+lazily: only the arrays of the restored spectra are decompressed.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from pyspec._version import __version__
+from pyspec.calibration import Calibration
+from pyspec.errors import CalibrationError, ImageError, SessionError
+from pyspec.image import Image
+from pyspec.spectrum import Spectrum
+
+SESSION_EXTENSION = ".pyspec"
+SESSION_VERSION = 1
+SIDECAR_EXTENSION = ".npz"
+HASH_CHUNK_SIZE = 1024**2  # in bytes
+
+def file_hash(filename):
+    """Compute the content hash of a file
+
+    Arguments
+    ---------
+    filename: str
+    Name of the file
+
+    Return
+    ------
+    hash: str
+    The SHA-256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def sidecar_filename(filename):
+    """Get the name of the binary sidecar of a session file
+
+    Arguments
+    ---------
+    filename: str
+    Name of the session file
+
+    Return
+    ------
+    sidecar: str
+    Name of the sidecar file
+    """
+    if filename.endswith(SESSION_EXTENSION):
+        filename = filename[:-len(SESSION_EXTENSION)]
+    return filename + SIDECAR_EXTENSION
+
+class _HashCache:
+    """Compute file hashes only once per file
+
+    Methods
+    -------
+    __init__
+    __call__
+    matches
+
+    Attributes
+    ----------
+    hashes: dict
+    Computed hashes. Keys are the filenames. Values are the hashes or None for
+    missing files
+    """
+    def __init__(self):
+        """Initialize instance"""
+        self.hashes = {}
+
+    def __call__(self, filename):
+        """Get the hash of a file
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        Return
+        ------
+        hash: str or None
+        The file hash. None if the file does not exist
+        """
+        if filename not in self.hashes:
+            if os.path.isfile(filename):
+                self.hashes[filename] = file_hash(filename)
+            else:
+                self.hashes[filename] = None
+        return self.hashes[filename]
+
+    def matches(self, filename, expected_hash):
+        """Check if a file has the expected content
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        expected_hash: str or None
+        The expected hash
+
+        Return
+        ------
+        matches: bool
+        True if the file exists and has the expected hash
+        """
+        file_hash_ = self(filename)
+        return file_hash_ is not None and file_hash_ == expected_hash
+
+def save_session(filename, items, calibration=None):
+    """Save a session
+
+    Arguments
+    ---------
+    filename: str
+    Name of the session file. Must end with SESSION_EXTENSION
+
+    items: list of (Image or Spectrum, dict)
+    The opened items and the state of their views. The states must be JSON
+    serializable
+
+    calibration: Calibration or None - Default: None
+    The current calibration
+
+    Raise
+    -----
+    SessionError if the filename does not have the correct format
+    """
+    if not filename.endswith(SESSION_EXTENSION):
+        raise SessionError(
+            "Session: 'filename' has incorrect extension. Valid extension is "
+            f"{SESSION_EXTENSION}")
+
+    hashes = _HashCache()
+    arrays = {}
+    records = []
+    for index, (item, state) in enumerate(items):
+        if isinstance(item, Image):
+            record = {
+                "type": "image",
+                "filename": os.path.abspath(item.filename),
+                "hash": hashes(item.filename),
+                **item.selection,
+                "operations": item.history.applied_operations,
+                "state": state,
+            }
+        else:
+            record = {
+                "type": "spectrum",
+                "name": item.name,
+                "state": state,
+                "source": None,
+            }
+            if item.source is not None:
+                source = dict(item.source)
+                source["filename"] = os.path.abspath(source["filename"])
+                source["hash"] = hashes(source["filename"])
+                record["source"] = source
+            elif os.path.isfile(item.name):
+                record["hash"] = hashes(item.name)
+            arrays[f"item{index}_flux"] = item.flux
+            if item.wavelength is not None:
+                arrays[f"item{index}_wavelength"] = item.wavelength
+        records.append(record)
+
+    session = {
+        "version": SESSION_VERSION,
+        "pyspec_version": __version__,
+        "items": records,
+        "calibration_points": None,
+    }
+    if calibration is not None:
+        session["calibration_points"] = [
+            [float(item["x"]), float(item["wave"])]
+            for item in calibration.calibration_points
+        ]
+
+    np.savez_compressed(sidecar_filename(filename), **arrays)
+    with open(filename, "w", encoding="UTF-8") as file:
+        json.dump(session, file, indent=2)
+
+def load_session(filename):
+    """Restore a session
+
+    Stored products are reused when the input files are unchanged. Otherwise
+    they are recomputed from the stored operations. Images are restored without
+    loading their data (see Image.load_data)
+
+    Arguments
+    ---------
+    filename: str
+    Name of the session file
+
+    Return
+    ------
+    items: list of (Image or Spectrum, dict)
+    The restored items and the state of their views
+
+    calibration: Calibration or None
+    The restored calibration
+
+    Raise
+    -----
+    SessionError if the session cannot be restored
+    """
+    try:
+        with open(filename, encoding="UTF-8") as file:
+            session = json.load(file)
+        # arrays are decompressed when accessed
+        arrays = np.load(sidecar_filename(filename))
+    except (IOError, ValueError) as error:
+        raise SessionError(
+            f"Session: Error reading session {filename}: {str(error)}"
+            ) from error
+
+    with arrays:
+        if session.get("version") != SESSION_VERSION:
+            raise SessionError(
+                "Session: Unsupported session version "
+                f"{session.get('version')}")
+
+        hashes = _HashCache()
+        items = []
+        for index, record in enumerate(session["items"]):
+            try:
+                if record["type"] == "image":
+                    item = Image(record["filename"], load=False,
+                                 hdu=record.get("hdu"),
+                                 plane=record.get("plane"))
+                    item.set_operations(record["operations"])
+                else:
+                    item = _load_spectrum(record, index, arrays, hashes)
+            except (ImageError, IOError, ValueError) as error:
+                raise SessionError(
+                    f"Session: Error restoring {record.get('filename')}: "
+                    f"{str(error)}") from error
+            items.append((item, record["state"]))
+
+    calibration = None
+    if session["calibration_points"] is not None:
+        try:
+            calibration = Calibration.from_points(
+                dict(session["calibration_points"]))
+        except CalibrationError as error:
+            raise SessionError(
+                f"Session: Error restoring the calibration: {str(error)}"
+                ) from error
+
+    return items, calibration
+
+def _load_spectrum(record, index, arrays, hashes):
+    """Restore a spectrum
+
+    Arguments
+    ---------
+    record: dict
+    The stored spectrum record
+
+    index: int
+    Index of the record
+
+    arrays: np.lib.npyio.NpzFile
+    The opened sidecar
+
+    hashes: _HashCache
+    The input file hashes
+
+    Return
+    ------
+    spectrum: Spectrum
+    The restored spectrum
+    """
+    source = record["source"]
+    flux = arrays.get(f"item{index}_flux")
+    wavelength = arrays.get(f"item{index}_wavelength")
+
+    # spectrum extracted from an image
+    if source is not None:
+        if flux is None or not hashes.matches(source["filename"],
+                                              source["hash"]):
+            image = Image(source["filename"], hdu=source.get("hdu"),
+                          plane=source.get("plane"))
+            image.set_operations(source["operations"])
+            spectrum = Spectrum.from_image(
+                image, source["lower_limit"], source["upper_limit"])
+            spectrum.name = record["name"]
+            spectrum.wavelength = wavelength
+            return spectrum
+        del source["hash"]
+        source["operations"] = tuple(
+            tuple(operation) for operation in source["operations"])
+        return Spectrum(flux, wavelength, record["name"], source)
+
+    # spectrum loaded from file
+    if flux is None or ("hash" in record and
+                        not hashes.matches(record["name"], record["hash"])):
+        return Spectrum.from_file(record["name"])
+    return Spectrum(flux, wavelength, record["name"])
@@ -1,15 +1,25 @@
 """ Basic Spectrum """
+import logging
+import os
+
 import numpy as np
 
+from pyspec.apertures import check_apertures, extract_apertures
+from pyspec.cache import get_cache
 from pyspec.errors import SpectrumError
+from pyspec.instrumentation import add_allocation, add_bytes_read, instrument
+from pyspec.precision import get_working_dtype
 
 ACCEPTED_FORMATS = [".dat"]
 
+logger = logging.getLogger(__name__)
+
 class Spectrum:
     """ Basic Spectrum
 
     Class methods
     -------------
+    from_apertures
     from_image
     from_file
 
@@ -17,8 +27,17 @@ class Spectrum:
     -------
     __init__
     find_local_max
+    find_redshift
+    fit_lines
+    flux_calibrate
+    normalize
+    read_source_header
     save
 
+    Properties
+    ----------
+    nbytes
+
     Attributes
     ----------
     flux: array of float
@@ -29,8 +48,14 @@ class Spectrum:
 
     name: str
     Name of the file
+
+    source: dict or None
+    Provenance of the spectrum. For spectra extracted from an Image, it
+    contains the keys "filename", "hdu" and "plane" (see Image.selection),
+    "operations" (the operations applied to the Image, see History),
+    "lower_limit" and "upper_limit". None otherwise
     """
-    def __init__(self, flux, wavelength, name):
+    def __init__(self, flux, wavelength, name, source=None):
         """Initialize instance
 
         Arguments
@@ -44,10 +69,22 @@ class Spectrum:
         name: str
         Name of the spectrum. E.g. name of the loaded file or suggested name
         for the saving file
+
+        source: dict or None - Default: None
+        Provenance of the spectrum
         """
         self.name = name
         self.flux = flux
         self.wavelength = wavelength
+        self.source = source
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the spectrum arrays"""
+        nbytes = self.flux.nbytes
+        if self.wavelength is not None:
+            nbytes += self.wavelength.nbytes
+        return nbytes
 
     def find_local_max(self, x_pos):
         """Find the local maximum.
@@ -74,10 +111,207 @@ class Spectrum:
                 return x_pos
 
 
+    def find_redshift(self, templates, **kwargs):
+        """Find the redshift and the best template of the spectrum
+
+        See redshift.find_redshifts
+
+        Arguments
+        ---------
+        templates: TemplateSet
+        The templates
+
+        **kwargs: dict
+        Other arguments of redshift.find_redshifts (z_min, z_max, log_step
+        and weights)
+
+        Return
+        ------
+        result: structured array record
+        The redshift, its uncertainty and the best template (see
+        redshift.REDSHIFT_DTYPE)
+
+        Raise
+        -----
+        SpectrumError if the spectrum is not calibrated
+        """
+        if self.wavelength is None:
+            raise SpectrumError("Spectrum: Cannot find the redshift of "
+                                "uncalibrated spectra")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.redshift import find_redshifts
+        return find_redshifts(self.flux, self.wavelength, templates, **kwargs)
+
+    def fit_lines(self, centres, **kwargs):
+        """Fit the profiles of several lines
+
+        The lines are fitted together with line_fitting.fit_lines
+
+        Arguments
+        ---------
+        centres: array of float
+        Expected centre of each line, in wavelength
+
+        **kwargs: dict
+        Other arguments of line_fitting.fit_lines (profile, half_window,
+        sigma, max_iterations and tolerance)
+
+        Return
+        ------
+        results: structured array
+        The fitted lines (see line_fitting.LINE_FIT_DTYPE)
+
+        Raise
+        -----
+        SpectrumError if the spectrum is not calibrated
+        """
+        if self.wavelength is None:
+            raise SpectrumError("Spectrum: Cannot fit lines of uncalibrated "
+                                "spectra")
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.line_fitting import fit_lines
+        return fit_lines(self.flux, self.wavelength, centres, **kwargs)
+
+    def flux_calibrate(self, sensitivity, exptime=None, airmass=None):
+        """Convert the flux from counts into flux densities
+
+        Arguments
+        ---------
+        sensitivity: SensitivityFunction
+        The sensitivity function (see pyspec.flux_calibration)
+
+        exptime: float or None - Default: None
+        Exposure time in seconds. If None, the EXPTIME keyword of the source
+        frame
+
+        airmass: float or None - Default: None
+        Airmass. If None, the AIRMASS keyword of the source frame
+
+        Raise
+        -----
+        SpectrumError if the spectrum is not calibrated
+        SpectrumError if the exposure time or the airmass are not known
+        """
+        if self.wavelength is None:
+            raise SpectrumError("Spectrum: Cannot flux calibrate uncalibrated "
+                                "spectra")
+        if exptime is None or airmass is None:
+            header = self.read_source_header() or {}
+            if exptime is None:
+                exptime = header.get("EXPTIME")
+            if airmass is None:
+                airmass = header.get("AIRMASS")
+        if exptime is None or airmass is None:
+            raise SpectrumError(
+                "Spectrum: Exposure time and airmass are needed to flux "
+                "calibrate")
+        self.flux = sensitivity.calibrate(
+            self.flux, self.wavelength, float(exptime),
+            float(airmass)).astype(self.flux.dtype, copy=False)
+
+    @instrument("Spectrum.normalize")
+    def normalize(self, masked_ranges=None, **kwargs):
+        """Divide the flux by its continuum
+
+        The continuum is fitted with continuum.fit_continuum
+
+        Arguments
+        ---------
+        masked_ranges: list of (float, float) or None - Default: None
+        Ranges excluded from the fit, in wavelength if the spectrum is
+        calibrated or in pixels otherwise
+
+        **kwargs: dict
+        Other arguments of continuum.fit_continuum (model, num_coefficients,
+        sigma_lower, sigma_upper and max_iterations)
+
+        Return
+        ------
+        continuum: array of float
+        The fitted continuum
+
+        Raise
+        -----
+        SpectrumError if the continuum cannot be fitted
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.continuum import fit_continuum
+        continuum, _ = fit_continuum(self.flux, self.wavelength, masked_ranges,
+                                     **kwargs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.flux = (self.flux / continuum).astype(self.flux.dtype,
+                                                       copy=False)
+        return continuum
+
     @classmethod
+    @instrument("Spectrum.from_apertures")
+    def from_apertures(cls, image, apertures):
+        """Create one Spectrum per aperture of an Image
+
+        All the apertures are extracted at once from a single read of the rows
+        they span (see Image.read_band and apertures.extract_apertures). If the
+        disk cache is active (see pyspec.cache) and contains all the extracted
+        fluxes, the image data is not needed
+
+        Arguments
+        ---------
+        image: Image
+        Image from which to extract the spectra
+
+        apertures: list of (int, int)
+        Lower and upper limits of each aperture. Must be sorted and must not
+        overlap (see apertures.find_apertures)
+
+        Return
+        ------
+        spectra: list of Spectrum
+        The initialized spectra, one per aperture
+
+        Raise
+        -----
+        SpectrumError if the apertures are not valid
+        """
+        if len(apertures) == 0:
+            return []
+        check_apertures(apertures)
+        sources = [
+            _extracted_source(image, lower_limit, upper_limit)
+            for lower_limit, upper_limit in apertures
+        ]
+
+        fluxes = None
+        cache = get_cache()
+        if cache is not None:
+            keys = [_extracted_key(cache, source) for source in sources]
+            fluxes = [cache.get(key) for key in keys]
+            if any(flux is None for flux in fluxes):
+                fluxes = None
+
+        if fluxes is None:
+            first_row = apertures[0][0]
+            band = image.read_band(first_row, apertures[-1][1])
+            fluxes = extract_apertures(band, apertures, first_row)
+            add_allocation(fluxes)
+            if cache is not None:
+                for key, flux in zip(keys, fluxes):
+                    cache.put(key, flux)
+
+        return [
+            cls(flux, None, _extracted_name(image, f"_ap{index}"), source)
+            for index, (flux, source) in enumerate(zip(fluxes, sources))
+        ]
+
+    @classmethod
+    @instrument("Spectrum.from_image")
     def from_image(cls, image, lower_limit, upper_limit):
         """Create a Spectrum from an Image
 
+        If the disk cache is active (see pyspec.cache) and contains the
+        extracted flux, the image data is not needed. If the image data is not
+        loaded, only the rows needed for the extraction are read, in a single
+        pass (see Image.read_band), so frames larger than the memory can be
+        extracted
+
         Arguments
         ---------
         image: Image
@@ -94,14 +328,27 @@ class Spectrum:
         spectrum: Spectrum
         The initialized spectrum
         """
-        name = image.filename.replace(
-            image.image_extension, "_extracted.dat")
-        flux = np.mean(image.data[lower_limit: upper_limit, :], axis=0)
+        name = _extracted_name(image)
         wavelength = None
+        source = _extracted_source(image, lower_limit, upper_limit)
+
+        flux = None
+        cache = get_cache()
+        if cache is not None:
+            key = _extracted_key(cache, source)
+            flux = cache.get(key)
+
+        if flux is None:
+            flux = np.mean(image.read_band(lower_limit, upper_limit), axis=0,
+                           dtype=get_working_dtype())
+            add_allocation(flux)
+            if cache is not None:
+                cache.put(key, flux)
 
-        return cls(flux, wavelength, name)
+        return cls(flux, wavelength, name, source)
 
     @classmethod
+    @instrument("Spectrum.from_file")
     def from_file(cls, filename):
         """Load a Spectrum from file
 
@@ -120,8 +367,10 @@ class Spectrum:
         SpectrumError if the file content was not correct
         """
         data = np.genfromtxt(filename, names=True)
-        print(data)
-        print(data.dtype.names)
+        add_bytes_read(os.path.getsize(filename))
+        add_allocation(data)
+        logger.debug("%s: read %d rows with columns %s", filename, data.size,
+                     data.dtype.names)
 
         try:
             flux = data["flux"]
@@ -136,6 +385,25 @@ class Spectrum:
 
         return cls(flux, wavelength, filename)
 
+    def read_source_header(self):
+        """Read the header of the frame the spectrum was extracted from
+
+        Only the header is read
+
+        Return
+        ------
+        header: astropy.io.fits.header.Header or None
+        The header. None if the spectrum was not extracted from an Image
+        """
+        if self.source is None:
+            return None
+        # pylint: disable-next=import-outside-toplevel
+        from pyspec.image import Image
+        return Image(self.source["filename"], load=False,
+                     hdu=self.source.get("hdu"),
+                     plane=self.source.get("plane")).header
+
+    @instrument("Spectrum.save")
     def save(self):
         """Save spectrum
 
@@ -163,3 +431,108 @@ class Spectrum:
                 file.write("# wavelength[Angstroms] flux\n")
                 for flux, wavelength in zip(self.flux, self.wavelength):
                     file.write(f"{wavelength} {flux}\n")
+
+def _extracted_key(cache, source):
+    """Compute the cache key of an extracted flux
+
+    Arguments
+    ---------
+    cache: ResultCache
+    The active cache
+
+    source: dict
+    Provenance of the spectrum (see _extracted_source)
+
+    Return
+    ------
+    key: str
+    The entry key
+    """
+    return cache.key(
+        cache.input_key(source["filename"]), "extract", {
+            "hdu": source["hdu"],
+            "plane": source["plane"],
+            "operations": source["operations"],
+            "lower_limit": int(source["lower_limit"]),
+            "upper_limit": int(source["upper_limit"]),
+            "dtype": get_working_dtype().name,
+        })
+
+def _extracted_name(image, suffix=""):
+    """Get the default name of a spectrum extracted from an Image
+
+    Arguments
+    ---------
+    image: Image
+    The Image
+
+    suffix: str - Default: ""
+    Added before "_extracted.dat" (e.g. to tell the apertures apart)
+
+    Return
+    ------
+    name: str
+    The name of the spectrum
+    """
+    selection = "".join(
+        f"_{key}{value}" for key, value in image.selection.items()
+        if value is not None)
+    return image.filename.replace(
+        image.image_extension, f"{selection}{suffix}_extracted.dat")
+
+def _extracted_source(image, lower_limit, upper_limit):
+    """Get the provenance of a spectrum extracted from an Image
+
+    Arguments
+    ---------
+    image: Image
+    The Image
+
+    lower_limit: int
+    Lower limit of the extraction region
+
+    upper_limit: int
+    Upper limit of the extraction region
+
+    Return
+    ------
+    source: dict
+    The provenance (see Spectrum.source)
+    """
+    return {
+        "filename": image.filename,
+        **image.selection,
+        "operations": image.history.applied_operations,
+        "lower_limit": lower_limit,
+        "upper_limit": upper_limit,
+    }
+
+def save_spectra(spectra, directory=None):
+    """Save several spectra
+
+    Arguments
+    ---------
+    spectra: list of Spectrum
+    The spectra
+
+    directory: str or None - Default: None
+    Directory where the spectra are saved, keeping their file names. If None,
+    each spectrum is saved with its name
+
+    Return
+    ------
+    names: list of str
+    Names of the saved files
+
+    Raise
+    -----
+    SpectrumError if a spectrum name does not have the correct format
+    """
+    names = []
+    for spectrum in spectra:
+        if directory is not None:
+            spectrum.name = os.path.join(
+                directory, os.path.basename(spectrum.name))
+        spectrum.save()
+        names.append(spectrum.name)
+    return names
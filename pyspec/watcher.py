@@ -0,0 +1,428 @@
+""" Reduce the frames written into a directory as they land
+
+Frames are detected by polling the directory. A frame is queued once its size
+and modification time did not change between two consecutive polls (and, for
+uncompressed FITS files, its size is a whole number of FITS blocks), so frames
+still being written by the camera software are never read.
+
+At most max_pending frames are queued into the worker pool at the same time.
+The remaining frames stay on disk until a worker is free, so a burst of frames
+never exhausts the memory.
+
+Usage:
+    watcher = DirectoryWatcher(directory, rotation_angle, lower_limit,
+                               upper_limit)
+    with watcher:
+        watcher.run()  # until stop() is called or Ctrl+C
+
+Leaving the context waits for the queued frames. Use terminate to stop without
+waiting (e.g. from a GUI). dev_tools/watcher_check.py exercises the watcher on
+synthetic frames written into a temporary directory.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+from pyspec import instrumentation
+from pyspec.batch import _init_worker, _reduce_frame_star, log_metrics
+from pyspec.cache import get_cache
+from pyspec.errors import ImageError
+from pyspec.fits_utils import FITS_BLOCK_SIZE
+from pyspec.frame_types import EXTRACTED_FRAME_TYPES, classify_frame
+from pyspec.image import ACCEPTED_FORMATS
+from pyspec.metrics import ThroughputReport
+from pyspec.precision import get_working_dtype
+
+DEFAULT_POLL_INTERVAL = 2.0  # in seconds
+
+logger = logging.getLogger(__name__)
+
+class DirectoryWatcher:
+    """ Reduce the frames written into a directory with the same settings
+
+    Methods
+    -------
+    __init__
+    __enter__
+    __exit__
+    _failed
+    _finished
+    _frame_settings
+    _is_complete
+    _scan
+    close
+    poll
+    run
+    stop
+    terminate
+
+    Attributes
+    ----------
+    archive: SpectralArchive or None
+    Archive where the spectra are also stored
+
+    directory: str
+    The watched directory
+
+    failed: list of str
+    Names of the frames whose reduction failed. They are also recorded in
+    report
+
+    max_pending: int
+    Maximum number of frames queued into the worker pool at the same time
+
+    names: list of str
+    Names of the saved spectra
+
+    poll_interval: float
+    Time between polls in run, in seconds
+
+    queued: list of str
+    Names of the frames queued into the worker pool
+
+    route: bool
+    If True, only arcs and science frames are reduced (see _frame_settings)
+
+    report: ThroughputReport
+    The metrics of the reduced frames
+
+    settings: tuple
+    Rotation angle, lower limit, upper limit, calibration, output directory
+    and sensitivity function (see batch.reduce_frame)
+
+    skipped: list of str
+    Names of the frames not reduced because of their frame type
+
+    spectra: list or None
+    List where the spectra are also appended, as they are collected by poll
+
+    _candidates: dict
+    Frames not queued yet. Keys are the filenames and values their size and
+    modification time in the last poll
+
+    _pool: multiprocessing.Pool
+    The worker pool
+
+    _results: queue.Queue
+    Results sent by the worker pool and not yet processed by poll
+
+    _seen: set of str
+    Frames already queued (or present when the watcher started)
+
+    _slots: threading.BoundedSemaphore
+    Free places in the worker pool queue
+
+    _stop: threading.Event
+    Set to stop run
+    """
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, directory, rotation_angle, lower_limit, upper_limit,
+                 calibration=None, output_dir=None, num_processors=1,
+                 max_pending=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                 skip_existing=True, archive=None, sensitivity=None,
+                 route=False, spectra=None):
+        """Initialize instance and start the worker pool
+
+        Arguments
+        ---------
+        directory: str
+        The watched directory
+
+        rotation_angle: float
+        Rotation angle in degrees
+
+        lower_limit: int
+        Lower limit of the extraction region
+
+        upper_limit: int
+        Upper limit of the extraction region
+
+        calibration: Calibration or None - Default: None
+        Wavelength calibration. If None, the spectra are not calibrated
+
+        output_dir: str or None - Default: None
+        Directory where the spectra are saved. If None, they are saved next to
+        the frames
+
+        num_processors: int - Default: 1
+        Number of worker processes
+
+        max_pending: int or None - Default: None
+        Maximum number of frames queued into the worker pool at the same time.
+        If None, twice the number of worker processes
+
+        poll_interval: float - Default: DEFAULT_POLL_INTERVAL
+        Time between polls in run, in seconds
+
+        skip_existing: bool - Default: True
+        If True, frames already in the directory are not reduced
+
+        archive: SpectralArchive or None - Default: None
+        Archive where the spectra are also stored, as they are collected by
+        poll
+
+        sensitivity: SensitivityFunction or None - Default: None
+        Sensitivity function. If None, the spectra are not flux calibrated
+
+        route: bool - Default: False
+        If True, classify each frame before queuing it (see
+        pyspec.frame_types). Only arcs and science frames are reduced, and
+        arcs are not flux calibrated
+
+        spectra: list or None - Default: None
+        List where the spectra are also appended, as they are collected by poll
+        """
+        self.directory = directory
+        self.settings = (rotation_angle, lower_limit, upper_limit, calibration,
+                         output_dir, sensitivity)
+        self.max_pending = max_pending or 2 * max(num_processors, 1)
+        self.poll_interval = poll_interval
+        self.names = []
+        self.failed = []
+        self.queued = []
+        self.report = ThroughputReport()
+        self.archive = archive
+        self.route = route
+        self.skipped = []
+        self.spectra = spectra
+
+        self._candidates = {}
+        self._seen = set(self._scan()) if skip_existing else set()
+        self._results = queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._stop = threading.Event()
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        cache = get_cache()
+        initargs = (None, 0) if cache is None else (
+            cache.directory, cache.max_size)
+        initargs += (instrumentation.is_enabled(), get_working_dtype().name)
+        self._pool = multiprocessing.Pool(
+            max(num_processors, 1), _init_worker, initargs)
+
+    def __enter__(self):
+        """Enter the context
+
+        Return
+        ------
+        watcher: DirectoryWatcher
+        This instance
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Wait for the queued frames and stop the worker pool"""
+        self.close()
+
+    def _failed(self, filename, error):
+        """Record a failed reduction. Called from the worker pool
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        error: Exception
+        The error raised by the reduction
+        """
+        self._slots.release()
+        self._results.put((filename, None, error))
+
+    def _finished(self, filename, result):
+        """Record a finished reduction. Called from the worker pool
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        result: tuple
+        The saved spectrum, the metrics, the instrumentation records and the
+        error message, if any (see batch._reduce_frame_star)
+        """
+        self._slots.release()
+        self._results.put((filename, result, None))
+
+    def _frame_settings(self, filename):
+        """Get the reduction settings of a frame
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        Return
+        ------
+        settings: tuple or None
+        The settings (see the attribute settings). If route is True, arcs
+        have no sensitivity function and other calibration frames return None
+        """
+        if not self.route:
+            return self.settings
+        try:
+            frame_type, _ = classify_frame(filename)
+        except ImageError as error:
+            # the reduction reports the error
+            logger.debug("%s: classification failed: %s", filename, error)
+            return self.settings
+        if frame_type not in EXTRACTED_FRAME_TYPES:
+            logger.info("%s: %s frame skipped", filename, frame_type)
+            return None
+        if frame_type == "arc":
+            return self.settings[:-1] + (None,)
+        return self.settings
+
+    @staticmethod
+    def _is_complete(filename, size):
+        """Check if the size of a frame is consistent with a complete file
+
+        Arguments
+        ---------
+        filename: str
+        Name of the frame
+
+        size: int
+        Size of the frame in bytes
+
+        Return
+        ------
+        complete: bool
+        False if the frame is empty or, for uncompressed frames, if the size is
+        not a whole number of FITS blocks
+        """
+        if size == 0:
+            return False
+        if filename.endswith(".gz"):
+            return True
+        return size % FITS_BLOCK_SIZE == 0
+
+    def _scan(self):
+        """List the frames in the directory
+
+        Return
+        ------
+        frames: dict
+        Keys are the filenames and values their size and modification time
+        """
+        frames = {}
+        for entry in os.scandir(self.directory):
+            if not any(entry.name.endswith(format_check)
+                       for format_check in ACCEPTED_FORMATS):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed since listed
+                continue
+            frames[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return frames
+
+    def close(self):
+        """Wait for the queued frames and stop the worker pool
+
+        Frames detected but not queued yet are not reduced
+        """
+        self._pool.close()
+        self._pool.join()
+        self.poll(queue_frames=False)
+
+    def poll(self, queue_frames=True):
+        """Check for new frames and collect the finished reductions
+
+        Arguments
+        ---------
+        queue_frames: bool - Default: True
+        If True, queue the new frames whose writing finished, as long as there
+        are free places in the worker pool
+
+        Return
+        ------
+        names: list of str
+        Names of the spectra saved since the last poll
+        """
+        if queue_frames:
+            frames = self._scan()
+            for filename in sorted(frames):
+                if filename in self._seen:
+                    continue
+                size_mtime = frames[filename]
+                stable = self._candidates.get(filename) == size_mtime
+                self._candidates[filename] = size_mtime
+                if not stable or not self._is_complete(filename, size_mtime[0]):
+                    continue
+                if not self._slots.acquire(blocking=False):
+                    # backpressure: wait for a free worker
+                    break
+                del self._candidates[filename]
+                self._seen.add(filename)
+                settings = self._frame_settings(filename)
+                if settings is None:
+                    self._slots.release()
+                    self.skipped.append(filename)
+                    continue
+                logger.debug("%s: queued", filename)
+                self.queued.append(filename)
+                self._pool.apply_async(
+                    _reduce_frame_star,
+                    ((filename,) + settings,),
+                    callback=lambda result, filename=filename: self._finished(
+                        filename, result),
+                    error_callback=lambda error, filename=filename:
+                        self._failed(filename, error))
+
+        names = []
+        while True:
+            try:
+                filename, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if error is None:
+                spectrum, metrics, records, error = result
+                instrumentation.merge(records)
+            if error is not None:
+                logger.error("%s: reduction failed: %s", filename, error)
+                self.failed.append(filename)
+                self.report.add_failure(filename, error)
+                continue
+            names.append(spectrum.name)
+            if self.archive is not None:
+                self.archive.append(spectrum)
+            if self.spectra is not None:
+                self.spectra.append(spectrum)
+            self.report.add(metrics)
+            log_metrics(metrics)
+        self.names += names
+        return names
+
+    def run(self):
+        """Poll the directory until stop is called"""
+        logger.info("Watching %s", self.directory)
+        self._stop.clear()
+        while not self._stop.wait(self.poll_interval):
+            self.poll()
+
+    def stop(self):
+        """Stop run after the current poll"""
+        self._stop.set()
+
+    def terminate(self):
+        """Stop the worker pool without waiting for the queued frames
+
+        The finished reductions are collected. The frames still queued or being
+        reduced are not saved
+
+        Return
+        ------
+        num_dropped: int
+        Number of queued frames that were not reduced
+        """
+        self._pool.terminate()
+        self._pool.join()
+        self.poll(queue_frames=False)
+        num_dropped = len(self.queued) - len(self.names) - len(self.failed)
+        if num_dropped > 0:
+            logger.warning("%d queued frames were not reduced", num_dropped)
+        return num_dropped
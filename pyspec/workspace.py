@@ -0,0 +1,162 @@
+""" Workspace holding several Images and Spectra """
+from collections import OrderedDict
+
+from pyspec.errors import WorkspaceError
+from pyspec.image import Image
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024**3  # in bytes
+
+class Workspace:
+    """ Collection of the opened Images and Spectra
+
+    The workspace keeps track of the order in which the items were used. When
+    the memory used by all items exceeds the memory budget, the data of the
+    least recently used Images is released. It is read again from file the
+    next time the Image is activated. Spectra are never released as they
+    might not exist on disk.
+
+    Items are stored by reference, so the arrays are shared with whoever
+    holds the item (e.g. the plotting widgets).
+
+    Methods
+    -------
+    __init__
+    __contains__
+    __iter__
+    __len__
+    activate
+    add
+    memory_usage
+    remove
+
+    Attributes
+    ----------
+    items: list of Image or Spectrum
+    The items in the workspace, in the order they were added
+
+    memory_budget: int
+    Maximum number of bytes used by the items' data before releasing the least
+    recently used Images
+
+    _last_used: OrderedDict
+    The items sorted from the least to the most recently used. Keys are
+    the item ids and values the items
+    """
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """Initialize instance
+
+        Arguments
+        ---------
+        memory_budget: int - Default: DEFAULT_MEMORY_BUDGET
+        Maximum number of bytes used by the items' data
+        """
+        self.items = []
+        self.memory_budget = memory_budget
+        self._last_used = OrderedDict()
+
+    def __contains__(self, item):
+        """Check if an item is in the workspace"""
+        return id(item) in self._last_used
+
+    def __iter__(self):
+        """Iterate over the items"""
+        return iter(self.items)
+
+    def __len__(self):
+        """Number of items in the workspace"""
+        return len(self.items)
+
+    def activate(self, item):
+        """Mark an item as the most recently used one
+
+        The item data is loaded if it was released. Then, the data of the least
+        recently used Images is released until the memory usage is within the
+        budget. The activated item is never released.
+
+        Arguments
+        ---------
+        item: Image or Spectrum
+        The activated item
+
+        Return
+        ------
+        released: list of Image
+        The Images whose data was released
+
+        Raise
+        -----
+        WorkspaceError if the item is not in the workspace
+        """
+        if item not in self:
+            raise WorkspaceError(
+                "Workspace: Cannot activate an item that is not in the "
+                "workspace")
+
+        self._last_used.move_to_end(id(item))
+        if isinstance(item, Image):
+            item.load_data()
+
+        released = []
+        for other in list(self._last_used.values())[:-1]:
+            if self.memory_usage() <= self.memory_budget:
+                break
+            if isinstance(other, Image) and other.is_loaded:
+                other.release_data()
+                released.append(other)
+
+        return released
+
+    def add(self, item, activate=True):
+        """Add an item and make it the active one
+
+        Arguments
+        ---------
+        item: Image or Spectrum
+        The new item
+
+        activate: bool - Default: True
+        If True, activate the item. Otherwise the item is added as the least
+        recently used one and its data is not loaded
+
+        Return
+        ------
+        released: list of Image
+        The Images whose data was released (see activate)
+        """
+        if item not in self:
+            self.items.append(item)
+            self._last_used[id(item)] = item
+            if not activate:
+                self._last_used.move_to_end(id(item), last=False)
+        if not activate:
+            return []
+        return self.activate(item)
+
+    def memory_usage(self):
+        """Compute the number of bytes used by the items' data
+
+        Return
+        ------
+        nbytes: int
+        The number of bytes
+        """
+        return sum(item.nbytes for item in self.items)
+
+    def remove(self, item):
+        """Remove an item from the workspace
+
+        Arguments
+        ---------
+        item: Image or Spectrum
+        The item to remove
+
+        Raise
+        -----
+        WorkspaceError if the item is not in the workspace
+        """
+        if item not in self:
+            raise WorkspaceError(
+                "Workspace: Cannot remove an item that is not in the "
+                "workspace")
+        self.items.remove(item)
+        del self._last_used[id(item)]